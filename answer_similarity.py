@@ -0,0 +1,96 @@
+"""似た回答の検出（文字n-gram・最小ハッシュ・LSH）
+
+生成した回答のうち互いによく似たものをまとめる。全ペアを比較せずに済むよう、最小ハッシュ署名を帯に分けた
+LSHで比較する候補を絞る。アプリ本体から切り離して単体で検証できるようにこのモジュールに置く。
+"""
+import re
+import unicodedata
+
+import numpy as np
+
+
+# 回答の文字n-gram作成関数
+def build_answer_shingles(text, shingle_size=3):
+    """回答を正規化し、文字n-gramのハッシュ値の集合（重複なしの配列）を返す"""
+    normalized = re.sub(r"\s+", "", unicodedata.normalize("NFKC", str(text)).lower())
+    codes = np.frombuffer(normalized.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    shingle_size = min(shingle_size, len(codes))
+    if shingle_size == 0:
+        return codes
+    # 文字コードを多項式ハッシュでまとめて、n-gramごとの値を一度に計算する
+    hashes = np.zeros(len(codes) - shingle_size + 1, dtype=np.uint64)
+    for offset in range(shingle_size):
+        hashes = hashes * np.uint64(1000003) + codes[offset:len(codes) - shingle_size + 1 + offset]
+    # 32ビットに畳み込む（最小ハッシュの乗算シフト法の入力に合わせる）
+    return np.unique((hashes ^ (hashes >> np.uint64(32))) & np.uint64(0xFFFFFFFF))
+
+
+# 最小ハッシュ署名計算関数
+def compute_minhash_signatures(shingle_sets, num_perm=64, seed=0):
+    """空でないn-gram集合ごとの最小ハッシュ署名（行: 回答、列: ハッシュ関数）を返す（係数は固定の乱数で毎回同じ）"""
+    rng = np.random.default_rng(seed)
+    # 乗算シフト法のハッシュ関数族（64ビットの積の上位32ビット）
+    coefficients = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) | np.uint64(1)
+    offsets = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+    signatures = np.empty((len(shingle_sets), num_perm), dtype=np.uint64)
+    for row, shingles in enumerate(shingle_sets):
+        signatures[row] = ((shingles[:, None] * coefficients + offsets) >> np.uint64(32)).min(axis=0)
+    return signatures
+
+
+# n-gram集合の類似度計算関数
+def compute_shingle_similarity(shingles_a, shingles_b):
+    """2つのn-gram集合のJaccard係数を返す"""
+    common = len(np.intersect1d(shingles_a, shingles_b, assume_unique=True))
+    return common / (len(shingles_a) + len(shingles_b) - common)
+
+
+# 類似回答検出関数
+def find_near_duplicate_answers(answers, threshold=0.8, num_perm=64, bands=16, max_representatives=8):
+    """回答（行番号→回答文）のうち互いによく似たもの（n-gramのJaccard係数がしきい値以上）をまとめ、クラスタ（行番号の一覧）を大きい順に返す
+
+    最小ハッシュ署名を帯に分けたLSHで候補を絞り、帯ごとのバケットでは、そのバケットにすでにあるクラスタの代表とだけ比較する。
+    しきい値未満で似た回答（定型文で書き出しがそろった回答など）が同じバケットに多数入ると、比較回数がバケットの
+    大きさの2乗で増えるため、バケットごとの代表は max_representatives 件までとする。代表が埋まったバケットでは
+    後から来た回答を代表に加えないので、似た回答の組が一致するすべての帯でバケットが埋まっている場合に限り、その組を
+    見落とす（しきい値以上の組は16帯のうち平均6帯以上で一致する）。上限を上げるほど見落としは減り、混み合った
+    バケットでの比較回数は上限に比例して増える。None を指定すると上限なしで比較する。
+    """
+    labels, shingle_sets = [], []
+    for row_idx, text in answers.items():
+        if not isinstance(text, str) or not text.strip():
+            continue
+        labels.append(row_idx)
+        shingle_sets.append(build_answer_shingles(text))
+    if len(labels) < 2:
+        return []
+
+    signatures = compute_minhash_signatures(shingle_sets, num_perm)
+    band_width = num_perm // bands
+    parent = list(range(len(labels)))
+
+    def find_root(item):
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    for band in range(bands):
+        buckets = {}
+        band_signatures = signatures[:, band * band_width:(band + 1) * band_width]
+        for item in range(len(labels)):
+            representatives = buckets.setdefault(band_signatures[item].tobytes(), [])
+            for representative in representatives:
+                if find_root(representative) == find_root(item):
+                    break
+                if compute_shingle_similarity(shingle_sets[representative], shingle_sets[item]) >= threshold:
+                    parent[find_root(item)] = find_root(representative)
+                    break
+            else:
+                if max_representatives is None or len(representatives) < max_representatives:
+                    representatives.append(item)
+
+    clusters = {}
+    for item, row_idx in enumerate(labels):
+        clusters.setdefault(find_root(item), []).append(row_idx)
+    return sorted((rows for rows in clusters.values() if len(rows) > 1), key=len, reverse=True)
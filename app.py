@@ -1,15 +1,43 @@
 import streamlit as st
 import os
 import pandas as pd
-import csv
+import numpy as np
 from datetime import datetime
 import pytz
 import itertools
 import toml
 import json
+import re
+import sys
 import hashlib
 import hmac
 import time
+import random
+import collections
+import asyncio
+import threading
+import sqlite3
+import glob
+import io
+import contextlib
+import cProfile
+import pstats
+import marshal
+from answer_similarity import find_near_duplicate_answers
+from combination_sampling import build_covering_array, build_stratified_sample, measure_combination_coverage
+from fortune_generation import (
+    ScheduledClient, build_fortune_prompt, build_result_row, check_length, generate_combination, generate_content,
+    get_combination_keyword_triples, get_keyword_columns, get_token_usage, is_error_answer, is_truncated_response,
+    profile_stage, vertex_model_options
+)
+from fortune_store import build_fortune_store, build_store_entries
+from keyword_index import (
+    build_keyword_index, build_prompt_keywords, compact_keyword_table, default_category_aliases, get_keyword_category_name,
+    get_keyword_names, get_keyword_options, load_condensed_texts, match_keyword_category, match_keyword_name,
+    normalize_keyword_text, open_condense_cache
+)
+from request_scheduler import QuotaExceededError, RequestScheduler, build_scheduler_settings
+from token_ledger import append_token_usage, open_token_ledger
 
 # Google GenAI SDKのインポート
 try:
@@ -29,11 +57,13 @@ except ImportError:
 try:
     from google.auth import default
     from google.auth.transport.requests import Request
-    from google.oauth2 import service_account
     VERTEX_AI_AVAILABLE = True
 except ImportError:
     VERTEX_AI_AVAILABLE = False
 
+# 再実行の所要時間の計測開始（プロファイルモード用）
+script_started_at = time.perf_counter()
+
 # ページ設定
 st.set_page_config(
     page_title="汎用占い生成アプリ",
@@ -185,12 +215,98 @@ if not vertex_ai_project_id and config and "api" in config:
     vertex_ai_project_id = api_config.get("vertex_project", "")
     vertex_ai_location = api_config.get("vertex_location", "us-central1")
 
-# Vertex AI モデルオプション
-vertex_model_options = [
-    "gemini-2.0-flash",
-    "gemini-2.5-flash",
-    "gemini-2.5-pro"
-]
+# エンドポイントの一覧（[[api.endpoints]] で複数のプロジェクト・リージョン・認証情報に振り分ける。未設定なら上記の1件）
+# credentials には認証情報を置いたSecretsのセクション名を指定する（省略時は gcp_service_account）
+endpoint_settings = []
+endpoint_sources = []
+if hasattr(st, 'secrets'):
+    try:
+        if "api" in st.secrets and "endpoints" in st.secrets["api"]:
+            endpoint_sources = [dict(endpoint) for endpoint in st.secrets["api"]["endpoints"]]
+    except:
+        pass
+if not endpoint_sources and config and "api" in config:
+    endpoint_sources = config["api"].get("endpoints", [])
+for endpoint in endpoint_sources:
+    project = endpoint.get("project", vertex_ai_project_id)
+    location = endpoint.get("location", vertex_ai_location)
+    endpoint_settings.append({
+        "name": endpoint.get("name", f"{project}/{location}"),
+        "project": project,
+        "location": location,
+        "credentials": endpoint.get("credentials"),
+        "weight": max(1, int(endpoint.get("weight", 1)))
+    })
+if not endpoint_settings:
+    endpoint_settings = [{"name": f"{vertex_ai_project_id}/{vertex_ai_location}", "project": vertex_ai_project_id, "location": vertex_ai_location, "credentials": None, "weight": 1}]
+
+# エンドポイントのサーキットブレーカー設定（config.tomlの[endpoint_pool]で変更可能）
+endpoint_pool_settings = {
+    "failure_threshold": 3,        # 連続して429・5xxを返したら遮断するまでの回数
+    "cooldown_seconds": 30,        # 遮断してから試しに1件送るまでの秒数（続けて失敗すると倍にする）
+    "max_cooldown_seconds": 300    # 遮断時間の上限（秒）
+}
+if config and "endpoint_pool" in config:
+    endpoint_pool_settings.update(config["endpoint_pool"])
+
+# 出力CSVの固定列（これ以外はキーワード列）
+result_base_columns = ["id", "質問", "回答", "サマリ", "元キーワード", "アレンジキーワード", "生成モデル"]
+
+# 「すべて」の展開方法（全組み合わせ、または網羅性を保った抽出）
+expansion_modes = ["すべての組み合わせ", "ペアワイズ（2つ組を網羅）", "3つ組を網羅", "層化ランダムサンプル"]
+
+# 入れ替えても同じ内容とみなすカテゴリ（[symmetry] categories = ["サイン", ...] で初期値を設定）
+default_symmetric_categories = list(config["symmetry"].get("categories", [])) if config and "symmetry" in config else []
+
+# カテゴリ名の別名（CSVファイル入力でのカテゴリ名の表記ゆれを吸収する）
+category_aliases = dict(default_category_aliases)
+
+# 設定ファイルの別名を追加（[keyword_aliases] 別名 = "カテゴリ名"）
+if config and "keyword_aliases" in config:
+    category_aliases.update(config["keyword_aliases"])
+
+# モデル別の料金（[pricing."モデル名"] input / output = 100万トークンあたりの料金、ベンチマークの推定コストに使用）
+model_pricing = dict(config["pricing"]) if config and "pricing" in config else {}
+
+# 共有スケジューラの設定（全セッションのモデル呼び出しを調整する、[scheduler]で変更可能）
+scheduler_settings = build_scheduler_settings(config)
+
+# リクエストの期限とヘッジの設定（config.tomlの[requests]で変更可能）
+request_settings = {
+    "timeout_seconds": 0,          # 1リクエストの期限（秒、0で無制限）
+    "hedge": False,                # 遅いリクエストに同じリクエストを追加で送るか
+    "hedge_percentile": 95,        # 追加で送るまでの待ち時間（モデルごとの所要時間のパーセンタイル）
+    "hedge_min_samples": 20        # 待ち時間を決めるのに必要な所要時間の記録数（それまでは追加で送らない）
+}
+if config and "requests" in config:
+    request_settings.update(config["requests"])
+
+# トークン使用量台帳（SQLite、[ledger] path で保存先を変更可能）
+ledger_path = os.path.join(os.path.dirname(__file__), "token_ledger.sqlite3")
+if config and "ledger" in config and "path" in config["ledger"]:
+    ledger_path = config["ledger"]["path"]
+
+# キーワード文の要約キャッシュ（SQLite、[condense] path で保存先を変更可能）
+condense_cache_path = os.path.join(os.path.dirname(__file__), "keyword_condense_cache.sqlite3")
+if config and "condense" in config and "path" in config["condense"]:
+    condense_cache_path = config["condense"]["path"]
+
+# サーバー側のキーワードCSV（[keywords] directory・pattern で変更可能、既定はapp.pyと同じ場所の「〜キーワード.csv」）
+keyword_directory = os.path.dirname(os.path.abspath(__file__))
+keyword_file_pattern = "*キーワード.csv"
+if config and "keywords" in config:
+    keyword_directory = config["keywords"].get("directory", keyword_directory)
+    keyword_file_pattern = config["keywords"].get("pattern", keyword_file_pattern)
+
+# 生成結果アーカイブ（SQLite、[archive] path で保存先を変更可能）
+archive_path = os.path.join(os.path.dirname(__file__), "fortune_archive.sqlite3")
+if config and "archive" in config and "path" in config["archive"]:
+    archive_path = config["archive"]["path"]
+
+# 配信用ストア（[serving] path で公開先を変更可能、配信側は fortune_store.ServingStore で参照する）
+serving_store_path = os.path.join(os.path.dirname(__file__), "fortune_store.bin")
+if config and "serving" in config and "path" in config["serving"]:
+    serving_store_path = config["serving"]["path"]
 
 # システムプロンプト設定
 default_system_prompt = ""
@@ -260,18 +376,1600 @@ def setup_vertex_ai(model_name, project_id=None, location=None, service_account=
         return None, None
 
 
+# Vertex AIクライアント取得関数
+def create_vertex_client(model_name):
+    """Secretsのサービスアカウント情報を使ってVertex AIクライアントを作成する（エンドポイントが複数ある場合は振り分け用のクライアント）"""
+    if len(endpoint_settings) == 1:
+        return create_endpoint_client(model_name, endpoint_settings[0])
+    
+    clients = {endpoint["name"]: create_endpoint_client(model_name, endpoint) for endpoint in endpoint_settings}
+    clients = {name: client for name, client in clients.items() if client}
+    if not clients:
+        return None
+    return EndpointPoolClient(clients, get_shared_endpoint_health())
+
+# エンドポイント別クライアント作成関数
+def create_endpoint_client(model_name, endpoint):
+    """エンドポイントのプロジェクト・リージョン・認証情報でVertex AIクライアントを作成する"""
+    service_account = None
+    credentials_section = endpoint["credentials"] or "gcp_service_account"
+    if hasattr(st, 'secrets') and credentials_section in st.secrets:
+        service_account = dict(st.secrets[credentials_section])
+    
+    client, _ = setup_vertex_ai(
+        model_name,
+        endpoint["project"],
+        endpoint["location"],
+        service_account
+    )
+    return client
+
+# キーワードテーブルの共有保管場所
+@st.cache_resource
+def get_shared_keyword_tables():
+    """同じ内容のキーワードCSVをセッション間で共有するための保管場所（ファイルハッシュ → テーブル、読み書きは lock を取って行う）"""
+    return {"lock": threading.Lock(), "tables": {}}
+
+# キーワードテーブル取得関数
+def load_keyword_table(file, file_hash):
+    """アップロードされたキーワードCSVをコンパクト形式で読み込む（同じ内容のファイルは全セッションで共有）"""
+    shared = get_shared_keyword_tables()
+    with shared["lock"]:
+        keyword_table = shared["tables"].get(file_hash)
+    if keyword_table is None:
+        # 解析はロックの外で行い、登録時に他のセッションが先に登録していればそちらを使う
+        df = pd.read_csv(file, encoding='utf-8', dtype=str)
+        parsed_table = compact_keyword_table(df, file_hash, len(file.getvalue()))
+        with shared["lock"]:
+            shared_tables = shared["tables"]
+            keyword_table = shared_tables.get(file_hash)
+            if keyword_table is None:
+                # 古いものから破棄して保管数を制限する
+                while len(shared_tables) >= 64:
+                    shared_tables.pop(next(iter(shared_tables)))
+                keyword_table = shared_tables[file_hash] = parsed_table
+    return keyword_table
+
+# サーバー側キーワードCSVの共有状態
+@st.cache_resource
+def get_keyword_directory_state():
+    """サーバー側のキーワードCSVの読み込み状態（ファイルごとの更新日時・ハッシュ・テーブルと版番号、全セッション共有）"""
+    return {"lock": threading.Lock(), "files": {}, "errors": {}, "version": 0, "checked_at": 0.0}
+
+# サーバー側キーワードCSVの再読み込み関数
+def refresh_keyword_directory(directory=None, pattern=None, min_interval=2.0):
+    """サーバー側のキーワードCSVを確認し、更新日時かサイズが変わったファイルだけ読み直す（内容が同じなら版は変えない）
+
+    戻り値: {"version": 版番号, "tables": カテゴリ名 → テーブル, "errors": ファイル名 → 読み込めなかった理由}
+    """
+    state = get_keyword_directory_state()
+    with state["lock"]:
+        now = time.time()
+        if now - state["checked_at"] >= min_interval:
+            state["checked_at"] = now
+            paths = sorted(glob.glob(os.path.join(directory or keyword_directory, pattern or keyword_file_pattern)))
+            changed = False
+            for removed_path in set(state["files"]) - set(paths):
+                del state["files"][removed_path]
+                changed = True
+            for path in paths:
+                try:
+                    file_stat = os.stat(path)
+                    entry = state["files"].get(path)
+                    if entry and (entry["mtime"], entry["size"]) == (file_stat.st_mtime_ns, file_stat.st_size):
+                        continue
+                    with open(path, 'rb') as f:
+                        content = f.read()
+                    file_hash = hashlib.md5(content).hexdigest()
+                    if not entry or entry["hash"] != file_hash:
+                        entry = {"hash": file_hash, "table": load_keyword_table(io.BytesIO(content), file_hash), "loaded_at": get_japan_time()}
+                        state["files"][path] = entry
+                        changed = True
+                    # 更新日時だけが変わった場合（内容は同じ）は読み直さない
+                    entry.update(mtime=file_stat.st_mtime_ns, size=file_stat.st_size)
+                    state["errors"].pop(path, None)
+                except Exception as e:
+                    # 読み込めないファイルは前回の内容を使い続ける
+                    state["errors"][path] = str(e)
+            state["errors"] = {path: error for path, error in state["errors"].items() if path in paths}
+            if changed:
+                state["version"] += 1
+        return {
+            "version": state["version"],
+            "tables": {get_keyword_category_name(path): entry["table"] for path, entry in state["files"].items()},
+            "files": {os.path.basename(path): entry["loaded_at"] for path, entry in state["files"].items()},
+            "errors": {os.path.basename(path): error for path, error in state["errors"].items()}
+        }
+
+# サーバー側キーワードの反映関数
+def apply_server_keywords(session_state, server_keywords):
+    """サーバー側のキーワードCSVをセッションのキーワードに反映する（アップロードしたカテゴリは置き換えない）"""
+    custom_keywords = session_state["custom_keywords"]
+    previous_categories = set(session_state.get("server_keyword_categories", []))
+    for category_name in previous_categories - set(server_keywords["tables"]):
+        custom_keywords.pop(category_name, None)
+    for category_name, keyword_table in server_keywords["tables"].items():
+        if category_name not in custom_keywords or category_name in previous_categories:
+            custom_keywords[category_name] = keyword_table
+    session_state["server_keyword_categories"] = [
+        category_name for category_name in server_keywords["tables"]
+        if custom_keywords.get(category_name) is server_keywords["tables"][category_name]
+    ]
+    session_state["server_keyword_version"] = server_keywords["version"]
+
+# キーワード表示用データフレーム作成関数
+def keyword_table_to_dataframe(keyword_table):
+    """コンパクト形式のキーワードテーブルから表示用のデータフレームを作成する"""
+    return pd.DataFrame({col: keyword_table["values"][col] for col in keyword_table["columns"]})
+
+# メモリ使用量見積もり関数
+def estimate_object_size(obj, seen=None):
+    """オブジェクトが参照する内容も含めたおおよそのメモリ使用量（バイト）を返す（共有されたオブジェクトは1回だけ数える）"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(obj, pd.DataFrame) else int(usage)
+    
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_object_size(k, seen) + estimate_object_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_object_size(item, seen) for item in obj)
+    return size
+
+# セッションのメモリ使用量レポート作成関数
+def build_session_memory_report(session_state):
+    """セッション状態のキーごとのおおよそのメモリ使用量を集計する"""
+    seen = set()
+    report = []
+    for key in list(session_state.keys()):
+        report.append({"キー": str(key), "サイズ(KB)": round(estimate_object_size(session_state[key], seen) / 1024, 1)})
+    return pd.DataFrame(report).sort_values("サイズ(KB)", ascending=False, ignore_index=True)
+
+# 要約対象のキーワード文収集関数
+def collect_long_keyword_texts(keywords, keyword_columns, char_limit):
+    """選択した列のうち、文字数上限を超えるキーワード文を重複なしで集める"""
+    texts = set()
+    for category_name, keyword_table in keywords.items():
+        columns = (keyword_columns or {}).get(category_name, keyword_table["columns"][1:])
+        for col in columns:
+            for text in keyword_table["values"].get(col, ()):
+                if len(text) > char_limit:
+                    texts.add(text)
+    return texts
+
+# キーワード文要約関数
+def condense_keyword_texts(client, model_name, texts, char_limit, progress_callback=None, path=None):
+    """キャッシュにない長いキーワード文をモデルで要約してキャッシュに保存する（トークン数を返す）"""
+    path = path or condense_cache_path
+    cached = load_condensed_texts(texts, char_limit, path)
+    pending = sorted(text for text in texts if text not in cached)
+    usage = [0, 0, 0, 0]
+    connection = open_condense_cache(path)
+    try:
+        for done, text in enumerate(pending, 1):
+            prompt = (
+                f"次の占いキーワードの説明文を、意味と重要な語句を保ったまま{char_limit}文字以内に要約してください。"
+                f"要約した文のみを出力してください。\n\n{text}"
+            )
+            response = generate_content(client, model_name, prompt, 0)
+            for usage_idx, count in enumerate(get_token_usage(response)):
+                usage[usage_idx] += count
+            condensed = (response.text or "").strip()
+            if condensed and len(condensed) < len(text):
+                with connection:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO condensed_texts VALUES (?, ?, ?, ?)",
+                        (hashlib.sha256(text.encode('utf-8')).hexdigest(), char_limit, condensed, get_japan_time())
+                    )
+            if progress_callback:
+                progress_callback(done, len(pending))
+    finally:
+        connection.close()
+    return usage
+
+# キーワードセットの識別子取得関数
+def get_keyword_signature(keywords):
+    """キーワードセットが変わったかどうかを判定するための識別子を返す"""
+    return tuple((category_name, keyword_info.get("hash"), len(keyword_info["index"])) for category_name, keyword_info in keywords.items())
+
+# セッション内の計算結果キャッシュ関数
+def memoize_in_session(name, key, compute, memo=None):
+    """name ごとに最後の計算結果をセッション状態（memo を指定した場合はその辞書）に保持し、key が同じ間は再計算しない"""
+    if memo is None:
+        memo = st.session_state.setdefault("memoized_values", {})
+    cached = memo.get(name)
+    if cached is None or cached[0] != key:
+        cached = (key, compute())
+        memo[name] = cached
+    return cached[1]
+
+# セッション内の計算結果キャッシュ破棄関数
+def clear_session_memo(*names):
+    """指定した名前の計算結果キャッシュを破棄する（元のデータを書き換えた後に呼ぶ）"""
+    memo = st.session_state.get("memoized_values", {})
+    for name in names:
+        memo.pop(name, None)
+
+# キーワードインデックス取得関数
+def get_keyword_index(keywords):
+    """読み込み済みのキーワードセットに対応するインデックスを返す（キーワードセットが変わった時のみ再作成）"""
+    signature = get_keyword_signature(keywords)
+    cached = st.session_state.get("keyword_index")
+    if cached is None or cached["signature"] != signature:
+        cached = {"signature": signature, "index": build_keyword_index(keywords, category_aliases)}
+        st.session_state.keyword_index = cached
+    return cached["index"]
+
+# 質問CSVのデータフレーム解析関数
+def parse_question_frame(df_questions, row_offset=0, with_keywords=True):
+    """質問CSVのデータフレームから、ID・質問・キーワード指定を列単位でまとめて取り出す"""
+    column_count = len(df_questions.columns)
+    id_column = df_questions.iloc[:, 0]  # A列（ID）
+    questions_column = df_questions.iloc[:, 1]  # B列（質問）
+    
+    # 質問が空の行は除外
+    valid_mask = questions_column.notna() & questions_column.astype(str).str.strip().ne("")
+    
+    # IDがない場合は行番号を使用
+    row_numbers = pd.Series(range(row_offset + 1, row_offset + 1 + len(df_questions)), index=df_questions.index)
+    ids = id_column.astype(str).where(id_column.notna(), "row_" + row_numbers.astype(str))
+    
+    questions = questions_column[valid_mask].astype(str).tolist()
+    id_values = ids[valid_mask].tolist()
+    
+    if not with_keywords:
+        return id_values, questions, None
+    
+    # C列以降のキーワード情報を読み取り（最大4カテゴリ）
+    triplet_columns = []
+    for i in range(4):
+        cat_col = 2 + i * 3  # C列, F列, I列, L列（カテゴリ）
+        key_col = 3 + i * 3  # D列, G列, J列, M列（キーワード）
+        who_col = 4 + i * 3  # E列, H列, K列, N列（対象）
+        if key_col >= column_count:
+            break
+        
+        categories = df_questions.iloc[:, cat_col]
+        keyword_values = df_questions.iloc[:, key_col]
+        # 対象列がある場合は読み取り、なければデフォルトで「あなた」（無効な値もデフォルト）
+        if who_col < column_count:
+            whos = df_questions.iloc[:, who_col].fillna("あなた").astype(str).str.strip()
+            whos = whos.where(whos.isin(["あなた", "あの人", "相性"]), "あなた")
+        else:
+            whos = pd.Series("あなた", index=df_questions.index)
+        
+        has_keyword = (categories.notna() & keyword_values.notna())[valid_mask]
+        triples = zip(
+            categories[valid_mask].astype(str).str.strip(),
+            keyword_values[valid_mask].astype(str).str.strip(),
+            whos[valid_mask]
+        )
+        triplet_columns.append([triple if ok else None for triple, ok in zip(triples, has_keyword)])
+    
+    if triplet_columns:
+        keywords_list = [[triple for triple in row if triple is not None] for row in zip(*triplet_columns)]
+    else:
+        keywords_list = [[] for _ in questions]
+    return id_values, questions, keywords_list
+
+# 質問CSV読み込み関数
+def read_question_csv(uploaded_file, with_keywords=True, on_first_chunk=None, chunksize=5000):
+    """質問CSVをチャンク単位で読み込む（2列未満の場合はNone）
+
+    on_first_chunk: 最初のチャンクの解析結果（ID, 質問, キーワード指定）を受け取る関数（プレビュー表示用）
+    """
+    id_list = []
+    questions_list = []
+    csv_keywords_list = [] if with_keywords else None
+    row_offset = 0
+    
+    # 全列を文字列として読み込む（チャンクごとに型推論が変わってIDの表記がぶれないようにする）
+    reader = pd.read_csv(uploaded_file, encoding='utf-8', dtype=str, chunksize=chunksize)
+    for chunk_idx, chunk in enumerate(reader):
+        if len(chunk.columns) < 2:
+            return None
+        
+        chunk_ids, chunk_questions, chunk_keywords = parse_question_frame(chunk, row_offset, with_keywords)
+        id_list.extend(chunk_ids)
+        questions_list.extend(chunk_questions)
+        if with_keywords:
+            csv_keywords_list.extend(chunk_keywords)
+        row_offset += len(chunk)
+        
+        if chunk_idx == 0 and on_first_chunk:
+            on_first_chunk(chunk_ids, chunk_questions, chunk_keywords)
+    
+    return id_list, questions_list, csv_keywords_list
+
+# 質問プレビュー表示関数
+def show_question_preview(preview_slot, id_list, questions_list, csv_keywords_list=None, total_count=None):
+    """質問の先頭5件をプレビュー表示する（total_countが未確定の間は読み込み中と表示）"""
+    with preview_slot.container():
+        with st.expander("質問プレビュー", expanded=False):
+            for i, (q_id, q) in enumerate(zip(id_list[:5], questions_list[:5]), 1):  # 最初の5個のみ表示
+                preview_text = f"{i}. ID: {q_id} - {q}"
+                kws = csv_keywords_list[i - 1] if csv_keywords_list else None
+                if kws:
+                    kw_text = ", ".join([f"{who}の{cat}:{kw}" for cat, kw, who in kws])
+                    preview_text += f" [キーワード: {kw_text}]"
+                st.text(preview_text)
+            if total_count is None:
+                st.text("... 残りを読み込み中")
+            elif total_count > 5:
+                st.text(f"... 他 {total_count - 5} 個")
+
+# 質問CSV取得関数（同じファイルは再解析しない）
+def load_question_csv(uploaded_file, with_keywords, preview_slot):
+    """アップロードされた質問CSVを解析し、結果をセッション状態にキャッシュする"""
+    # アップロードごとに振られるIDで判定する（ファイル全体のハッシュ計算を再実行のたびに行わない）
+    cache_key = (getattr(uploaded_file, "file_id", None) or hashlib.md5(uploaded_file.getvalue()).hexdigest(), with_keywords)
+    cached = st.session_state.get("question_csv_cache")
+    if cached and cached["key"] == cache_key:
+        return cached["parsed"]
+    
+    # 最初のチャンクを解析した時点でプレビューを表示し、残りを続けて読み込む
+    with st.spinner("質問CSVを読み込み中..."):
+        parsed = read_question_csv(
+            uploaded_file,
+            with_keywords=with_keywords,
+            on_first_chunk=lambda ids, questions, kws: show_question_preview(preview_slot, ids, questions, kws)
+        )
+    st.session_state.question_csv_cache = {"key": cache_key, "parsed": parsed}
+    return parsed
+
+# プリセット用キーワード設定取得関数
+def get_preset_keyword_settings(session_state):
+    """プロンプトに含めるキーワード列（すべての列を使うカテゴリは除く）と要約の文字数上限をプリセット用に取得する"""
+    keyword_columns = {}
+    for category_name, keyword_table in session_state.get("custom_keywords", {}).items():
+        columns = session_state.get(f"prompt_columns_{category_name}")
+        if columns is not None and list(columns) != keyword_table["columns"][1:]:
+            keyword_columns[category_name] = list(columns)
+    return {"keyword_columns": keyword_columns, "condense_limit": int(session_state.get("condense_limit", 0))}
+
+# プリセットのキーワード設定適用関数
+def apply_preset_keyword_settings(session_state, preset_info):
+    """プリセットのキーワード列と要約の文字数上限を画面の設定に反映する（読み込まれていない列は無視）"""
+    preset_columns = preset_info.get("keyword_columns", {})
+    for category_name, keyword_table in session_state.get("custom_keywords", {}).items():
+        available_columns = keyword_table["columns"][1:]
+        if category_name in preset_columns:
+            session_state[f"prompt_columns_{category_name}"] = [col for col in preset_columns[category_name] if col in available_columns]
+        else:
+            session_state[f"prompt_columns_{category_name}"] = list(available_columns)
+    session_state["condense_limit"] = int(preset_info.get("condense_limit", 0))
+
+# 組み合わせ展開関数
+def expand_keyword_combinations(value_lists, expansion=None):
+    """カテゴリごとの値リストを、指定した展開方法（全組み合わせ・網羅配列・層化サンプル）で組み合わせる"""
+    expansion = expansion or {}
+    mode = expansion.get("mode", expansion_modes[0])
+    if mode == "ペアワイズ（2つ組を網羅）":
+        return build_covering_array(value_lists, 2)
+    if mode == "3つ組を網羅":
+        return build_covering_array(value_lists, 3)
+    if mode == "層化ランダムサンプル":
+        return build_stratified_sample(value_lists, expansion.get("sample_size", 100), expansion.get("seed", 0))
+    return list(itertools.product(*value_lists))
+
+# キーワード値リスト作成関数
+def get_keyword_value_lists(selected_categories, selected_values, keyword_index):
+    """画面で選択したキーワードから、カテゴリごとの値リストを作成する（「すべて」は全キーワード）"""
+    value_lists = []
+    for category_type, selected_value in zip(selected_categories, selected_values):
+        if selected_value == "すべて" and category_type in keyword_index["categories"]:
+            # カスタムキーワードモード
+            value_lists.append(get_keyword_names(keyword_index, category_type))
+        else:
+            value_lists.append([selected_value])
+    return value_lists
+
+# キーワード組み合わせ生成関数
+def build_keyword_combinations(selected_categories, selected_values, selected_who, keyword_index, expansion=None):
+    """画面で選択したキーワードから、キーワードの組み合わせと誰の情報の組み合わせを作成する"""
+    keyword_combinations = []
+    who_combinations = []  # 誰の情報の組み合わせ
+    
+    # キーワードの組み合わせ生成（動的に対応）
+    value_lists = get_keyword_value_lists(selected_categories, selected_values, keyword_index)
+    if value_lists:
+        keyword_combinations = expand_keyword_combinations(value_lists, expansion)
+        # 誰の情報は「すべて」の場合でも固定
+        who_combinations = [list(selected_who) for _ in keyword_combinations]
+    
+    return keyword_combinations, who_combinations
+
+# 生成対象の組み合わせ作成関数
+def build_total_combinations(input_mode, questions_list, id_list, csv_keywords_list, keyword_combinations, who_combinations, selected_who, keyword_index, expansion=None):
+    """質問×キーワードの全組み合わせを作成する（CSVのキーワード指定に誤りがあればエラー内容も返す）"""
+    total_combinations = []
+    validation_errors = []
+    
+    # CSV入力でキーワード指定がある場合の処理
+    if input_mode == "CSVファイル入力" and csv_keywords_list and any(len(kw) > 0 for kw in csv_keywords_list):
+        # CSVのキーワード指定を優先
+        for i, question in enumerate(questions_list):
+            question_id = id_list[i] if i < len(id_list) else f"auto_{i+1}"
+            csv_keywords = csv_keywords_list[i] if i < len(csv_keywords_list) else []
+            
+            if csv_keywords:  # CSVにキーワード指定がある場合
+                # CSVのキーワードを検証して組み合わせを作成
+                validated_keywords = []
+                error_keywords = []
+                
+                for cat_name, kw_name, who_name in csv_keywords:
+                    # カテゴリ名の検証と正規化（別名・全角半角の違いを吸収）
+                    valid_category = match_keyword_category(keyword_index, cat_name)
+                    
+                    # キーワードの検証（全角数字・記号も半角と同一視）
+                    valid_keyword = match_keyword_name(keyword_index, valid_category, kw_name) if valid_category else None
+                    
+                    # 対象（誰の）の検証
+                    valid_who = who_name if who_name in ["あなた", "あの人", "相性"] else "あなた"
+                    
+                    if valid_category and valid_keyword:
+                        validated_keywords.append((valid_category, valid_keyword, valid_who))
+                    else:
+                        error_keywords.append(f"{cat_name}:{kw_name}")
+                
+                if error_keywords:
+                    validation_errors.append(f"ID: {question_id} - 無効なキーワード指定: {', '.join(error_keywords)}")
+                
+                if validated_keywords:
+                    # 「すべて」はカテゴリの全キーワードに展開し、指定の展開方法で組み合わせる
+                    expanded_keywords_list = []
+                    for cat, kw, who in validated_keywords:
+                        if kw == "すべて" and cat in keyword_index["categories"]:
+                            expanded_keywords_list.append([(cat, name, who) for name in get_keyword_names(keyword_index, cat)])
+                        else:
+                            expanded_keywords_list.append([(cat, kw, who)])
+                    
+                    for combo in expand_keyword_combinations(expanded_keywords_list, expansion):
+                        # comboは各カテゴリから1つずつ選ばれたタプルのリスト
+                        flattened_combo = list(combo)
+                        keyword_values = [kw for _, kw, _ in flattened_combo]
+                        who_values = [who for _, _, who in flattened_combo]
+                        total_combinations.append((question_id, question, tuple(keyword_values), tuple(who_values), flattened_combo))
+                else:
+                    # 有効なキーワードがない場合もエラーとする
+                    validation_errors.append(f"ID: {question_id} - キーワードが検証できませんでした")
+            else:
+                # CSVにキーワード指定がない場合は画面設定を使用
+                for j, keyword_combo in enumerate(keyword_combinations):
+                    who_combo = who_combinations[j] if j < len(who_combinations) else selected_who
+                    total_combinations.append((question_id, question, keyword_combo, tuple(who_combo), None))
+    elif input_mode == "CSV連続モード" and len(questions_list) > 0:
+        # CSV連続モード：各キーワードの組み合わせごとに、全質問をまとめて処理
+        for j, keyword_combo in enumerate(keyword_combinations):
+            who_combo = who_combinations[j] if j < len(who_combinations) else selected_who
+            # 質問リスト全体を1つの組み合わせとして追加
+            total_combinations.append(("batch", questions_list, keyword_combo, tuple(who_combo), None))
+    else:
+        # 通常モード：各質問×各キーワード組み合わせ
+        for i, question in enumerate(questions_list):
+            question_id = id_list[i] if i < len(id_list) else f"auto_{i+1}"
+            for j, keyword_combo in enumerate(keyword_combinations):
+                who_combo = who_combinations[j] if j < len(who_combinations) else selected_who
+                total_combinations.append((question_id, question, keyword_combo, tuple(who_combo), None))
+    
+    return total_combinations, validation_errors
+
+# 対称な組み合わせの識別キー作成関数
+def get_symmetry_key(combo, settings, symmetric_categories):
+    """同じカテゴリのキーワードを入れ替えただけの組み合わせが同じキーになるよう、該当カテゴリの値を並べ替えたキーを作成する"""
+    keyword_triples = get_combination_keyword_triples(combo, settings)
+    values = [value for _, value, _ in keyword_triples]
+    for category in symmetric_categories:
+        positions = [position for position, (category_type, _, _) in enumerate(keyword_triples) if category_type == category]
+        if len(positions) > 1:
+            for position, value in zip(positions, sorted(values[p] for p in positions)):
+                values[position] = value
+    question_id, current_question = combo[0], combo[1]
+    return json.dumps([
+        str(question_id),
+        "" if question_id == "batch" else current_question,
+        [category_type for category_type, _, _ in keyword_triples],
+        values
+    ], ensure_ascii=False)
+
+# 対称な組み合わせへの回答反映関数
+def mirror_outcome(outcome, combo, settings):
+    """生成済みの組み合わせの回答を、入れ替えただけの組み合わせの行（キーワード列は自身の値）として複製する"""
+    keyword_triples = get_combination_keyword_triples(combo, settings)
+    return {
+        "rows": [
+            build_result_row(
+                row["id"], row["質問"], keyword_triples,
+                row["回答"], row["サマリ"], row["元キーワード"], row["アレンジキーワード"], row["生成モデル"]
+            )
+            for row in outcome["rows"]
+        ],
+        "model": "",
+        "usage": [0, 0, 0, 0],
+        "escalation_reasons": [],
+        "followup_count": 0,
+        "recovered_count": 0,
+        "parsed_ok": outcome["parsed_ok"],
+        "request_count": 0
+    }
+
+# 結果行の識別キー作成関数
+def build_result_row_key(question_id, keyword_columns):
+    """出力CSVの行を識別するキー（IDとキーワード列の値）を作成する"""
+    return json.dumps([str(question_id), sorted([str(col), str(value)] for col, value in keyword_columns)], ensure_ascii=False)
+
+# 組み合わせの識別キー作成関数
+def get_combination_key(combo, settings):
+    """組み合わせを識別するキー（IDとキーワード）を作成する（CSV連続モードは質問リスト全体で1件）"""
+    question_id = combo[0]
+    return json.dumps([str(question_id), [list(triple) for triple in get_combination_keyword_triples(combo, settings)]], ensure_ascii=False)
+
+# 組み合わせの出力行キー取得関数
+def get_combination_row_keys(combo, settings):
+    """組み合わせから生成される出力CSVの行の識別キーを返す"""
+    question_id = combo[0]
+    keyword_columns = get_keyword_columns(get_combination_keyword_triples(combo, settings))
+    if question_id == "batch":
+        return [build_result_row_key(q_id, keyword_columns) for q_id in settings["id_list"]]
+    return [build_result_row_key(question_id, keyword_columns)]
+
+# 組み合わせの入力ハッシュ計算関数
+def compute_combination_hash(combo, settings, keyword_index):
+    """プロンプトの入力・モデル・生成設定から組み合わせの内容ハッシュを計算する"""
+    question_id, current_question = combo[0], combo[1]
+    all_keywords = build_prompt_keywords(keyword_index, get_combination_keyword_triples(combo, settings), settings)
+    payload = {
+        "prompt": "\n\n".join(build_fortune_prompt(settings, current_question, all_keywords, question_id == "batch")),
+        "model_chain": settings["model_chain"],
+        "cascade_enabled": settings["cascade_enabled"],
+        "thinking_budget": settings["thinking_budget"],
+        "answer_length": settings["answer_length"],
+        "summary_length": settings["summary_length"],
+        "length_tolerance": settings["length_tolerance"]
+    }
+    # モデルごとのThinking Budgetはカスケードモードで設定した場合のみ含める（それ以外の実行のハッシュは変えない）
+    if settings.get("thinking_budgets"):
+        payload["thinking_budgets"] = settings["thinking_budgets"]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+# 差分実行用マニフェスト作成関数
+def build_run_manifest(combination_hashes, settings):
+    """組み合わせごとの入力ハッシュを記録したマニフェストを作成する"""
+    return {
+        "version": 1,
+        "created": get_japan_time(),
+        "models": settings["model_chain"],
+        "thinking_budget": settings["thinking_budget"],
+        "entries": combination_hashes
+    }
+
+# 前回結果の索引作成関数
+def index_previous_results(df_previous):
+    """前回の出力CSV（全列を文字列で読み込んだもの）の行を識別キーで引けるようにする"""
+    keyword_column_names = [col for col in df_previous.columns if col not in result_base_columns]
+    previous_rows = {}
+    for row in df_previous.to_dict('records'):
+        # 空のキーワード列はその行では使われていない
+        keyword_columns = [(col, row[col]) for col in keyword_column_names if row[col] != ""]
+        row_dict = {"id": row.get("id", ""), "質問": row.get("質問", "")}
+        row_dict.update(keyword_columns)
+        for col in result_base_columns[2:]:
+            row_dict[col] = row.get(col, "")
+        previous_rows.setdefault(build_result_row_key(row_dict["id"], keyword_columns), row_dict)
+    return previous_rows
+
+# 文字数適合チェック関数
+def build_length_report(df, answer_length, summary_length, tolerance):
+    """結果テーブルの回答・サマリ文字数を集計し、許容範囲外の行を判定する"""
+    lengths = pd.DataFrame({
+        "回答文字数": df["回答"].fillna("").astype(str).str.len(),
+        "サマリ文字数": df["サマリ"].fillna("").astype(str).str.len()
+    }, index=df.index)
+    answer_ok = (lengths["回答文字数"] - answer_length).abs() <= answer_length * tolerance / 100
+    summary_ok = (lengths["サマリ文字数"] - summary_length).abs() <= summary_length * tolerance / 100
+    return lengths, ~(answer_ok & summary_ok)
+
+# 類似回答レポート作成関数
+def build_duplicate_report(df, clusters, truncate_chars=60):
+    """類似回答のクラスタを、行ごとのキーワードと回答の先頭を並べた表にする（各クラスタの先頭行を残し、残りを再生成の対象とする）"""
+    keyword_columns = [col for col in df.columns if col not in result_base_columns]
+    records = []
+    for cluster_number, rows in enumerate(clusters, 1):
+        for position, row_idx in enumerate(rows):
+            records.append({
+                "クラスタ": cluster_number,
+                "行": row_idx,
+                "id": df.at[row_idx, "id"],
+                "キーワード": " / ".join(
+                    f"{col}: {df.at[row_idx, col]}" for col in keyword_columns
+                    if not pd.isna(df.at[row_idx, col]) and str(df.at[row_idx, col]) != ""
+                ),
+                "回答": truncate_text(df.at[row_idx, "回答"], truncate_chars),
+                "再生成": position > 0
+            })
+    return pd.DataFrame(records, columns=["クラスタ", "行", "id", "キーワード", "回答", "再生成"])
+
+# 結果の絞り込み関数
+def filter_result_rows(df, id_query="", keyword_query="", who_filter="すべて", status_filter="すべて", nonconforming_mask=None):
+    """結果テーブルをID・キーワード・対象・状態で絞り込む条件（行ごとの真偽値）を返す"""
+    mask = pd.Series(True, index=df.index)
+    keyword_columns = [col for col in df.columns if col not in result_base_columns]
+    
+    if id_query:
+        mask &= df["id"].astype(str).str.contains(id_query.strip(), regex=False)
+    
+    if keyword_query:
+        # 全角・半角の違いを区別せずに部分一致
+        normalized_query = normalize_keyword_text(keyword_query)
+        keyword_mask = pd.Series(False, index=df.index)
+        for col in keyword_columns:
+            keyword_mask |= df[col].fillna("").astype(str).map(normalize_keyword_text).str.contains(normalized_query, regex=False)
+        mask &= keyword_mask
+    
+    if who_filter != "すべて":
+        who_mask = pd.Series(False, index=df.index)
+        for col in keyword_columns:
+            if col.startswith(f"{who_filter}の"):
+                who_mask |= df[col].fillna("").astype(str) != ""
+        mask &= who_mask
+    
+    if status_filter == "エラーのみ":
+        mask &= df["回答"].map(is_error_answer)
+    elif status_filter == "正常のみ":
+        mask &= ~df["回答"].map(is_error_answer)
+    elif status_filter == "文字数範囲外" and nonconforming_mask is not None:
+        mask &= nonconforming_mask
+    return mask
+
+# 長文の省略関数
+def truncate_text(text, limit):
+    """指定文字数を超える文字列を省略記号付きで切り詰める"""
+    text = "" if pd.isna(text) else str(text)
+    return text if len(text) <= limit else text[:limit] + "…"
+
+# 結果ページ作成関数
+def build_result_page(df, mask, page, page_size, truncate_chars=80):
+    """絞り込んだ結果のうち指定ページの行だけを、長い回答・サマリを省略して返す"""
+    matched_index = df.index[mask]
+    page_index = matched_index[(page - 1) * page_size:page * page_size]
+    page_df = df.loc[page_index].copy()
+    for col in ["回答", "サマリ"]:
+        if col in page_df:
+            page_df[col] = page_df[col].map(lambda text: truncate_text(text, truncate_chars))
+    return page_df
+
+# 行の再生成関数
+def regenerate_rows(client, run, row_indices, keyword_index, progress_callback=None, avoid_answers=None):
+    """指定した行の組み合わせだけを再生成し、結果テーブルの同じ位置に反映する
+
+    入れ替えても同じ内容とみなす組み合わせ（run["symmetry_keys"] が同じもの）は1回だけ再生成し、同じ回答をそれぞれの行に反映する。
+    avoid_answers: 行番号 → 似た回答にしないための参考の回答（類似回答の再生成で使用）
+    トークン上限に達した場合はそこで止め、残りの行は元のまま run["regenerate_quota_error"] に理由を記録する
+    """
+    df = run["df"]
+    run.pop("regenerate_quota_error", None)
+    regenerated_count = 0
+    targeted_count = 0
+    symmetry_keys = run.get("symmetry_keys")
+    combo_rows = {}
+    for row_idx, combo_idx in enumerate(run["row_combo_indices"]):
+        combo_rows.setdefault(combo_idx, []).append(row_idx)
+    # 再生成する組み合わせを対称キーごとにまとめる（最初の組み合わせを生成し、同じキーの組み合わせに複製する）
+    group_combos = {}
+    for combo_idx in combo_rows:
+        group_combos.setdefault(symmetry_keys[combo_idx] if symmetry_keys else combo_idx, []).append(combo_idx)
+    group_targets = {}
+    for row_idx in row_indices:
+        combo_idx = run["row_combo_indices"][row_idx]
+        group_targets.setdefault(symmetry_keys[combo_idx] if symmetry_keys else combo_idx, []).append(row_idx)
+    
+    for done, (group_key, target_rows) in enumerate(group_targets.items(), 1):
+        combo_indices = group_combos[group_key]
+        combo_settings = run["settings"]
+        combo_avoid_answers = list(dict.fromkeys(avoid_answers[row_idx] for row_idx in target_rows if row_idx in (avoid_answers or {})))
+        if combo_avoid_answers:
+            combo_settings = dict(run["settings"], avoid_answers=combo_avoid_answers)
+        try:
+            outcome = generate_combination(client, run["combinations"][combo_indices[0]], combo_settings, keyword_index)
+        except QuotaExceededError as e:
+            run["regenerate_quota_error"] = f"{e}。再生成していない行が{len(row_indices) - targeted_count:,}行あります"
+            break
+        targeted_count += len(target_rows)
+        for usage_idx, count in enumerate(outcome["usage"]):
+            run["token_totals"][usage_idx] += count
+        run["request_count"] = run.get("request_count", 0) + outcome["request_count"]
+        
+        # CSV連続モードでは同じIDの行に反映し、対象外の行はそのまま残す（同じキーの組み合わせの行にも反映する）
+        target_ids = {str(df.at[row_idx, "id"]) for row_idx in target_rows}
+        for combo_idx in combo_indices:
+            combo_outcome = outcome
+            if combo_idx != combo_indices[0]:
+                combo_outcome = mirror_outcome(outcome, run["combinations"][combo_idx], run["settings"])
+            new_rows = {str(row["id"]): row for row in combo_outcome["rows"]}
+            for row_idx in combo_rows[combo_idx]:
+                if str(df.at[row_idx, "id"]) not in target_ids:
+                    continue
+                new_row = new_rows.get(str(df.at[row_idx, "id"]))
+                if new_row is None and len(combo_outcome["rows"]) == 1:
+                    new_row = combo_outcome["rows"][0]
+                if new_row is None:
+                    continue
+                for col in ["回答", "サマリ", "元キーワード", "アレンジキーワード", "生成モデル"]:
+                    df.at[row_idx, col] = new_row.get(col, "")
+                regenerated_count += 1
+        
+        if progress_callback:
+            progress_callback(done, len(group_targets))
+    
+    run["regenerated_count"] = run.get("regenerated_count", 0) + regenerated_count
+    # 結果から作成した表示用データ（文字数チェック・CSVなど）を作り直す
+    run.pop("memo", None)
+    return run
+
+# 組み合わせの表示テキスト作成関数
+def describe_combination(combo, thinking_budget):
+    """進行状況に表示する組み合わせの説明（質問・キーワード）を作成する"""
+    question_id, current_question, keyword_combination, who_combination, _ = combo
+    thinking_status = f" (思考機能: {thinking_budget}トークン)" if thinking_budget > 0 else ""
+    combo_text = " × ".join(f"{who}の{val}" for val, who in zip(keyword_combination, who_combination))
+    if question_id == "batch":
+        return f"連続処理: {len(current_question)}個の質問 | {combo_text}{thinking_status}"
+    question_preview = current_question[:30] + "..." if len(current_question) > 30 else current_question
+    return f"質問: {question_preview} | {combo_text}{thinking_status}"
+
+# 区間ごとの所要時間の計測クラス
+class StageProfiler:
+    """処理の区間ごとの回数・合計・最大の所要時間を集計する（管理者のプロファイルモード用）"""
+    
+    def __init__(self, started_at=None):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.checkpoint_at = started_at if started_at is not None else time.perf_counter()
+    
+    def record(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+    
+    def checkpoint(self, name):
+        """前回の区切りからの時間を1つの区間として記録する（画面のセクションごとの計測用）"""
+        now = time.perf_counter()
+        self.record(name, now - self.checkpoint_at)
+        self.checkpoint_at = now
+    
+    def report(self):
+        """区間ごとの集計表（記録した順）を返す"""
+        with self.lock:
+            rows = [
+                {"区間": name, "回数": count, "合計(ms)": round(total * 1000, 1), "平均(ms)": round(total * 1000 / count, 2), "最大(ms)": round(longest * 1000, 1)}
+                for name, (count, total, longest) in self.stages.items()
+            ]
+        return pd.DataFrame(rows, columns=["区間", "回数", "合計(ms)", "平均(ms)", "最大(ms)"])
+
+# 区切り記録関数
+def profile_checkpoint(profiler, name):
+    """プロファイルモードの場合のみ、前回の区切りからの時間を記録する"""
+    if profiler:
+        profiler.checkpoint(name)
+
+# cProfileの結果変換関数
+def summarize_cprofile(profile, limit=30):
+    """cProfileの結果を、pstats・snakeviz で開けるダンプ（バイト列）と累積時間順の上位関数の一覧に変換する"""
+    profile.create_stats()
+    # pstats.Stats は読み込んだ記録を profile から取り除くため、先にダンプする
+    dump = marshal.dumps(profile.stats)
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(limit)
+    return dump, stream.getvalue()
+
+# 生成の進行状況表示クラス
+class GenerationProgress:
+    """進行状況の表示を一定間隔にまとめて更新し、スループット・残り時間・エラー数・再試行数を表示する"""
+    
+    def __init__(self, total, thinking_budget=0, refresh_interval=0.5, window_seconds=60):
+        self.total = total
+        self.thinking_budget = thinking_budget
+        self.refresh_interval = refresh_interval
+        self.window_seconds = window_seconds
+        self.done = 0
+        self.generated = 0
+        self.error_count = 0
+        self.retry_count = 0
+        self.token_totals = [0, 0, 0, 0]
+        self.events = collections.deque()  # 直近の (時刻, 行数, トークン数)
+        self.last_combo = None
+        self.started_at = time.perf_counter()
+        self.last_render = None
+        self.progress_bar = st.progress(0)
+        self.status_text = st.empty()
+        self.token_info = st.empty()
+    
+    def update(self, combo, outcome, carried=False):
+        """1組み合わせの結果を記録し、前回の表示から一定時間が経っていれば表示を更新する"""
+        now = time.perf_counter()
+        self.done += 1
+        self.last_combo = combo
+        if not carried:
+            self.generated += 1
+            for usage_idx, count in enumerate(outcome["usage"]):
+                self.token_totals[usage_idx] += count
+            # API・JSON解析に失敗した組み合わせをエラーとして数える
+            if not outcome["parsed_ok"] or any(is_error_answer(row["回答"]) for row in outcome["rows"]):
+                self.error_count += 1
+            self.retry_count += len(outcome["escalation_reasons"]) + outcome["followup_count"]
+            self.events.append((now, len(outcome["rows"]), sum(outcome["usage"][:3])))
+        while self.events and now - self.events[0][0] > self.window_seconds:
+            self.events.popleft()
+        
+        if self.last_render is None or now - self.last_render >= self.refresh_interval or self.done == self.total:
+            self.render(now)
+    
+    def render(self, now=None):
+        """現在の集計値で進行状況を表示する"""
+        now = now or time.perf_counter()
+        self.last_render = now
+        self.progress_bar.progress(self.done / self.total if self.total else 1.0)
+        if self.last_combo is not None:
+            self.status_text.text(f"進行状況: {self.done}/{self.total} - {describe_combination(self.last_combo, self.thinking_budget)}")
+        
+        total_prompt_tokens, total_candidates_tokens, total_thoughts_tokens, total_cached_tokens = self.token_totals
+        token_text = f"入力: {total_prompt_tokens:,} | 出力: {total_candidates_tokens:,}"
+        if total_thoughts_tokens > 0:
+            token_text += f" | 思考: {total_thoughts_tokens:,}"
+        if total_cached_tokens > 0:
+            token_text += f" | キャッシュ: {total_cached_tokens:,}"
+        
+        # 直近の時間枠でのスループットと、1組み合わせあたりの実測時間からの残り時間
+        elapsed = now - self.started_at
+        window = min(self.window_seconds, elapsed)
+        rate_text = ""
+        if self.generated and window > 0:
+            rows_per_minute = sum(rows for _, rows, _ in self.events) * 60 / window
+            tokens_per_minute = sum(tokens for _, _, tokens in self.events) * 60 / window
+            remaining_seconds = int(elapsed / self.generated * (self.total - self.done))
+            rate_text = f" | {rows_per_minute:,.1f}行/分 | {tokens_per_minute:,.0f}トークン/分 | 残り約{remaining_seconds // 60}分{remaining_seconds % 60:02d}秒"
+        self.token_info.info(f"📊 トークン使用量: {token_text}{rate_text} | エラー: {self.error_count}件 | 再試行: {self.retry_count}回")
+
+# 共有スケジューラ取得関数
+@st.cache_resource
+def get_shared_scheduler():
+    """全セッションで共有するリクエストスケジューラを返す"""
+    return RequestScheduler(scheduler_settings)
+
+# 非同期呼び出し用のイベントループ
+@st.cache_resource
+def get_shared_event_loop():
+    """ヘッジ付きの呼び出しを実行するイベントループ（全セッション共有、専用スレッドで動かし続ける）"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="hedged-requests", daemon=True).start()
+    return loop
+
+# モデルごとの所要時間の記録
+@st.cache_resource
+def get_shared_latency_history():
+    """モデルごとの最近の呼び出しの所要時間（秒、全セッション共有）"""
+    return {"lock": threading.Lock(), "models": {}}
+
+# ヘッジの集計の初期値
+def new_hedge_stats():
+    """期限・ヘッジの集計（件数と、ヘッジで余分に使ったトークン: 計測できた分・取り消した分の推定）"""
+    return {
+        "timeouts": 0, "hedge_sent": 0, "hedge_wins": 0, "cancelled": 0, "hedge_cancelled": 0,
+        "hedge_usage": [0, 0, 0, 0], "cancelled_usage_estimate": [0, 0, 0, 0]
+    }
+
+# 期限・ヘッジ付きクライアント
+class HedgedClient:
+    """1リクエストごとに期限を設け、所要時間がモデルの通常の上位パーセンタイルを超えた呼び出しには同じリクエストを追加で送り、先に成功した方を使うクライアント"""
+    
+    def __init__(self, client, timeout_seconds=0, hedge=False, hedge_percentile=95, hedge_min_samples=20):
+        self.client = client
+        self.timeout_seconds = timeout_seconds
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_history = get_shared_latency_history()
+        self.stats = new_hedge_stats()
+        # client.models.generate_content と同じ形で呼び出せるようにする
+        self.models = self
+    
+    def get_hedge_delay(self, model):
+        """追加のリクエストを送るまでの待ち時間（秒）を返す（ヘッジしない、または記録が足りない場合はNone）"""
+        if not self.hedge:
+            return None
+        with self.latency_history["lock"]:
+            latencies = list(self.latency_history["models"].get(model, ()))
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return float(np.percentile(latencies, self.hedge_percentile))
+    
+    def record_latency(self, model, seconds):
+        with self.latency_history["lock"]:
+            self.latency_history["models"].setdefault(model, collections.deque(maxlen=500)).append(seconds)
+    
+    def cancel_tasks(self, pending, tasks):
+        """まだ返っていない呼び出しを取り消し、件数（うちヘッジで追加した分）を数える"""
+        for task in pending:
+            task.cancel()
+            self.stats["cancelled"] += 1
+            self.stats["hedge_cancelled"] += int(tasks[task][0])
+    
+    def generate_content(self, model, contents, config=None):
+        # 取り消せるよう非同期クライアントで呼び出し、共有のイベントループで完了を待つ
+        future = asyncio.run_coroutine_threadsafe(self.generate_content_async(model, contents, config), get_shared_event_loop())
+        return future.result()
+    
+    async def generate_content_async(self, model, contents, config):
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        hedge_delay = self.get_hedge_delay(model)
+        tasks = {}  # 呼び出し → (ヘッジかどうか, 開始時刻)
+        
+        def launch(is_hedge):
+            task = asyncio.ensure_future(self.client.aio.models.generate_content(model=model, contents=contents, config=config))
+            tasks[task] = (is_hedge, loop.time())
+            self.stats["hedge_sent"] += int(is_hedge)
+            return task
+        
+        pending = {launch(False)}
+        first_error = None
+        while True:
+            wake_times = []
+            if self.timeout_seconds:
+                wake_times.append(started_at + self.timeout_seconds)
+            if hedge_delay is not None and len(tasks) == 1:
+                wake_times.append(started_at + hedge_delay)
+            done, pending = await asyncio.wait(
+                pending, timeout=max(0.0, min(wake_times) - loop.time()) if wake_times else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            
+            winner = next((task for task in done if task.exception() is None), None)
+            for task in done:
+                if task is not winner and first_error is None:
+                    first_error = task.exception()
+            if winner is not None:
+                is_hedge, task_started_at = tasks[winner]
+                self.record_latency(model, loop.time() - task_started_at)
+                self.cancel_tasks(pending, tasks)
+                self.stats["hedge_wins"] += int(is_hedge)
+                # 同時に返ったもう一方の分は、ヘッジで余分に使ったトークンとして数える
+                for task in done - {winner}:
+                    if task.exception() is None:
+                        for usage_idx, count in enumerate(get_token_usage(task.result())):
+                            self.stats["hedge_usage"][usage_idx] += count
+                # 取り消した呼び出しの使用量は返ってこない（サーバー側で処理が進んでいれば課金される）ため、
+                # 先に返った呼び出しと同じだけ使ったものとして推定値を別に数える
+                for usage_idx, count in enumerate(get_token_usage(winner.result())):
+                    self.stats["cancelled_usage_estimate"][usage_idx] += count * len(pending)
+                return winner.result()
+            if not pending:
+                raise first_error
+            
+            elapsed = loop.time() - started_at
+            if self.timeout_seconds and elapsed >= self.timeout_seconds:
+                self.cancel_tasks(pending, tasks)
+                self.stats["timeouts"] += 1
+                self.record_latency(model, elapsed)
+                raise TimeoutError(f"{self.timeout_seconds}秒以内に応答がありませんでした")
+            if hedge_delay is not None and len(tasks) == 1 and elapsed >= hedge_delay:
+                pending.add(launch(True))
+
+# 期限・ヘッジの適用関数
+def hedge_client(client):
+    """画面の設定に応じて、期限・ヘッジ付きでモデルを呼び出すクライアントを返す（どちらも使わない場合はそのまま）"""
+    timeout_seconds = st.session_state.get("request_timeout", request_settings["timeout_seconds"])
+    hedge = st.session_state.get("hedge_enabled", request_settings["hedge"])
+    if not timeout_seconds and not hedge:
+        return client
+    return HedgedClient(client, timeout_seconds, hedge, request_settings["hedge_percentile"], request_settings["hedge_min_samples"])
+
+# ヘッジの集計関数
+def merge_hedge_stats(total_stats, client):
+    """期限・ヘッジ付きクライアントの集計を、実行全体の集計に加える"""
+    total_stats = dict(new_hedge_stats(), **(total_stats or {}))
+    stats = getattr(client, "stats", None)
+    if stats:
+        for key in ["timeouts", "hedge_sent", "hedge_wins", "cancelled", "hedge_cancelled"]:
+            total_stats[key] += stats[key]
+        for key in ["hedge_usage", "cancelled_usage_estimate"]:
+            total_stats[key] = [total + count for total, count in zip(total_stats[key], stats[key])]
+    return total_stats
+
+# エンドポイントの状態管理
+class EndpointHealth:
+    """エンドポイントごとの振り分けの順番（重み付きラウンドロビン）とサーキットブレーカーの状態（全セッション共有）
+
+    連続してfailure_threshold回失敗したエンドポイントは遮断し、cooldown_seconds後に1件だけ試しに送って、成功すれば復帰させる
+    """
+    
+    def __init__(self, endpoints, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.endpoints = {
+            endpoint["name"]: {
+                "weight": endpoint["weight"], "current_weight": 0, "failures": 0, "open_until": 0.0,
+                "cooldown": settings["cooldown_seconds"], "trial": False, "requests": 0, "errors": 0, "tokens": 0
+            }
+            for endpoint in endpoints
+        }
+    
+    def is_available(self, state, now):
+        if state["failures"] < self.settings["failure_threshold"]:
+            return True
+        # 遮断中のエンドポイントは、待ち時間が過ぎたら試しに1件だけ送る
+        return now >= state["open_until"] and not state["trial"]
+    
+    def choose(self, names, exclude=()):
+        """次に使うエンドポイントを選ぶ（すべて遮断中の場合は最も早く再開するもの）"""
+        with self.lock:
+            now = time.time()
+            candidates = [name for name in names if name not in exclude] or list(names)
+            available = [name for name in candidates if self.is_available(self.endpoints[name], now)]
+            if not available:
+                return min(candidates, key=lambda name: self.endpoints[name]["open_until"])
+            total_weight = sum(self.endpoints[name]["weight"] for name in available)
+            for name in available:
+                self.endpoints[name]["current_weight"] += self.endpoints[name]["weight"]
+            chosen = max(available, key=lambda name: self.endpoints[name]["current_weight"])
+            self.endpoints[chosen]["current_weight"] -= total_weight
+            if self.endpoints[chosen]["failures"] >= self.settings["failure_threshold"]:
+                self.endpoints[chosen]["trial"] = True
+            return chosen
+    
+    def record(self, name, failed=False, tokens=0):
+        """呼び出しの結果を記録する（failed: エンドポイント側の問題による失敗）"""
+        with self.lock:
+            state = self.endpoints[name]
+            state["requests"] += 1
+            state["tokens"] += tokens
+            state["trial"] = False
+            if not failed:
+                state["failures"] = 0
+                state["cooldown"] = self.settings["cooldown_seconds"]
+                return
+            state["errors"] += 1
+            state["failures"] += 1
+            if state["failures"] >= self.settings["failure_threshold"]:
+                state["open_until"] = time.time() + state["cooldown"]
+                state["cooldown"] = min(state["cooldown"] * 2, self.settings["max_cooldown_seconds"])
+    
+    def release(self, name):
+        """結果を待たずに取り消した呼び出しの試し送信の枠を戻す"""
+        with self.lock:
+            self.endpoints[name]["trial"] = False
+    
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            return [
+                {
+                    "name": name,
+                    "state": "正常" if state["failures"] < self.settings["failure_threshold"] else ("遮断中" if now < state["open_until"] else "試行待ち"),
+                    "weight": state["weight"],
+                    "failures": state["failures"],
+                    "reopen_in": max(0.0, state["open_until"] - now) if state["failures"] >= self.settings["failure_threshold"] else 0.0,
+                    "requests": state["requests"],
+                    "errors": state["errors"],
+                    "tokens": state["tokens"]
+                }
+                for name, state in self.endpoints.items()
+            ]
+
+# 共有エンドポイント状態取得関数
+@st.cache_resource
+def get_shared_endpoint_health():
+    """全セッションで共有するエンドポイントの状態を返す"""
+    return EndpointHealth(endpoint_settings, endpoint_pool_settings)
+
+# エンドポイント側のエラー判定関数
+def is_endpoint_failure(error):
+    """429・5xx・通信エラーなど、別のエンドポイントに回すべきエラーかを返す"""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code == 429 or code >= 500
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+# 非同期呼び出し用の窓口
+class AsyncModels:
+    """client.aio.models.generate_content と同じ形で、指定した非同期関数を呼び出す"""
+    
+    def __init__(self, generate_content):
+        self.generate_content = generate_content
+        self.models = self
+
+# エンドポイント振り分けクライアント
+class EndpointPoolClient:
+    """複数のエンドポイントに重み付きラウンドロビンで振り分け、429・5xxを返すエンドポイントを避けて呼び出すクライアント"""
+    
+    def __init__(self, clients, health):
+        self.clients = clients
+        self.health = health
+        self.usage = {name: {"requests": 0, "errors": 0, "usage": [0, 0, 0, 0]} for name in clients}
+        # client.models.generate_content / client.aio.models.generate_content と同じ形で呼び出せるようにする
+        self.models = self
+        self.aio = AsyncModels(self.generate_content_async)
+    
+    def record(self, name, response=None, error=None):
+        failed = error is not None and is_endpoint_failure(error)
+        usage = get_token_usage(response) if response is not None else (0, 0, 0, 0)
+        self.health.record(name, failed, sum(usage[:3]))
+        self.usage[name]["requests"] += 1
+        self.usage[name]["errors"] += int(error is not None)
+        self.usage[name]["usage"] = [total + count for total, count in zip(self.usage[name]["usage"], usage)]
+        # エンドポイント側の問題でなければ、別のエンドポイントでも同じ結果になるため再送しない
+        return failed
+    
+    def generate_content(self, model, contents, config=None):
+        tried = []
+        while True:
+            name = self.health.choose(self.clients, tried)
+            tried.append(name)
+            try:
+                response = self.clients[name].models.generate_content(model=model, contents=contents, config=config)
+            except Exception as e:
+                if not self.record(name, error=e) or len(tried) >= len(self.clients):
+                    raise
+                continue
+            self.record(name, response)
+            return response
+    
+    async def generate_content_async(self, model, contents, config=None):
+        tried = []
+        while True:
+            name = self.health.choose(self.clients, tried)
+            tried.append(name)
+            try:
+                response = await self.clients[name].aio.models.generate_content(model=model, contents=contents, config=config)
+            except asyncio.CancelledError:
+                self.health.release(name)
+                raise
+            except Exception as e:
+                if not self.record(name, error=e) or len(tried) >= len(self.clients):
+                    raise
+                continue
+            self.record(name, response)
+            return response
+
+# エンドポイント別使用量の集計関数
+def merge_endpoint_usage(total_usage, client):
+    """振り分けクライアントのエンドポイント別の使用量を、実行全体の集計に加える"""
+    total_usage = total_usage or {}
+    for name, usage in (getattr(client, "usage", None) or {}).items():
+        total = total_usage.setdefault(name, {"requests": 0, "errors": 0, "usage": [0, 0, 0, 0]})
+        total["requests"] += usage["requests"]
+        total["errors"] += usage["errors"]
+        total["usage"] = [count + added for count, added in zip(total["usage"], usage["usage"])]
+    return total_usage
+
+# スケジューラ登録関数
+def schedule_client(client, label, total):
+    """ジョブを共有スケジューラに登録し、順番を待ってモデルを呼び出すクライアントを返す"""
+    scheduler = get_shared_scheduler()
+    job_id = scheduler.start_job(st.session_state.get("user_role", "user"), label, total)
+    return ScheduledClient(client, scheduler, job_id)
+
+# 台帳の列（記録順）
+ledger_columns = [
+    "記録日時", "種別", "ロール", "モデル", "カスケード", "Thinking Budget", "プリセット", "入力モード",
+    "組み合わせ数", "行数", "入力トークン", "出力トークン", "思考トークン", "キャッシュトークン", "所要時間(秒)"
+]
+
+# 台帳記録関数
+def record_token_usage(kind, settings, combination_count, row_count, token_totals, duration_seconds, path=None, role=None):
+    """1回の実行（生成・再生成など）のトークン使用量を台帳に追記する（ロールを省略した場合はログイン中のロール）"""
+    return append_token_usage(
+        path or ledger_path, kind, role if role is not None else st.session_state.get("user_role", ""),
+        settings, combination_count, row_count, token_totals, duration_seconds
+    )
+
+# 台帳読み込み関数
+def load_token_ledger(path=None):
+    """台帳の全記録をDataFrameで返す"""
+    connection = open_token_ledger(path or ledger_path)
+    try:
+        rows = connection.execute("SELECT * FROM token_ledger ORDER BY rowid").fetchall()
+    finally:
+        connection.close()
+    return pd.DataFrame(rows, columns=ledger_columns)
+
+# 台帳集計関数
+def aggregate_token_ledger(ledger, group_by):
+    """台帳を指定した列ごとに集計する（実行回数・行数・トークン数・所要時間・1行あたりのトークン数）"""
+    ledger = ledger.assign(日付=ledger["記録日時"].str[:10], 合計トークン=ledger[["入力トークン", "出力トークン", "思考トークン"]].sum(axis=1))
+    summary = ledger.groupby(group_by, sort=True).agg(
+        実行回数=("記録日時", "size"),
+        行数=("行数", "sum"),
+        入力トークン=("入力トークン", "sum"),
+        出力トークン=("出力トークン", "sum"),
+        思考トークン=("思考トークン", "sum"),
+        キャッシュトークン=("キャッシュトークン", "sum"),
+        合計トークン=("合計トークン", "sum"),
+        所要時間_秒=("所要時間(秒)", "sum")
+    ).reset_index()
+    summary["1行あたりトークン"] = (summary["合計トークン"] / summary["行数"].where(summary["行数"] > 0)).round(1)
+    return summary.rename(columns={"所要時間_秒": "所要時間(秒)"})
+
+# アーカイブの列（検索結果の表示順）
+archive_columns = ["実行ID", "保存日時", "種別", "id", "質問", "キーワード列", "回答", "サマリ", "元キーワード", "アレンジキーワード", "生成モデル"]
+
+# アーカイブ接続関数
+def open_fortune_archive(path=None):
+    """生成結果アーカイブに接続し、テーブルと全文索引がなければ作成する"""
+    connection = sqlite3.connect(path or archive_path, timeout=30)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS archive_runs ("
+        "run_id INTEGER PRIMARY KEY AUTOINCREMENT, archived_at TEXT, kind TEXT, role TEXT, model TEXT,"
+        " preset TEXT, input_mode TEXT, row_count INTEGER)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS archive_rows ("
+        "row_id INTEGER PRIMARY KEY, run_id INTEGER, question_id TEXT, row_key TEXT, question TEXT, answer TEXT,"
+        " summary TEXT, keyword_columns TEXT, original_keyword TEXT, arranged_keyword TEXT, model TEXT)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS archive_rows_row_key ON archive_rows (row_key)")
+    connection.execute("CREATE INDEX IF NOT EXISTS archive_rows_question_id ON archive_rows (question_id)")
+    # 日本語は分かち書きせずに部分一致できるよう trigram で索引を作る（非対応のSQLiteでは通常のテーブルで部分一致検索する）
+    try:
+        connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(question, answer, summary, keywords, tokenize='trigram')"
+        )
+    except sqlite3.OperationalError:
+        connection.execute("CREATE TABLE IF NOT EXISTS archive_fts (question TEXT, answer TEXT, summary TEXT, keywords TEXT)")
+    return connection
+
+# 全文索引の有無の確認関数
+def archive_has_fulltext_index(connection):
+    """アーカイブの検索用テーブルがFTS5の全文索引かどうかを返す"""
+    row = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'archive_fts'").fetchone()
+    return bool(row) and "fts5" in row[0].lower()
+
+# アーカイブ保存関数
+def archive_results(df, kind, settings=None, path=None):
+    """結果テーブルの行をアーカイブに追加し、追加した行数を返す（保存に失敗しても生成結果には影響させない）"""
+    if df.empty:
+        return 0
+    keyword_column_names = [col for col in df.columns if col not in result_base_columns]
+    
+    def as_text(value):
+        return "" if value is None or pd.isna(value) else str(value)
+    
+    settings = settings or {}
+    try:
+        connection = open_fortune_archive(path)
+        try:
+            with connection:
+                run_id = connection.execute(
+                    "INSERT INTO archive_runs (archived_at, kind, role, model, preset, input_mode, row_count) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        get_japan_time(), kind, st.session_state.get("user_role", ""),
+                        " → ".join(settings.get("model_chain", [])), settings.get("preset_name") or "",
+                        settings.get("input_mode", ""), len(df)
+                    )
+                ).lastrowid
+                next_row_id = connection.execute("SELECT COALESCE(MAX(row_id), 0) + 1 FROM archive_rows").fetchone()[0]
+                archive_rows, search_rows = [], []
+                for row_id, record in enumerate(df.to_dict("records"), next_row_id):
+                    keyword_columns = [(col, as_text(record.get(col))) for col in keyword_column_names if as_text(record.get(col))]
+                    texts = [as_text(record.get(col)) for col in ["id", "質問", "回答", "サマリ", "元キーワード", "アレンジキーワード", "生成モデル"]]
+                    archive_rows.append((
+                        row_id, run_id, texts[0], build_result_row_key(texts[0], keyword_columns), texts[1], texts[2], texts[3],
+                        json.dumps(keyword_columns, ensure_ascii=False), texts[4], texts[5], texts[6]
+                    ))
+                    # 検索用の文は全角・半角と大文字小文字を揃えて索引する
+                    search_rows.append((
+                        row_id, normalize_keyword_text(texts[1]), normalize_keyword_text(texts[2]), normalize_keyword_text(texts[3]),
+                        normalize_keyword_text(" ".join(f"{col} {value}" for col, value in keyword_columns))
+                    ))
+                connection.executemany("INSERT INTO archive_rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", archive_rows)
+                connection.executemany("INSERT INTO archive_fts (rowid, question, answer, summary, keywords) VALUES (?, ?, ?, ?, ?)", search_rows)
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return 0
+    return len(df)
+
+# アーカイブ検索条件作成関数
+def build_archive_conditions(connection, text_query="", keyword_query="", id_query=""):
+    """検索語からアーカイブの絞り込み条件（SQLとパラメータ）を作成する（空白区切りの語はすべて含むものに絞る）"""
+    full_text = archive_has_fulltext_index(connection)
+    conditions, params, match_terms = [], [], []
+    all_columns = "question || char(10) || answer || char(10) || summary || char(10) || keywords"
+    for target, query in ((None, text_query), ("keywords", keyword_query)):
+        for term in normalize_keyword_text(query or "").split():
+            if full_text and len(term) >= 3:
+                quoted = '"' + term.replace('"', '""') + '"'
+                match_terms.append(f"{target} : {quoted}" if target else quoted)
+            else:
+                # trigram の索引は3文字未満の語には使えないため部分一致で探す
+                escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                conditions.append(f"r.row_id IN (SELECT rowid FROM archive_fts WHERE ({target or all_columns}) LIKE ? ESCAPE '\\')")
+                params.append(f"%{escaped}%")
+    if match_terms:
+        conditions.insert(0, "r.row_id IN (SELECT rowid FROM archive_fts WHERE archive_fts MATCH ?)")
+        params.insert(0, " AND ".join(match_terms))
+    if id_query and id_query.strip():
+        conditions.append("r.question_id = ?")
+        params.append(id_query.strip())
+    return " AND ".join(conditions) or "1", params
+
+# アーカイブ問い合わせ関数
+def query_fortune_archive(connection, where, params, limit=None, offset=0):
+    """条件に合うアーカイブの行を新しい順にDataFrameで返す"""
+    rows = connection.execute(
+        "SELECT r.run_id, a.archived_at, a.kind, r.question_id, r.question, r.keyword_columns, r.answer, r.summary,"
+        " r.original_keyword, r.arranged_keyword, r.model"
+        f" FROM archive_rows r JOIN archive_runs a ON a.run_id = r.run_id WHERE {where}"
+        " ORDER BY r.row_id DESC LIMIT ? OFFSET ?",
+        [*params, -1 if limit is None else limit, offset]
+    ).fetchall()
+    return pd.DataFrame(rows, columns=archive_columns)
+
+# アーカイブ検索関数
+def search_fortune_archive(text_query="", keyword_query="", id_query="", limit=None, offset=0, path=None):
+    """質問・回答・サマリ・キーワード列の全文検索とIDでアーカイブを絞り込み、(ページの行, 一致件数) を返す"""
+    connection = open_fortune_archive(path)
+    try:
+        where, params = build_archive_conditions(connection, text_query, keyword_query, id_query)
+        total = connection.execute(f"SELECT COUNT(*) FROM archive_rows r WHERE {where}", params).fetchone()[0]
+        return query_fortune_archive(connection, where, params, limit, offset), total
+    finally:
+        connection.close()
+
+# アーカイブ照合関数
+def lookup_archived_rows(question_id, keyword_columns, path=None):
+    """IDとキーワード列の値が一致するアーカイブの行を、実行をまたいで新しい順に返す"""
+    connection = open_fortune_archive(path)
+    try:
+        return query_fortune_archive(connection, "r.row_key = ?", [build_result_row_key(question_id, keyword_columns)])
+    finally:
+        connection.close()
+
+# アーカイブ件数取得関数
+def get_archive_stats(path=None):
+    """アーカイブの実行数・行数と全文索引の有無を返す"""
+    connection = open_fortune_archive(path)
+    try:
+        run_count = connection.execute("SELECT COUNT(*) FROM archive_runs").fetchone()[0]
+        row_count = connection.execute("SELECT COUNT(*) FROM archive_rows").fetchone()[0]
+        return {"runs": run_count, "rows": row_count, "full_text": archive_has_fulltext_index(connection)}
+    finally:
+        connection.close()
+
+# アーカイブのキーワード表示関数
+def format_archived_keywords(keyword_columns_json):
+    """保存したキーワード列を「列名: キーワード」の一覧の文字列にする"""
+    return " / ".join(f"{col}: {value}" for col, value in json.loads(keyword_columns_json or "[]"))
+
+# アーカイブ出力関数
+def expand_archived_rows(archive_df):
+    """アーカイブの行を、キーワード列を展開した出力CSVと同じ形式のDataFrameにする"""
+    records = []
+    for record in archive_df.to_dict("records"):
+        row = {col: record[col] for col in ["実行ID", "保存日時", "種別", "id", "質問"]}
+        row.update(json.loads(record["キーワード列"] or "[]"))
+        row.update({col: record[col] for col in result_base_columns[2:]})
+        records.append(row)
+    # 実行ごとに異なるキーワード列は、質問と回答の間にまとめて並べる
+    keyword_column_names = list(dict.fromkeys(col for row in records for col in row if col not in archive_columns))
+    return pd.DataFrame(records, columns=archive_columns[:5] + keyword_column_names + result_base_columns[2:])
+
+# 配信用ストアの登録内容作成関数
+def build_serving_entries(df):
+    """結果テーブルの行から、配信用ストアに登録する (キー, 値) の一覧を作成する（エラーの行は除く）"""
+    rows = df[~df["回答"].map(is_error_answer)]
+    return build_store_entries(rows.to_dict("records"), result_base_columns)
+
+# 配信用ストア公開関数
+def publish_serving_store(df, settings=None, path=None):
+    """結果テーブルを配信用ストアに変換して公開し、登録件数を返す（公開中のストアはアトミックに置き換わる）"""
+    settings = settings or {}
+    metadata = {
+        "published_at": get_japan_time(),
+        "models": settings.get("model_chain", []),
+        "preset": settings.get("preset_name") or "",
+        "keyword_columns": [col for col in df.columns if col not in result_base_columns]
+    }
+    return build_fortune_store(build_serving_entries(df), path or serving_store_path, metadata)
+
+# ベンチマーク記録キー作成関数
+def build_benchmark_record_key(model_name, contents, config=None):
+    """モデル名・生成設定・プロンプトから、記録したレスポンスを照合するキーを作成する"""
+    thinking_config = getattr(config, "thinking_config", None)
+    payload = json.dumps([
+        model_name,
+        getattr(thinking_config, "thinking_budget", None),
+        getattr(config, "max_output_tokens", None),
+        getattr(config, "system_instruction", None),
+        contents
+    ], ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# ベンチマーク用クライアント
+class BenchmarkClient:
+    """モデル呼び出しの所要時間を計測し、レスポンスを記録する（記録を渡した場合はオフラインで再生する）"""
+    usage_fields = ('prompt_token_count', 'candidates_token_count', 'thoughts_token_count', 'cached_content_token_count')
+    
+    def __init__(self, client=None, recordings=None):
+        self.client = client
+        self.recordings = recordings
+        self.records = []
+        self.elapsed = 0.0
+        # client.models.generate_content と同じ形で呼び出せるようにする
+        self.models = self
+    
+    def generate_content(self, model, contents, config=None):
+        record_key = build_benchmark_record_key(model, contents, config)
+        if self.recordings is not None:
+            record = self.recordings.get(record_key)
+            if record is None:
+                raise KeyError("記録されたレスポンスがありません")
+            self.elapsed += record["latency"]
+            return types.GenerateContentResponse(
+                candidates=[types.Candidate(
+                    content=types.Content(role="model", parts=[types.Part(text=record["text"])]),
+                    finish_reason=record.get("finish_reason")
+                )],
+                usage_metadata=types.GenerateContentResponseUsageMetadata(**record["usage"])
+            )
+        
+        start_time = time.perf_counter()
+        response = self.client.models.generate_content(model=model, contents=contents, config=config)
+        latency = time.perf_counter() - start_time
+        self.elapsed += latency
+        self.records.append({
+            "key": record_key,
+            "model": model,
+            "latency": latency,
+            "text": response.text or "",
+            "finish_reason": "MAX_TOKENS" if is_truncated_response(response) else None,
+            "usage": dict(zip(self.usage_fields, get_token_usage(response)))
+        })
+        return response
+
+# ベンチマーク記録読み込み関数
+def load_benchmark_recordings(text):
+    """記録ファイル（JSON Lines）を記録キー→レスポンスの辞書に変換する"""
+    recordings = {}
+    for line in text.splitlines():
+        if line.strip():
+            record = json.loads(line)
+            recordings[record["key"]] = record
+    return recordings
+
+# ベンチマーク設定一覧作成関数
+def build_sweep_settings(models, thinking_budgets):
+    """モデル×Thinking Budgetの設定一覧を作成する（思考機能のないモデルは1設定、実際に送る値が同じ設定はまとめる）"""
+    sweep_settings = []
+    for model_name in models:
+        for budget in (thinking_budgets if "2.5" in model_name else [0]):
+            if model_name == "gemini-2.5-pro":
+                budget = max(budget, 128)
+            if (model_name, budget) not in sweep_settings:
+                sweep_settings.append((model_name, budget))
+    return sweep_settings
+
+# ベンチマーク実行関数
+def run_benchmark_sweep(benchmark_client, sample, settings, keyword_index, sweep_settings, progress_callback=None, client=None):
+    """サンプルの組み合わせを各設定で生成し、組み合わせごとの計測値を返す（clientを渡した場合はclient経由で呼び出す）"""
+    measurements = []
+    total = len(sweep_settings) * len(sample)
+    for model_name, budget in sweep_settings:
+        sweep = dict(settings, model_chain=[model_name], cascade_enabled=False, thinking_budget=budget, thinking_budgets={})
+        for combo in sample:
+            start_elapsed = benchmark_client.elapsed
+            outcome = generate_combination(client or benchmark_client, combo, sweep, keyword_index)
+            rows = outcome["rows"]
+            has_error = any(is_error_answer(row["回答"]) for row in rows)
+            conforming = [
+                check_length(row["回答"], settings["answer_length"], settings["length_tolerance"])
+                and check_length(row["サマリ"], settings["summary_length"], settings["length_tolerance"])
+                for row in rows
+            ]
+            prompt_tokens, candidates_tokens, thoughts_tokens, cached_tokens = outcome["usage"]
+            measurements.append({
+                "モデル": model_name,
+                "Thinking Budget": budget,
+                "レイテンシ": benchmark_client.elapsed - start_elapsed,
+                "入力トークン": prompt_tokens,
+                "出力トークン": candidates_tokens,
+                "思考トークン": thoughts_tokens,
+                "キャッシュトークン": cached_tokens,
+                "JSON有効": outcome["parsed_ok"] and not has_error,
+                "文字数適合率": sum(conforming) / len(conforming) if conforming else 0.0,
+                "エラー": has_error
+            })
+            if progress_callback:
+                progress_callback(len(measurements), total)
+    return measurements
+
+# ベンチマークレポート作成関数
+def build_benchmark_report(measurements, pricing=None, latency_slo=None, min_quality=0):
+    """計測値を設定ごとに集計し、レイテンシ分位点・トークン数・JSON有効率・文字数適合率を比較する表を作成する"""
+    report_rows = []
+    for (model_name, budget), group in pd.DataFrame(measurements).groupby(["モデル", "Thinking Budget"], sort=False):
+        latency = group["レイテンシ"]
+        row = {
+            "モデル": model_name,
+            "Thinking Budget": str(budget) if "2.5" in model_name else "-",
+            "件数": len(group),
+            "p50(秒)": round(latency.quantile(0.5), 2),
+            "p90(秒)": round(latency.quantile(0.9), 2),
+            "p99(秒)": round(latency.quantile(0.99), 2),
+            "平均入力トークン": round(group["入力トークン"].mean()),
+            "平均出力トークン": round(group["出力トークン"].mean()),
+            "平均思考トークン": round(group["思考トークン"].mean()),
+            "平均キャッシュトークン": round(group["キャッシュトークン"].mean()),
+            "JSON有効率(%)": round(group["JSON有効"].mean() * 100, 1),
+            "文字数適合率(%)": round(group["文字数適合率"].mean() * 100, 1),
+            "エラー件数": int(group["エラー"].sum())
+        }
+        # 料金設定がある場合は1組み合わせあたりの推定コスト（思考トークンは出力として計算）
+        price = (pricing or {}).get(model_name)
+        if price:
+            row["推定コスト/件"] = round(
+                (row["平均入力トークン"] * price.get("input", 0)
+                 + (row["平均出力トークン"] + row["平均思考トークン"]) * price.get("output", 0)) / 1_000_000, 6
+            )
+        if latency_slo:
+            row["条件達成"] = (
+                row["p90(秒)"] <= latency_slo and row["エラー件数"] == 0
+                and row["JSON有効率(%)"] >= min_quality and row["文字数適合率(%)"] >= min_quality
+            )
+        report_rows.append(row)
+    
+    report = pd.DataFrame(report_rows)
+    # 条件を満たす設定のうち最も安いもの（料金設定がなければ合計トークン数が最少のもの）を推奨とする
+    if latency_slo and not report.empty and report["条件達成"].any():
+        report["推奨"] = ""
+        if "推定コスト/件" in report:
+            # 一部のモデルだけ料金設定がある場合は、料金のある設定の中で比較する（料金のない設定は比較できない）
+            cost = report["推定コスト/件"]
+            report.loc[report["条件達成"] & cost.isna(), "推奨"] = "価格未設定"
+            candidates = cost[report["条件達成"] & cost.notna()]
+        else:
+            candidates = report[["平均入力トークン", "平均出力トークン", "平均思考トークン"]].sum(axis=1)[report["条件達成"]]
+        if not candidates.empty:
+            report.loc[candidates.idxmin(), "推奨"] = "⭐"
+    return report
+
 # Basic認証チェック
 if not check_password():
     st.stop()
 
+# プロファイルモード（管理者のみ、この再実行の画面のセクションごとの所要時間を計測する）
+rerun_profiler = None
+if st.session_state.get("user_role") == "admin" and st.session_state.get("profiling_enabled"):
+    rerun_profiler = StageProfiler(script_started_at)
+    rerun_profiler.checkpoint("設定の読み込み・認証")
+
 # 認証成功後のメイン画面
 st.title("🔮 汎用占い生成")
 
 # サイドバーに移動する設定項目を定義
 selected_model = None
+cascade_enabled = False
+model_chain = []
 thinking_budget = 1024
 answer_length = 300
 summary_length = 20
+length_tolerance = 30
 
 if not vertex_ai_project_id:
     st.error("⚠️ Vertex AI Project IDが設定されていません。secrets.tomlファイルに設定してください。")
@@ -298,127 +1996,133 @@ if vertex_ai_project_id:
         # 1. プリセット管理タブ
         # ===============================
         with tab1:
-            # プリセットデータをセッション状態で管理
-            if 'presets' not in st.session_state:
-                st.session_state.presets = {}
-            
-            if 'selected_preset' not in st.session_state:
-                st.session_state.selected_preset = None
-            
-            # ファイル操作
-            with st.expander("📁 ファイル操作", expanded=False):
-                # インポート
-                uploaded_preset = st.file_uploader(
-                    "📤 インポート",
-                    type=['json'],
-                    key="preset_upload",
-                    label_visibility="visible"
-                )
+            # プリセットのファイル操作・選択ではこのタブの上部だけを再実行する（適用・解除した時は画面全体を再実行する）
+            @st.fragment
+            def show_preset_manager():
+                # プリセットデータをセッション状態で管理
+                if 'presets' not in st.session_state:
+                    st.session_state.presets = {}
+                
+                if 'selected_preset' not in st.session_state:
+                    st.session_state.selected_preset = None
                 
-                if uploaded_preset is not None:
-                    # ファイルが既に処理されたかチェック
-                    file_hash = hashlib.md5(uploaded_preset.read()).hexdigest()
-                    uploaded_preset.seek(0)  # ファイルポインタをリセット
+                # ファイル操作
+                with st.expander("📁 ファイル操作", expanded=False):
+                    # インポート
+                    uploaded_preset = st.file_uploader(
+                        "📤 インポート",
+                        type=['json'],
+                        key="preset_upload",
+                        label_visibility="visible"
+                    )
                     
-                    if 'last_uploaded_preset_hash' not in st.session_state or st.session_state.last_uploaded_preset_hash != file_hash:
-                        try:
-                            preset_content = json.loads(uploaded_preset.read().decode('utf-8'))
-                            # クリーンなプリセットデータのみを抽出
-                            cleaned_presets = {}
-                            for name, data in preset_content.items():
-                                cleaned_presets[name] = {
-                                    'rules': data.get('rules', ''),
-                                    'tone': data.get('tone', ''),
-                                    'created': data.get('created', data.get('last_updated', get_japan_time()))
-                                }
-                            # 既存のプリセットにマージ（上書き）
-                            for name, data in cleaned_presets.items():
-                                st.session_state.presets[name] = data
-                            
-                            st.session_state.last_uploaded_preset_hash = file_hash
-                            st.success(f"{len(cleaned_presets)}個のプリセットをインポートしました")
-                        except Exception as e:
-                            st.error(f"インポートエラー: {str(e)}")
+                    if uploaded_preset is not None:
+                        # ファイルが既に処理されたかチェック
+                        file_hash = hashlib.md5(uploaded_preset.read()).hexdigest()
+                        uploaded_preset.seek(0)  # ファイルポインタをリセット
+                        
+                        if 'last_uploaded_preset_hash' not in st.session_state or st.session_state.last_uploaded_preset_hash != file_hash:
+                            try:
+                                preset_content = json.loads(uploaded_preset.read().decode('utf-8'))
+                                # クリーンなプリセットデータのみを抽出
+                                cleaned_presets = {}
+                                for name, data in preset_content.items():
+                                    cleaned_presets[name] = {
+                                        'rules': data.get('rules', ''),
+                                        'tone': data.get('tone', ''),
+                                        'keyword_columns': data.get('keyword_columns', {}),
+                                        'condense_limit': data.get('condense_limit', 0),
+                                        'created': data.get('created', data.get('last_updated', get_japan_time()))
+                                    }
+                                # 既存のプリセットにマージ（上書き）
+                                for name, data in cleaned_presets.items():
+                                    st.session_state.presets[name] = data
+                                
+                                st.session_state.last_uploaded_preset_hash = file_hash
+                                st.success(f"{len(cleaned_presets)}個のプリセットをインポートしました")
+                            except Exception as e:
+                                st.error(f"インポートエラー: {str(e)}")
+                    
+                    # エクスポート
+                    st.write("")
+                    if st.session_state.presets:
+                        # エクスポート用のデータを作成（不要なキーを除外）
+                        export_data = {}
+                        for name, data in st.session_state.presets.items():
+                            export_data[name] = {
+                                'rules': data.get('rules', ''),
+                                'tone': data.get('tone', ''),
+                                'keyword_columns': data.get('keyword_columns', {}),
+                                'condense_limit': data.get('condense_limit', 0),
+                                'last_updated': data.get('last_updated', data.get('created', get_japan_time()))
+                            }
+                        
+                        # デバッグ情報を表示（コメントアウト）
+                        # with st.expander("エクスポートデータの確認", expanded=False):
+                        #     st.json(export_data)
+                        
+                        json_str = json.dumps(export_data, ensure_ascii=False, indent=2)
+                        st.download_button(
+                            label="📥 JSONファイルをダウンロード",
+                            data=json_str,
+                            file_name=f"presets_{get_japan_time().replace(':', '').replace('-', '').replace(' ', '_')}.json",
+                            mime="application/json",
+                            use_container_width=True
+                        )
+                    else:
+                        st.info("プリセットがありません")
                 
-                # エクスポート
-                st.write("")
+                # プリセット選択セクション
                 if st.session_state.presets:
-                    # エクスポート用のデータを作成（不要なキーを除外）
-                    export_data = {}
-                    for name, data in st.session_state.presets.items():
-                        export_data[name] = {
-                            'rules': data.get('rules', ''),
-                            'tone': data.get('tone', ''),
-                            'last_updated': data.get('last_updated', data.get('created', get_japan_time()))
-                        }
+                    st.divider()
+                    # ドロップダウンでプリセットを選択
+                    preset_names = list(st.session_state.presets.keys())
                     
-                    # デバッグ情報を表示（コメントアウト）
-                    # with st.expander("エクスポートデータの確認", expanded=False):
-                    #     st.json(export_data)
+                    # 現在選択中のプリセットをデフォルトに
+                    if st.session_state.selected_preset and st.session_state.selected_preset in preset_names:
+                        default_index = preset_names.index(st.session_state.selected_preset)
+                    else:
+                        default_index = 0
                     
-                    json_str = json.dumps(export_data, ensure_ascii=False, indent=2)
-                    st.download_button(
-                        label="📥 JSONファイルをダウンロード",
-                        data=json_str,
-                        file_name=f"presets_{get_japan_time().replace(':', '').replace('-', '').replace(' ', '_')}.json",
-                        mime="application/json",
-                        use_container_width=True
+                    selected_preset_name = st.selectbox(
+                        "🎯 プリセット選択",
+                        preset_names,
+                        index=default_index,
+                        format_func=lambda x: f"{x}（選択中）" if x == st.session_state.selected_preset else x
                     )
-                else:
-                    st.info("プリセットがありません")
+                    
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        if st.button("✅ 適用", type="primary", use_container_width=True):
+                            # プリセットを適用
+                            if selected_preset_name in st.session_state.presets:
+                                preset_info = st.session_state.presets[selected_preset_name]
+                                st.session_state['preset_user_rules_input'] = preset_info.get('rules', '')
+                                st.session_state['preset_user_tone_input'] = preset_info.get('tone', '')
+                                apply_preset_keyword_settings(st.session_state, preset_info)
+                                st.session_state.selected_preset = selected_preset_name
+                                st.success(f"✅ プリセット「{selected_preset_name}」を適用しました")
+                                st.rerun()
+                    
+                    with col2:
+                        if st.button("❌ 解除", 
+                                   use_container_width=True,
+                                   disabled=st.session_state.selected_preset is None):
+                            st.session_state.selected_preset = None
+                            # ルール設定とトンマナ設定も空欄に戻す
+                            st.session_state.preset_user_rules_input = ""
+                            st.session_state.preset_user_tone_input = ""
+                            st.rerun()
             
-            # プリセット選択セクション
-            if st.session_state.presets:
-                st.divider()
-                # ドロップダウンでプリセットを選択
-                preset_names = list(st.session_state.presets.keys())
-                
-                # 現在選択中のプリセットをデフォルトに
-                if st.session_state.selected_preset and st.session_state.selected_preset in preset_names:
-                    default_index = preset_names.index(st.session_state.selected_preset)
-                else:
-                    default_index = 0
-                
-                selected_preset_name = st.selectbox(
-                    "🎯 プリセット選択",
-                    preset_names,
-                    index=default_index,
-                    format_func=lambda x: f"{x}（選択中）" if x == st.session_state.selected_preset else x
-                )
-                
-                col1, col2 = st.columns(2)
-                with col1:
-                    if st.button("✅ 適用", type="primary", use_container_width=True):
-                        # プリセットを適用
-                        if selected_preset_name in st.session_state.presets:
-                            preset_info = st.session_state.presets[selected_preset_name]
-                            st.session_state['preset_user_rules_input'] = preset_info.get('rules', '')
-                            st.session_state['preset_user_tone_input'] = preset_info.get('tone', '')
-                            st.session_state['user_rules'] = preset_info.get('rules', '')
-                            st.session_state['user_tone'] = preset_info.get('tone', '')
-                            st.session_state.selected_preset = selected_preset_name
-                            st.success(f"✅ プリセット「{selected_preset_name}」を適用しました")
-                            st.rerun()
-                
-                with col2:
-                    if st.button("❌ 解除", 
-                               use_container_width=True,
-                               disabled=st.session_state.selected_preset is None):
-                        st.session_state.selected_preset = None
-                        # ルール設定とトンマナ設定も空欄に戻す
-                        st.session_state.preset_user_rules_input = ""
-                        st.session_state.preset_user_tone_input = ""
-                        st.session_state.user_rules = ""
-                        st.session_state.user_tone = ""
-                        st.rerun()
+            show_preset_manager()
             
-            # プリセット編集セクション
+            # プリセット編集セクション（ルール・トンマナは生成設定に使うため、フラグメントに含めず編集のたびに画面全体を再実行する）
             st.divider()
             st.write("✏️ **ルール＆トンマナ編集**", help="占い生成の追加ルールやトーン&マナーを設定できます。")
             
             # セッション状態の初期化
             if 'preset_user_rules_input' not in st.session_state:
-                st.session_state.preset_user_rules_input = st.session_state.get('user_rules', "")
+                st.session_state.preset_user_rules_input = ""
             
             # ルール設定
             st.text_area(
@@ -431,7 +2135,7 @@ if vertex_ai_project_id:
             
             # セッション状態の初期化
             if 'preset_user_tone_input' not in st.session_state:
-                st.session_state.preset_user_tone_input = st.session_state.get('user_tone', "")
+                st.session_state.preset_user_tone_input = ""
             
             # トーン&マナー設定
             st.text_area(
@@ -463,6 +2167,7 @@ if vertex_ai_project_id:
                         st.session_state.presets[st.session_state.selected_preset] = {
                             'rules': rules,
                             'tone': tone,
+                            **get_preset_keyword_settings(st.session_state),
                             'last_updated': get_japan_time()
                         }
                         
@@ -501,6 +2206,7 @@ if vertex_ai_project_id:
                         st.session_state.presets[preset_name] = {
                             'rules': st.session_state.get('preset_user_rules_input', ''),
                             'tone': st.session_state.get('preset_user_tone_input', ''),
+                            **get_preset_keyword_settings(st.session_state),
                             'created': get_japan_time()
                         }
                         st.session_state.selected_preset = preset_name
@@ -520,6 +2226,17 @@ if vertex_ai_project_id:
                 if 'custom_keywords' not in st.session_state:
                     st.session_state.custom_keywords = {}
                 
+                # サーバー側のキーワードCSV（全セッションで共有し、更新されたファイルだけ読み直す）
+                server_keywords = refresh_keyword_directory()
+                if 'server_keyword_version' not in st.session_state:
+                    apply_server_keywords(st.session_state, server_keywords)
+                if server_keywords["files"]:
+                    st.caption("サーバーのキーワードCSV: " + "、".join(
+                        f"{file_name}（{loaded_at}読み込み）" for file_name, loaded_at in server_keywords["files"].items()
+                    ))
+                for file_name, error in server_keywords["errors"].items():
+                    st.warning(f"サーバーの{file_name}を読み込めませんでした（前回の内容を使用します）: {error}")
+                
                 # カスタムキーワードのアップロード
                 col1, col2 = st.columns(2)
                 
@@ -537,22 +2254,26 @@ if vertex_ai_project_id:
                         st.write("アップロードされたファイル：")
                         for file in uploaded_keyword_files:
                             # ファイル名からカテゴリ名を抽出（拡張子を除く）
-                            category_name = file.name.replace('.csv', '').replace('キーワード', '')
+                            category_name = get_keyword_category_name(file.name)
                             st.write(f"- {category_name} ({file.name})")
                 
                 # カスタムキーワードの読み込み
                 if uploaded_keyword_files:
                     for file in uploaded_keyword_files:
                         try:
-                            df = pd.read_csv(file, encoding='utf-8')
-                            category_name = file.name.replace('.csv', '').replace('キーワード', '')
-                            
-                            # データ構造を既存の形式に合わせる
-                            st.session_state.custom_keywords[category_name] = {
-                                "df": df,
-                                "columns": list(df.columns),
-                                "data": df.to_dict('records')
-                            }
+                            category_name = get_keyword_category_name(file.name)
+
+                            # 内容が変わっていないファイルは再読み込みしない
+                            file_hash = hashlib.md5(file.getvalue()).hexdigest()
+                            loaded = st.session_state.custom_keywords.get(category_name)
+                            if loaded and loaded.get("hash") == file_hash:
+                                continue
+
+                            # 列ごとの文字列配列とキーワード名の索引だけを保持する
+                            st.session_state.custom_keywords[category_name] = load_keyword_table(file, file_hash)
+                            # アップロードしたカテゴリはサーバー側の更新で置き換えない
+                            if category_name in st.session_state.get("server_keyword_categories", []):
+                                st.session_state.server_keyword_categories.remove(category_name)
                             
                         except Exception as e:
                             st.error(f"{file.name}の読み込みに失敗しました: {str(e)}")
@@ -563,26 +2284,93 @@ if vertex_ai_project_id:
                     # カスタムキーワードのアップロードを必須にする
                     if not st.session_state.custom_keywords:
                         st.warning("⚠️ キーワードCSVファイルをアップロードしてください。")
-        
+
+                # セッションのメモリ使用量
+                if st.checkbox("🧮 メモリ使用量を表示", value=False, help="このセッションが保持しているデータのおおよそのサイズを表示します"):
+                    memory_report = build_session_memory_report(st.session_state)
+                    st.write(f"セッション合計: {memory_report['サイズ(KB)'].sum():,.1f} KB")
+                    st.caption("同じ内容のキーワードCSVは全セッションで共有されます")
+                    keyword_sizes = pd.DataFrame([
+                        {
+                            "カテゴリ": category_name,
+                            "CSVサイズ(KB)": round((keyword_table.get("raw_size") or 0) / 1024, 1),
+                            "保持サイズ(KB)": round(estimate_object_size(keyword_table) / 1024, 1)
+                        }
+                        for category_name, keyword_table in st.session_state.custom_keywords.items()
+                    ])
+                    if not keyword_sizes.empty:
+                        st.dataframe(keyword_sizes, hide_index=True, use_container_width=True)
+                    st.dataframe(memory_report, hide_index=True, use_container_width=True)
+
         # ===============================
         # 2. AI・モデル設定タブ
         # ===============================
         with tab2:
-            # モデル選択
-            default_model = "gemini-2.5-flash"
-            
-            selected_model = st.selectbox(
-                "使用するモデル",
-                vertex_model_options,
-                index=0 if default_model not in vertex_model_options else vertex_model_options.index(default_model),
-                help="使用するGeminiモデルを選択してください"
+            # カスケードモード
+            cascade_enabled = st.checkbox(
+                "🪜 カスケードモード",
+                value=False,
+                help="高速モデルで生成し、JSON解析エラー・空の回答・文字数不一致の場合のみ上位モデルで再生成します"
             )
             
+            if cascade_enabled:
+                cascade_first_model = st.selectbox(
+                    "初段モデル",
+                    vertex_model_options,
+                    index=0,
+                    help="最初に使用する高速なモデルを選択してください"
+                )
+                cascade_escalation_models = st.multiselect(
+                    "エスカレーション先（上から順に試行）",
+                    [m for m in vertex_model_options if m != cascade_first_model],
+                    default=[m for m in ["gemini-2.5-flash", "gemini-2.5-pro"] if m != cascade_first_model],
+                    help="初段モデルの回答が条件を満たさない場合に使用するモデル"
+                )
+                model_chain = [cascade_first_model] + cascade_escalation_models
+                selected_model = cascade_first_model
+                st.caption("文字数の許容誤差は「📄 出力」タブで設定できます")
+            else:
+                # モデル選択
+                default_model = "gemini-2.5-flash"
+                
+                selected_model = st.selectbox(
+                    "使用するモデル",
+                    vertex_model_options,
+                    index=0 if default_model not in vertex_model_options else vertex_model_options.index(default_model),
+                    help="使用するGeminiモデルを選択してください"
+                )
+                model_chain = [selected_model]
+            
             # 思考機能の設定（Gemini 2.5のみ対応）
             thinking_budget = 1024  # デフォルト値
-            if "2.5" in selected_model:
+            thinking_budgets = {}
+            thinking_models = [m for m in model_chain if "2.5" in m]
+            if thinking_models and cascade_enabled:
+                # カスケードモードではモデルごとに設定する（上位モデルに初段モデルの値をそのまま使わない）
+                st.write("### 🧠 推論設定")
+                for model_name in thinking_models:
+                    if model_name == "gemini-2.5-pro":
+                        thinking_budgets[model_name] = st.slider(
+                            f"Thinking Budget（{model_name}）",
+                            min_value=128,
+                            max_value=4096,
+                            value=1024,
+                            step=128,
+                            help="推論に使用するトークン数。Proモデルでは128以上の値が必要です。"
+                        )
+                    else:
+                        thinking_budgets[model_name] = st.slider(
+                            f"Thinking Budget（{model_name}）",
+                            min_value=0,
+                            max_value=4096,
+                            value=1024,
+                            step=128,
+                            help="推論に使用するトークン数。0に設定すると推論機能を無効化します。"
+                        )
+                thinking_budget = thinking_budgets.get(model_chain[0], thinking_budget)
+            elif thinking_models:
                 st.write("### 🧠 推論設定")
-                if selected_model == "gemini-2.5-flash":
+                if "gemini-2.5-flash" in thinking_models:
                     thinking_budget = st.slider(
                         "Thinking Budget",
                         min_value=0,
@@ -591,7 +2379,7 @@ if vertex_ai_project_id:
                         step=128,
                         help="推論に使用するトークン数。0に設定すると推論機能を無効化します。"
                     )
-                elif selected_model == "gemini-2.5-pro":
+                else:
                     thinking_budget = st.slider(
                         "Thinking Budget",
                         min_value=128,
@@ -600,6 +2388,25 @@ if vertex_ai_project_id:
                         step=128,
                         help="推論に使用するトークン数。Proモデルでは128以上の値が必要です。"
                     )
+            
+            # リクエストの期限と、遅いリクエストの追加送信（ヘッジ）
+            st.write("### ⏱️ リクエストの期限")
+            st.number_input(
+                "1リクエストの期限（秒、0で無制限）",
+                min_value=0,
+                max_value=600,
+                value=int(request_settings["timeout_seconds"]),
+                step=10,
+                key="request_timeout",
+                help="期限までに応答がないリクエストは打ち切り、その行をエラーとして次の組み合わせに進みます（エラーの行は後から再生成できます）"
+            )
+            st.checkbox(
+                "🪁 遅いリクエストを追加で送る（ヘッジ）",
+                value=bool(request_settings["hedge"]),
+                key="hedge_enabled",
+                help=f"所要時間がそのモデルの通常の{request_settings['hedge_percentile']}パーセンタイルを超えたら同じリクエストをもう1件送り、先に返った方を使います（もう一方は取り消します）。"
+                     f"各モデルで{request_settings['hedge_min_samples']}回以上呼び出した後に有効になります。"
+            )
         
         # ===============================
         # 3. 出力設定タブ
@@ -623,6 +2430,17 @@ if vertex_ai_project_id:
                 step=1,
                 help="サマリの文字数を指定してください"
             )
+            
+            length_tolerance = st.slider(
+                "📐 文字数許容誤差（%）",
+                min_value=0,
+                max_value=100,
+                value=30,
+                step=5,
+                help="指定文字数からのずれがこの割合を超えた回答を文字数不一致とみなします（文字数チェック・カスケードモードの判定に使用）"
+            )
+    
+    profile_checkpoint(rerun_profiler, "サイドバー（プリセット・AI設定・キーワードCSV）")
     
     # ===============================
     # メイン領域
@@ -647,8 +2465,10 @@ if vertex_ai_project_id:
 ## 🚀 クイックスタート
 
 ### 1. 初期設定
-1. **キーワードCSVのアップロード**（サイドバーの「🎯 プリセット」タブ内）
-   - ハウスキーワード.csvなどのCSVファイルをアップロード
+1. **キーワードCSVの準備**（サイドバーの「🎯 プリセット」タブ内）
+   - サーバーに置いた「〜キーワード.csv」は自動で読み込まれます（場所はconfig.tomlの[keywords] directory・patternで変更可能）
+   - サーバーのファイルが更新されると、画面に「最新版を読み込む」が表示されます
+   - ハウスキーワード.csvなどのCSVファイルをアップロードすると、同じカテゴリはアップロードした内容が優先されます
    - 複数のファイルを同時にアップロード可能
 
 2. **システムプロンプトの入力**
@@ -663,12 +2483,21 @@ if vertex_ai_project_id:
 2. **キーワードの選択**
    - 各カテゴリからキーワードを選択
    - 「すべて」を選ぶと全組み合わせを生成
+   - 「すべて」の展開方法で、キーワードの2つ組（3つ組）を網羅する最小限に近い組み合わせや、指定件数の層化ランダムサンプルに絞り込み可能（生成時に網羅率を表示）
+   - 「入れ替えても同じ内容とみなすカテゴリ」を選ぶと、同じカテゴリのキーワードを入れ替えただけの組み合わせ（例：あなたの牡羊座×あの人の牡牛座 と あなたの牡牛座×あの人の牡羊座）を1回だけ生成し、同じ回答を両方の行に出力
+   - 「🧾 プロンプトに含めるキーワード列・要約」で、カテゴリごとにプロンプトへ含める列を選択（プリセットに保存）。長い説明文は一度だけ要約してキャッシュし、以降の実行で再利用
+   - 同じキーワードを「あなた」「あの人」の両方で使う場合、キーワード情報はプロンプトに1回だけ含まれます
    - 「あなた」「あの人」「相性」で対象を指定
 
 3. **占いの生成**
    - 「🚀 占い回答を生成」ボタンをクリック
    - 結果はCSVファイルでダウンロード可能
 
+4. **差分実行**
+   - 結果CSVと一緒にマニフェスト（組み合わせごとの入力ハッシュ）をダウンロード
+   - 次回「♻️ 差分実行」に両方をアップロードすると、プリセット・キーワード・質問・モデル設定が変わった組み合わせと新しい組み合わせだけを生成
+   - 変更のない行は前回の結果をそのまま引き継ぎます
+
 ## 🎯 プリセット機能
 
 ### プリセットの作成
@@ -690,10 +2519,75 @@ if vertex_ai_project_id:
 - **gemini-2.5-flash**：バランス型（思考機能付き）
 - **gemini-2.5-pro**：高精度（思考機能付き）
 
+### カスケードモード
+高速なモデル（gemini-2.0-flashなど）で最初に生成し、以下の場合のみ上位モデルで再生成します。
+- JSON解析に失敗した場合
+- 回答が空の場合
+- 回答・サマリの文字数が許容誤差（「📄 出力」タブで設定）を超えた場合
+- 最大出力トークン数を2倍にして再試行しても、出力が途中で打ち切られた場合
+
+各行を生成したモデルは出力CSVの「生成モデル」列に記録されます。
+Thinking Budgetはチェーン内のGemini 2.5のモデルごとに設定します。エスカレーション率はエラーで終わった組み合わせを除いて計算します。
+
 ### Thinking Budget（思考トークン）
 Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指定できます。
 値が大きいほどより深い思考が可能です。
 
+### リクエストの期限・ヘッジ
+- **1リクエストの期限**：期限までに応答がないリクエストを打ち切り、その行をエラーにして次に進みます（止まったリクエストで実行全体が止まらなくなります）
+- **ヘッジ**：所要時間がモデルの通常の所要時間（既定は95パーセンタイル）を超えたリクエストには同じリクエストをもう1件送り、先に返った方を使います。追加で送った件数・取り消した件数と、余分に使ったトークンは結果のトークン使用量サマリーの下に表示されます（取り消した呼び出しの使用量は返ってこないため、計測できた下限と推定値を並べて表示します）
+- 既定値はconfig.tomlの[requests]（timeout_seconds、hedge、hedge_percentile、hedge_min_samples）で変更できます
+
+### ベンチマーク（管理者のみ）
+「🧪 モデル×Thinking Budget ベンチマーク」で、現在の質問・キーワード設定から固定のサンプルを抽出し、モデルとThinking Budgetの設定ごとに比較できます。
+- レイテンシ（p50/p90/p99）、入力・出力・思考・キャッシュのトークン数、JSON有効率、文字数適合率を一覧表示
+- レイテンシSLOと品質の条件を満たす設定のうち、最も安い設定に⭐を表示（料金はconfig.tomlの[pricing."モデル名"]で設定）
+- 記録ファイルをダウンロードしておくと、同じサンプルをAPIを呼ばずに再生できます
+
+### 複数のエンドポイントへの振り分け
+Secretsまたはconfig.tomlの`[[api.endpoints]]`に、プロジェクト（project）・リージョン（location）・認証情報のセクション名（credentials）・重み（weight）を複数設定すると、リクエストを重みに応じて順番に振り分けます。
+- 429・5xxを続けて返したエンドポイントは一時的に遮断し、そのリクエストは別のエンドポイントで再送します
+- エンドポイント別のリクエスト数・トークン数はトークン使用量サマリーに表示されます
+
+### 配信用ストア（管理者のみ）
+結果の「🚀 配信用ストアに公開」で、エラー以外の行を (質問ID, キーワードの組み合わせ) で引ける読み取り専用のファイル（既定はapp.pyと同じ場所のfortune_store.bin、config.tomlの[serving] pathで変更可能）に変換して公開します。
+- 配信側は`fortune_store.ServingStore(パス).lookup(質問ID, [(対象, カテゴリ, キーワード), ...])`で参照します（キーワードの順番は問いません）
+- 公開し直すとファイルはアトミックに置き換わり、配信側は次の参照から新しいストアに切り替わります
+- `python fortune_store.py lookup ストア 質問ID 対象:カテゴリ:キーワード ...`で1件を確認できます
+
+### HTTP API
+1件ずつ占いを生成するHTTP APIを、アプリとは別のプロセスとして`python fortune_api.py [config.tomlのパス]`で起動します（config.tomlの`[api_server]`で`enabled = true`の場合のみ、既定は http://127.0.0.1:8765）。
+- `POST /fortune`に`{"question": "質問", "keywords": [{"category": "カテゴリ", "keyword": "キーワード", "target": "あなた"}], "preset": "プリセット名"}`を送ると、回答・サマリなどをJSONで返します（model・thinking_budget・answer_length・summary_lengthも指定可能）
+- キーワードはサーバー側のキーワードCSV、プリセットは`presets_path`に置いたエクスポート済みのJSONを起動時に読み込みます（更新した場合は再起動してください）
+- Vertex AIのプロジェクト・認証情報はアプリと同じSecrets（.streamlit/secrets.toml）・環境変数・config.tomlから読み込みます（[[api.endpoints]]の振り分けは使いません）
+- 同じリクエストは一定時間キャッシュから返し、同時に来た同じリクエストはモデルを1回だけ呼び出します
+- `token`を設定すると`Authorization: Bearer トークン`が必要になります。`backend = "fake"`でモデルを呼ばずに疑似の回答を返します
+- モデル呼び出しはAPIサーバーのリクエストキュー（[scheduler]の設定、ロール「api」）で順番を待ち、トークン使用量はアプリと同じ台帳に記録されます
+- `GET /health`でリクエスト数・キャッシュのヒット数などを確認できます
+
+### プロファイル（管理者のみ）
+「⏱️ プロファイル」でプロファイルモードをオンにすると、画面の再実行ごとのセクション別の所要時間と、生成ジョブの区間別（組み合わせ展開・プロンプト構築・API呼び出し・JSON解析・結果テーブル作成・アーカイブ保存など）の所要時間を表示します。
+「生成ジョブをcProfileで記録」をオンにすると、関数ごとの記録（.prof）をダウンロードできます。
+プリセットのファイル操作・選択、結果表示、キーワード参照は、その中の操作ではそのセクションだけを再実行します（ルール・トンマナ、AI設定・出力設定・質問入力・キーワード選択は、見積もりなど画面の他の部分に反映するため画面全体を再実行します）。
+
+### リクエストキュー
+全セッションのモデル呼び出しは共有のキューで順番に処理されます。
+- 同時リクエスト数は全体・ロールごとに制限され、実行中のジョブ間で公平に割り当てられます（大量生成中でも単発の質問はすぐに処理されます）
+- ロールごとに1日のトークン上限と、1ジョブあたりのトークン上限を設定できます（config.tomlの[scheduler]）
+- 上限に達すると生成はその時点で止まり、生成済みの行だけが結果になります。マニフェストと結果CSVを保存しておけば「♻️ 差分実行」で残りから再開できます
+- 管理者は「🚦 リクエストキュー」で待機数・実行中のジョブ・本日の使用量を確認できます
+
+### トークン使用量台帳（管理者のみ）
+生成・再生成・ベンチマークの実行ごとに、ロール・モデル・Thinking Budget・プリセット・行数・トークン数・所要時間を台帳（SQLite）に記録します。
+「📒 トークン使用量台帳」で期間と集計単位（日付・モデル・プリセットなど）を選んで集計し、CSVでダウンロードできます。
+
+### 生成結果アーカイブ
+生成・再生成した行は実行ごとにアーカイブ（SQLite）に保存され、「🗄️ 生成結果アーカイブ」で過去の実行をまとめて検索できます。
+- 全文検索は質問・回答・サマリ・キーワード列が対象で、空白で区切った語をすべて含む行に絞り込みます（全角・半角は区別しません）
+- キーワード欄はキーワード列だけを、ID欄はIDの完全一致で検索します
+- 一致したすべての行を、出力CSVと同じ形式で書き出せます
+- 以前にダウンロードした結果CSVも取り込めます（保存先はconfig.tomlの[archive] pathで変更可能）
+
 ## 📄 入力モードの詳細
 
 ### テキスト入力
@@ -704,16 +2598,28 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
 - A列：ID、B列：質問
 - C列以降：カテゴリ、キーワード、対象の3列セット
 - 各質問を独立して処理
+- カテゴリ名・キーワード名は全角／半角の違いを区別せずに照合されます
+- カテゴリ名には別名も使用可能（例：星座→サイン、惑星→天体。config.tomlの[keyword_aliases]で追加可能）
 
 ### CSV連続モード
 - A列：ID、B列：質問
 - 複数の質問を関連付けて処理
 - 例：性格→恋愛→仕事→人生のテーマ
+- 回答はIDで対応付けられ、一部が壊れたレスポンスからも正しい形式の回答は救出されます
+- 回答が欠けたIDだけを、回答済みの内容を参考として再リクエストします
 
 ## 📦 出力設定
 
 - **回答文字数**：50〜2000文字
 - **サマリ文字数**：20〜500文字
+- **文字数許容誤差**：指定文字数からのずれの許容範囲（%）
+
+生成後の「文字数チェック」で回答・サマリの文字数分布と範囲外の行を確認できます。
+「🔁 文字数不一致の行のみ再生成」で範囲外の行だけを再実行し、結果の同じ位置に反映します。
+「類似回答チェック」では、別のキーワードの組み合わせなのにほぼ同じになった回答をまとめて表示します。「🔁 似た回答の行を再生成」で、各まとまりの先頭の回答と似ないよう指示して残りの行を再実行できます。
+結果プレビューはID・キーワード・対象・状態（エラー／文字数範囲外など）で絞り込み、ページ単位で表示します。長い回答・サマリは省略表示され、行を選ぶと全文を確認できます。
+最大出力トークン数は指定文字数から自動で設定されます。
+システムプロンプト・ルール・トンマナ・出力形式は固定の指示（system instruction）として送り、本文はキーワード情報→質問の順に並べるため、共通部分がキャッシュされやすくなります。キャッシュされた入力トークン数はトークン使用量サマリーに表示されます。
 
 ## 📊 出力フォーマット
 
@@ -728,10 +2634,11 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
 - サマリ
 - 元キーワード
 - アレンジキーワード
+- 生成モデル
 
 ## ⚠️ 注意事項
 
-- キーワードCSVは事前にアップロードが必要
+- キーワードCSVはサーバーに置くか、事前にアップロードが必要
 - 大量の組み合わせを生成すると時間がかかる場合があります
 - APIの利用制限に注意してください
 
@@ -800,74 +2707,38 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
         )
         
         if uploaded_file is not None:
+            status_slot = st.empty()
+            info_slot = st.empty()
+            preview_slot = st.empty()
             try:
-                # CSVファイルを読み込み
-                df_questions = pd.read_csv(uploaded_file, encoding='utf-8')
+                # CSVファイルをチャンク単位で読み込み（先頭のプレビューを先に表示）
+                with profile_stage(rerun_profiler, "質問CSVの解析"):
+                    parsed = load_question_csv(uploaded_file, True, preview_slot)
                 
-                # A列（ID）とB列（質問）を取得
-                if len(df_questions.columns) >= 2:
-                    id_column = df_questions.iloc[:, 0]  # A列（ID）
-                    questions_column = df_questions.iloc[:, 1]  # B列（質問）
-                    
-                    # IDと質問のペアを作成
-                    questions_list = []
-                    id_list = []
-                    csv_keywords_list = []  # CSVから読み込んだキーワード情報
-                    
-                    for idx in range(len(df_questions)):
-                        if pd.notna(questions_column.iloc[idx]) and str(questions_column.iloc[idx]).strip():
-                            questions_list.append(str(questions_column.iloc[idx]))
-                            # IDがない場合は行番号を使用
-                            id_value = str(id_column.iloc[idx]) if pd.notna(id_column.iloc[idx]) else f"row_{idx+1}"
-                            id_list.append(id_value)
-                            
-                            # C列以降のキーワード情報を読み取り（最大4カテゴリ）
-                            row_keywords = []
-                            for i in range(4):  # 最大4カテゴリ
-                                cat_col = 2 + i * 3  # C列, F列, I列, L列（カテゴリ）
-                                key_col = 3 + i * 3  # D列, G列, J列, M列（キーワード）
-                                who_col = 4 + i * 3  # E列, H列, K列, N列（対象）
-                                
-                                if cat_col < len(df_questions.columns) and key_col < len(df_questions.columns):
-                                    category = df_questions.iloc[idx, cat_col]
-                                    keyword = df_questions.iloc[idx, key_col]
-                                    # 対象列がある場合は読み取り、なければデフォルトで「あなた」
-                                    who = df_questions.iloc[idx, who_col] if who_col < len(df_questions.columns) else "あなた"
-                                    
-                                    if pd.notna(category) and pd.notna(keyword):
-                                        who_str = str(who).strip() if pd.notna(who) else "あなた"
-                                        # 対象の検証
-                                        if who_str not in ["あなた", "あの人", "相性"]:
-                                            who_str = "あなた"  # 無効な値の場合はデフォルト
-                                        row_keywords.append((str(category).strip(), str(keyword).strip(), who_str))
-                            
-                            csv_keywords_list.append(row_keywords)
+                # A列（ID）とB列（質問）が必要
+                if parsed is not None:
+                    id_list, questions_list, csv_keywords_list = parsed
                     
                     if questions_list:
-                        st.success(f"✅ {len(questions_list)}個の質問を読み込みました")
+                        status_slot.success(f"✅ {len(questions_list)}個の質問を読み込みました")
                         
                         # キーワード指定の有無を確認
                         has_keywords = any(len(kw) > 0 for kw in csv_keywords_list)
                         if has_keywords:
-                            st.info("📋 CSVファイルにキーワード指定が含まれています（CSV優先モード）")
+                            info_slot.info("📋 CSVファイルにキーワード指定が含まれています（CSV優先モード）")
                         
                         # プレビュー表示
-                        with st.expander("質問プレビュー", expanded=False):
-                            for i, (q_id, q, kws) in enumerate(zip(id_list[:5], questions_list[:5], csv_keywords_list[:5]), 1):  # 最初の5個のみ表示
-                                preview_text = f"{i}. ID: {q_id} - {q}"
-                                if kws:
-                                    kw_text = ", ".join([f"{who}の{cat}:{kw}" for cat, kw, who in kws])
-                                    preview_text += f" [キーワード: {kw_text}]"
-                                st.text(preview_text)
-                            if len(questions_list) > 5:
-                                st.text(f"... 他 {len(questions_list) - 5} 個")
+                        show_question_preview(preview_slot, id_list, questions_list, csv_keywords_list, len(questions_list))
                     else:
-                        st.warning("有効な質問が見つかりませんでした")
+                        preview_slot.empty()
+                        status_slot.warning("有効な質問が見つかりませんでした")
                 else:
-                    st.error("CSVファイルに2列以上必要です（A列: ID, B列: 質問）")
+                    preview_slot.empty()
+                    status_slot.error("CSVファイルに2列以上必要です（A列: ID, B列: 質問）")
                     
             except Exception as e:
-                st.error(f"CSVファイルの読み込みに失敗しました: {str(e)}")
+                preview_slot.empty()
+                status_slot.error(f"CSVファイルの読み込みに失敗しました: {str(e)}")
         else:
             st.info("CSVファイルをアップロードしてください")
     else:  # CSV連続モード
@@ -881,50 +2752,62 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
         )
         
         if uploaded_file is not None:
+            status_slot = st.empty()
+            preview_slot = st.empty()
             try:
-                # CSVファイルを読み込み
-                df_questions = pd.read_csv(uploaded_file, encoding='utf-8')
+                # CSVファイルをチャンク単位で読み込み（先頭のプレビューを先に表示）
+                with profile_stage(rerun_profiler, "質問CSVの解析"):
+                    parsed = load_question_csv(uploaded_file, False, preview_slot)
                 
-                # A列（ID）とB列（質問）を取得
-                if len(df_questions.columns) >= 2:
-                    id_column = df_questions.iloc[:, 0]  # A列（ID）
-                    questions_column = df_questions.iloc[:, 1]  # B列（質問）
-                    
-                    # IDと質問のペアを作成
-                    questions_list = []
-                    id_list = []
-                    
-                    for idx in range(len(df_questions)):
-                        if pd.notna(questions_column.iloc[idx]) and str(questions_column.iloc[idx]).strip():
-                            questions_list.append(str(questions_column.iloc[idx]))
-                            # IDがない場合は行番号を使用
-                            id_value = str(id_column.iloc[idx]) if pd.notna(id_column.iloc[idx]) else f"row_{idx+1}"
-                            id_list.append(id_value)
+                # A列（ID）とB列（質問）が必要
+                if parsed is not None:
+                    id_list, questions_list, _ = parsed
                     
                     if questions_list:
-                        st.success(f"✅ {len(questions_list)}個の質問を読み込みました（連続処理モード）")
+                        status_slot.success(f"✅ {len(questions_list)}個の質問を読み込みました（連続処理モード）")
                         
                         # プレビュー表示
-                        with st.expander("質問プレビュー", expanded=False):
-                            for i, (q_id, q) in enumerate(zip(id_list[:5], questions_list[:5]), 1):  # 最初の5個のみ表示
-                                st.text(f"{i}. ID: {q_id} - {q}")
-                            if len(questions_list) > 5:
-                                st.text(f"... 他 {len(questions_list) - 5} 個")
+                        show_question_preview(preview_slot, id_list, questions_list, None, len(questions_list))
                     else:
-                        st.warning("有効な質問が見つかりませんでした")
+                        preview_slot.empty()
+                        status_slot.warning("有効な質問が見つかりませんでした")
                 else:
-                    st.error("CSVファイルに2列以上必要です（A列: ID, B列: 質問）")
+                    preview_slot.empty()
+                    status_slot.error("CSVファイルに2列以上必要です（A列: ID, B列: 質問）")
                     
             except Exception as e:
-                st.error(f"CSVファイルの読み込みに失敗しました: {str(e)}")
+                preview_slot.empty()
+                status_slot.error(f"CSVファイルの読み込みに失敗しました: {str(e)}")
         else:
             st.info("CSVファイルをアップロードしてください")
     
+    profile_checkpoint(rerun_profiler, "質問入力（質問CSVの解析を含む）")
+    
     # ===============================
     # 4. キーワード設定セクション
     # ===============================
     st.subheader("🔍 キーワード設定")
     
+    # サーバー側のキーワードCSVが更新された場合は、このセッションに反映するか確認する
+    if server_keywords["version"] != st.session_state.get("server_keyword_version"):
+        server_categories = set(st.session_state.get("server_keyword_categories", []))
+        updated_categories = [
+            category_name for category_name, keyword_table in server_keywords["tables"].items()
+            if category_name not in st.session_state.custom_keywords
+            or (category_name in server_categories and st.session_state.custom_keywords[category_name] is not keyword_table)
+        ] + sorted(server_categories - set(server_keywords["tables"]))
+        if not updated_categories:
+            # 更新されたのがアップロードしたカテゴリだけなど、このセッションのキーワードが変わらない場合は通知せずに版だけ進める
+            apply_server_keywords(st.session_state, server_keywords)
+        else:
+            col_notice, col_reload = st.columns([3, 1])
+            with col_notice:
+                st.info(f"🔄 サーバーのキーワードCSVが更新されました（{'、'.join(updated_categories)}）。最新版を読み込むと、このセッションのキーワードが置き換わります。")
+            with col_reload:
+                if st.button("最新版を読み込む", use_container_width=True):
+                    apply_server_keywords(st.session_state, server_keywords)
+                    st.rerun()
+    
     # セッション状態でカテゴリリストを管理
     if 'keyword_categories' not in st.session_state:
         # カスタムキーワードがある場合は最初のカテゴリを設定
@@ -953,6 +2836,7 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
     if st.session_state.custom_keywords:
         category_types = list(st.session_state.custom_keywords.keys())
         keywords = st.session_state.custom_keywords
+        keyword_index = get_keyword_index(keywords)
     else:
         st.error("キーワードCSVファイルをアップロードしてください。")
         st.stop()
@@ -1013,9 +2897,7 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
                             # キーワード選択
                             if category_type in keywords:
                                 # キーワードリストを作成（1列目の値 + "すべて"）
-                                keyword_data = keywords[category_type]["data"]
-                                first_column = keywords[category_type]["columns"][0] if keywords[category_type]["columns"] else "name"
-                                keyword_list = ["すべて"] + [item[first_column] for item in keyword_data if first_column in item]
+                                keyword_list = get_keyword_options(keyword_index, category_type)
                                 
                                 selected_value = st.selectbox(
                                     "キーワード",
@@ -1035,14 +2917,170 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
                         selected_values.append(selected_value)
                         selected_who.append(who_for)
     
+    # 「すべて」の展開方法
+    col_expansion, col_sample_size = st.columns([2, 1])
+    with col_expansion:
+        expansion_mode = st.selectbox(
+            "「すべて」の展開方法",
+            expansion_modes,
+            key="expansion_mode",
+            help="ペアワイズ／3つ組：キーワードの2つ組（3つ組）がすべて1回以上現れる最小限に近い組み合わせだけを生成します。層化ランダムサンプル：各キーワードがほぼ均等に現れるよう指定件数を抽出します。"
+        )
+    with col_sample_size:
+        expansion_sample_size = st.number_input(
+            "サンプル数",
+            min_value=1,
+            value=100,
+            key="expansion_sample_size",
+            disabled=expansion_mode != "層化ランダムサンプル"
+        )
+    keyword_expansion = {"mode": expansion_mode, "sample_size": int(expansion_sample_size), "seed": 0}
+    
+    # 同じカテゴリを複数選んだ場合の対称な組み合わせの統合
+    symmetric_categories = st.multiselect(
+        "入れ替えても同じ内容とみなすカテゴリ",
+        category_types,
+        default=[category for category in default_symmetric_categories if category in category_types],
+        key="symmetric_categories",
+        help="同じカテゴリが複数ある場合（例：あなたのサイン×あの人のサイン）、キーワードを入れ替えただけの組み合わせは1回だけ生成し、同じ回答をそれぞれの行に出力します。"
+    )
+    
+    # プロンプトに含めるキーワード列と長い説明文の要約
+    if 'condense_limit' not in st.session_state:
+        st.session_state.condense_limit = 0
+    with st.expander("🧾 プロンプトに含めるキーワード列・要約", expanded=False):
+        st.caption("カテゴリごとにプロンプトへ含める列を選べます（プリセットに保存されます）。上限を超える長い説明文は一度だけ要約してキャッシュし、以降の実行で再利用します。")
+        keyword_columns = {}
+        for category_name, keyword_table in keywords.items():
+            column_key = f"prompt_columns_{category_name}"
+            available_columns = keyword_table["columns"][1:]
+            # 未設定、またはCSVの列が変わった場合はすべての列を選択
+            if column_key not in st.session_state or not set(st.session_state[column_key]) <= set(available_columns):
+                st.session_state[column_key] = list(available_columns)
+            keyword_columns[category_name] = st.multiselect(f"{category_name}の列", available_columns, key=column_key)
+        
+        condense_limit = st.number_input("要約する文字数上限（0で要約しない）", min_value=0, max_value=1000, step=10, key="condense_limit")
+        condensed_texts = {}
+        # 説明文の集計・要約キャッシュの参照はキーワード・列・上限が変わった時だけ行う
+        keyword_settings_key = (
+            get_keyword_signature(keywords), tuple((name, tuple(columns)) for name, columns in keyword_columns.items()), condense_limit
+        )
+        if condense_limit:
+            def find_condensed_texts():
+                texts = collect_long_keyword_texts(keywords, keyword_columns, condense_limit)
+                return texts, load_condensed_texts(texts, condense_limit, condense_cache_path)
+            
+            long_texts, condensed_texts = memoize_in_session("condensed_texts", keyword_settings_key, find_condensed_texts)
+            st.caption(f"上限を超える説明文 {len(long_texts):,}件中 {len(condensed_texts):,}件が要約済みです（未要約の文はそのまま使用します）")
+            
+            if len(condensed_texts) < len(long_texts) and st.button("✂️ 未要約の説明文を要約", help=f"{selected_model}で要約し、キャッシュに保存します"):
+                condense_client = create_vertex_client(selected_model) if NEW_SDK else None
+                if not condense_client:
+                    st.error("Vertex AIクライアントの初期化に失敗しました")
+                else:
+                    pending_count = len(long_texts) - len(condensed_texts)
+                    condense_client = schedule_client(condense_client, f"要約 {pending_count:,}件", pending_count)
+                    condense_started_at = time.perf_counter()
+                    condense_progress = st.progress(0)
+                    try:
+                        condense_usage = condense_keyword_texts(
+                            condense_client, selected_model, long_texts, condense_limit,
+                            progress_callback=lambda done, total: condense_progress.progress(done / total)
+                        )
+                    except QuotaExceededError as e:
+                        # 要約できた分はキャッシュに保存済み
+                        condense_usage = None
+                        clear_session_memo("condensed_texts", "keyword_chars")
+                        st.error(f"⛔ {e}。要約を途中で止めました（要約済みの説明文はキャッシュに保存されています）")
+                    finally:
+                        condense_client.finish()
+                    if condense_usage is not None:
+                        record_token_usage(
+                            "要約",
+                            {"model_chain": [selected_model], "cascade_enabled": False, "thinking_budget": 0,
+                             "preset_name": st.session_state.get("selected_preset"), "input_mode": input_mode},
+                            pending_count, pending_count, condense_usage, time.perf_counter() - condense_started_at
+                        )
+                        clear_session_memo("condensed_texts", "keyword_chars")
+                        st.rerun()
+        
+        # キーワード情報の文字数（全キーワードの合計）の比較
+        full_chars, selected_chars = memoize_in_session(
+            "keyword_chars", keyword_settings_key + (len(condensed_texts),),
+            lambda: (
+                sum(len(text) for keyword_table in keywords.values() for col in keyword_table["columns"][1:] for text in keyword_table["values"][col]),
+                sum(
+                    len(condensed_texts.get(text, text))
+                    for category_name, keyword_table in keywords.items()
+                    for col in keyword_columns[category_name]
+                    for text in keyword_table["values"][col]
+                )
+            )
+        )
+        st.caption(f"キーワード情報の文字数（全キーワード合計）: すべての列 {full_chars:,}文字 → 選択・要約後 {selected_chars:,}文字")
+    
     # CSVファイル名設定の初期化
     if 'custom_filename' not in st.session_state:
         st.session_state.custom_filename = "占い結果"
     
+    profile_checkpoint(rerun_profiler, "キーワード設定")
+    
     # ===============================
     # 2. 実行ボタン
     # ===============================
     st.markdown("---")
+    
+    # 差分実行（前回のマニフェストと出力CSVを使って変更分のみ生成）
+    previous_manifest = None
+    previous_results = None
+    with st.expander("♻️ 差分実行（前回の結果を再利用）", expanded=False):
+        st.caption("前回の実行で保存したマニフェストと結果CSVをアップロードすると、入力（プロンプト・モデル・設定）が変わった組み合わせと新しい組み合わせだけを生成し、それ以外は前回の行をそのまま引き継ぎます。")
+        col_manifest, col_previous = st.columns(2)
+        with col_manifest:
+            uploaded_manifest = st.file_uploader("前回のマニフェスト（JSON）", type=['json'], key="previous_manifest_upload")
+        with col_previous:
+            uploaded_previous_csv = st.file_uploader("前回の結果CSV", type=['csv'], key="previous_results_upload")
+        
+        if uploaded_manifest is not None and uploaded_previous_csv is not None:
+            try:
+                # 同じアップロードは再実行のたびに解析し直さない
+                # 前回の行をそのまま引き継ぐため、全列を文字列として読み込む
+                previous_manifest, previous_results = memoize_in_session(
+                    "previous_run", (uploaded_manifest.file_id, uploaded_previous_csv.file_id),
+                    lambda: (
+                        json.loads(uploaded_manifest.getvalue().decode('utf-8')),
+                        index_previous_results(pd.read_csv(uploaded_previous_csv, encoding='utf-8-sig', dtype=str, keep_default_na=False))
+                    )
+                )
+                st.success(f"✅ 前回のマニフェスト（{len(previous_manifest.get('entries', {}))}件）と結果（{len(previous_results)}行）を読み込みました")
+            except Exception as e:
+                previous_manifest = None
+                previous_results = None
+                st.error(f"前回の結果の読み込みに失敗しました: {str(e)}")
+        elif uploaded_manifest is not None or uploaded_previous_csv is not None:
+            st.info("マニフェストと結果CSVの両方をアップロードしてください")
+    
+    # 生成設定（再生成・ベンチマークでも同じ設定を使用する）
+    generation_settings = {
+        "system_prompt": system_prompt,
+        "user_rules": st.session_state.get('preset_user_rules_input', ''),
+        "user_tone": st.session_state.get('preset_user_tone_input', ''),
+        "selected_categories": list(selected_categories),
+        "id_list": list(id_list),
+        "model_chain": list(model_chain),
+        "cascade_enabled": cascade_enabled,
+        "thinking_budget": thinking_budget,
+        "thinking_budgets": thinking_budgets,
+        "answer_length": answer_length,
+        "summary_length": summary_length,
+        "length_tolerance": length_tolerance,
+        "preset_name": st.session_state.get("selected_preset"),
+        "input_mode": input_mode,
+        "symmetric_categories": list(symmetric_categories),
+        "keyword_columns": keyword_columns,
+        "condensed_texts": condensed_texts
+    }
+    
     if st.button("🚀 占い回答を生成", type="primary", use_container_width=True):
         if not system_prompt:
             st.error("システムプロンプトを入力してください")
@@ -1052,184 +3090,65 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
             else:
                 st.error("CSVファイルをアップロードして質問を読み込んでください")
         else:
+            # プロファイルモードでは生成ジョブの区間ごとの所要時間を計測する（指定した場合はcProfileも記録する）
+            job_started_at = time.perf_counter()
+            job_profiler = StageProfiler() if rerun_profiler else None
+            job_cprofile = None
+            if job_profiler and st.session_state.get("profiling_cprofile"):
+                job_cprofile = cProfile.Profile()
+                try:
+                    job_cprofile.enable()
+                except ValueError:
+                    # 他のプロファイラが動いている場合は記録しない
+                    job_cprofile = None
+            
             # 組み合わせ生成
-            keyword_combinations = []
-            who_combinations = []  # 誰の情報の組み合わせ
-            
-            # 各カテゴリの値リストを作成
-            value_lists = []
-            who_lists = []  # 誰の情報のリスト
-            for idx, (category_type, selected_value, selected_who_value) in enumerate(zip(selected_categories, selected_values, selected_who)):
-                if selected_value == "すべて":
-                    # カスタムキーワードモード
-                    if category_type in keywords:
-                        keyword_data = keywords[category_type]["data"]
-                        first_column = keywords[category_type]["columns"][0] if keywords[category_type]["columns"] else "name"
-                        all_values = [item[first_column] for item in keyword_data if first_column in item]
-                        value_lists.append(all_values)
-                    else:
-                        value_lists.append([selected_value])
-                    # 「すべて」の場合でも誰の情報は固定
-                    who_lists.append([selected_who_value] * len(value_lists[-1]))
-                else:
-                    value_lists.append([selected_value])
-                    who_lists.append([selected_who_value])
-            
-            # キーワードの組み合わせ生成（動的に対応）
-            if value_lists:
-                for combination in itertools.product(*value_lists):
-                    keyword_combinations.append(combination)
-                # 誰の情報も同じ形で組み合わせを作成
-                # ただし、「すべて」の場合は特別処理が必要
-                who_combinations = [[selected_who[i] for i in range(len(selected_who))] for _ in keyword_combinations]
-            
-            # 質問×キーワードの全組み合わせを生成（IDも含める）
-            total_combinations = []
-            
-            # CSV入力でキーワード指定がある場合の処理
-            if input_mode == "CSVファイル入力" and csv_keywords_list and any(len(kw) > 0 for kw in csv_keywords_list):
-                # CSVのキーワード指定を優先
-                has_validation_error = False
-                validation_errors = []
-                
-                for i, question in enumerate(questions_list):
-                    question_id = id_list[i] if i < len(id_list) else f"auto_{i+1}"
-                    csv_keywords = csv_keywords_list[i] if i < len(csv_keywords_list) else []
-                    
-                    if csv_keywords:  # CSVにキーワード指定がある場合
-                        # CSVのキーワードを検証して組み合わせを作成
-                        validated_keywords = []
-                        error_keywords = []
-                        
-                        for cat_name, kw_name, who_name in csv_keywords:
-                            # カテゴリ名の検証と正規化
-                            valid_category = None
-                            valid_keyword = None
-                            
-                            # カテゴリ名のマッチング
-                            if cat_name in category_types:
-                                valid_category = cat_name
-                            else:
-                                # 部分一致や大文字小文字を無視してマッチング
-                                for ct in category_types:
-                                    if cat_name.lower() in ct.lower() or ct.lower() in cat_name.lower():
-                                        valid_category = ct
-                                        break
-                            
-                            if valid_category:
-                                # キーワードの検証
-                                if valid_category in keywords:
-                                    keyword_data = keywords[valid_category]["data"]
-                                    first_column = keywords[valid_category]["columns"][0] if keywords[valid_category]["columns"] else "name"
-                                    valid_keywords_list = [item[first_column] for item in keyword_data if first_column in item]
-                                    
-                                    # 全角数字を半角数字に変換する関数
-                                    def normalize_numbers(text):
-                                        # 全角数字を半角に変換
-                                        trans_table = str.maketrans('０１２３４５６７８９', '0123456789')
-                                        return text.translate(trans_table)
-                                    
-                                    # キーワード名を正規化
-                                    normalized_kw_name = normalize_numbers(kw_name)
-                                    
-                                    # キーワードリストも正規化して比較
-                                    normalized_keywords_list = [normalize_numbers(kw) for kw in valid_keywords_list]
-                                    
-                                    # 正規化した値で検索
-                                    if normalized_kw_name in normalized_keywords_list:
-                                        # 元のリストから一致するものを探す
-                                        idx = normalized_keywords_list.index(normalized_kw_name)
-                                        valid_keyword = valid_keywords_list[idx]
-                                    elif kw_name.lower() == "すべて" or kw_name.lower() == "all":
-                                        valid_keyword = "すべて"
-                                else:
-                                    # カテゴリが存在しない場合
-                                    valid_keyword = None
-                            
-                            # 対象（誰の）の検証
-                            valid_who = who_name if who_name in ["あなた", "あの人", "相性"] else "あなた"
-                            
-                            if valid_category and valid_keyword:
-                                validated_keywords.append((valid_category, valid_keyword, valid_who))
-                            else:
-                                error_keywords.append(f"{cat_name}:{kw_name}")
-                        
-                        if error_keywords:
-                            error_msg = f"ID: {question_id} - 無効なキーワード指定: {', '.join(error_keywords)}"
-                            validation_errors.append(error_msg)
-                            has_validation_error = True
-                        
-                        if validated_keywords:
-                            # 「すべて」を展開する必要があるかチェック
-                            expanded_keywords_list = []
-                            has_all_keyword = False
-                            
-                            for cat, kw, who in validated_keywords:
-                                if kw == "すべて":
-                                    has_all_keyword = True
-                                    # カテゴリに応じて展開
-                                    if cat in keywords:
-                                        keyword_data = keywords[cat]["data"]
-                                        first_column = keywords[cat]["columns"][0] if keywords[cat]["columns"] else "name"
-                                        all_keywords = [(cat, item[first_column], who) for item in keyword_data if first_column in item]
-                                        expanded_keywords_list.append(all_keywords)
-                                    else:
-                                        expanded_keywords_list.append([(cat, kw, who)])
-                                else:
-                                    expanded_keywords_list.append([(cat, kw, who)])
-                            
-                            if has_all_keyword:
-                                # 「すべて」が含まれる場合は総当たりで展開
-                                import itertools
-                                for combo in itertools.product(*expanded_keywords_list):
-                                    # comboは各カテゴリから1つずつ選ばれたタプルのリスト
-                                    flattened_combo = list(combo)
-                                    keyword_values = [kw for _, kw, _ in flattened_combo]
-                                    who_values = [who for _, _, who in flattened_combo]
-                                    total_combinations.append((question_id, question, tuple(keyword_values), tuple(who_values), flattened_combo))
-                            else:
-                                # 「すべて」が含まれない場合はそのまま
-                                keyword_values = [kw for _, kw, _ in validated_keywords]
-                                who_values = [who for _, _, who in validated_keywords]
-                                total_combinations.append((question_id, question, tuple(keyword_values), tuple(who_values), validated_keywords))
-                        else:
-                            # 有効なキーワードがない場合もエラーとする
-                            error_msg = f"ID: {question_id} - キーワードが検証できませんでした"
-                            validation_errors.append(error_msg)
-                            has_validation_error = True
-                    else:
-                        # CSVにキーワード指定がない場合は画面設定を使用
-                        for j, keyword_combo in enumerate(keyword_combinations):
-                            who_combo = who_combinations[j] if j < len(who_combinations) else selected_who
-                            total_combinations.append((question_id, question, keyword_combo, tuple(who_combo), None))
-                
-                # エラーがある場合は処理を停止
-                if has_validation_error:
-                    st.error("CSVファイルに無効なキーワードが含まれています。")
-                    for error in validation_errors:
-                        st.error(error)
-                    st.info("アップロードされているキーワードCSVと一致するキーワードのみ使用できます。")
-                    st.stop()
-            else:
-                # テキスト入力、CSV連続モード、またはCSVにキーワード指定がない場合
-                if input_mode == "CSV連続モード" and len(questions_list) > 0:
-                    # CSV連続モード：各キーワードの組み合わせごとに、全質問をまとめて処理
-                    for j, keyword_combo in enumerate(keyword_combinations):
-                        who_combo = who_combinations[j] if j < len(who_combinations) else selected_who
-                        # 質問リスト全体を1つの組み合わせとして追加
-                        total_combinations.append(("batch", questions_list, keyword_combo, tuple(who_combo), None))
-                else:
-                    # 通常モード：各質問×各キーワード組み合わせ
-                    for i, question in enumerate(questions_list):
-                        question_id = id_list[i] if i < len(id_list) else f"auto_{i+1}"
-                        for j, keyword_combo in enumerate(keyword_combinations):
-                            who_combo = who_combinations[j] if j < len(who_combinations) else selected_who
-                            total_combinations.append((question_id, question, keyword_combo, tuple(who_combo), None))
+            with profile_stage(job_profiler, "組み合わせ展開"):
+                keyword_combinations, who_combinations = build_keyword_combinations(selected_categories, selected_values, selected_who, keyword_index, keyword_expansion)
+                total_combinations, validation_errors = build_total_combinations(
+                    input_mode, questions_list, id_list, csv_keywords_list,
+                    keyword_combinations, who_combinations, selected_who, keyword_index, keyword_expansion
+                )
+            
+            # エラーがある場合は処理を停止
+            if validation_errors:
+                st.error("CSVファイルに無効なキーワードが含まれています。")
+                for error in validation_errors:
+                    st.error(error)
+                st.info("アップロードされているキーワードCSVと一致するキーワードのみ使用できます。")
+                if job_cprofile:
+                    job_cprofile.disable()
+                st.stop()
             
             st.info(f"質問数: {len(questions_list)} × キーワード組み合わせ数: {len(keyword_combinations)} = 合計生成数: {len(total_combinations)}")
             
+            # 対称な組み合わせは1回だけ生成する
+            symmetry_keys = None
+            if symmetric_categories:
+                symmetry_keys = [get_symmetry_key(combo, generation_settings, symmetric_categories) for combo in total_combinations]
+                unique_count = len(set(symmetry_keys))
+                if unique_count < len(total_combinations):
+                    st.info(f"🪞 入れ替えただけの組み合わせを統合: {len(total_combinations):,}件 → {unique_count:,}件を生成（{len(total_combinations) - unique_count:,}件は同じ回答を出力）")
+            
+            # 網羅サンプリングの場合は全組み合わせとの比較と網羅率を表示
+            if expansion_mode != expansion_modes[0]:
+                value_lists = get_keyword_value_lists(selected_categories, selected_values, keyword_index)
+                full_count = 1
+                for values in value_lists:
+                    full_count *= len(values)
+                coverage_texts = []
+                for strength, label in [(1, "キーワード"), (2, "2つ組"), (3, "3つ組")]:
+                    if strength <= len(value_lists):
+                        covered, total = measure_combination_coverage(keyword_combinations, value_lists, strength)
+                        coverage_texts.append(f"{label} {covered:,}/{total:,}（{covered / total:.1%}）")
+                st.info(f"🧮 {expansion_mode}: キーワード組み合わせ {len(keyword_combinations):,}件（全組み合わせ {full_count:,}件）| 網羅率: {' / '.join(coverage_texts)}")
+                if expansion_mode == "層化ランダムサンプル" and len(keyword_combinations) < keyword_expansion["sample_size"]:
+                    st.warning(f"⚠️ サンプル数 {keyword_expansion['sample_size']:,}件に対して、作成できた組み合わせは {len(keyword_combinations):,}件です（全組み合わせ数が指定件数より少ないため）")
+            
             # 結果保存用リスト
             results = []
+            row_combo_indices = []  # 各結果行の元になった組み合わせ番号
+            new_row_indices = []  # 今回の実行で作成した行（引き継いだ行はアーカイブ済みのため除く）
             
             # トークン数カウント用
             total_prompt_tokens = 0
@@ -1237,390 +3156,192 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
             total_thoughts_tokens = 0
             total_cached_tokens = 0
             
-            # プログレスバー
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            token_info = st.empty()
+            # カスケードモードの集計用
+            escalated_count = 0
+            checked_count = 0
+            escalation_reasons = {}
+            model_usage_counts = {}
             
-            for i, combo in enumerate(total_combinations):
-                # 新しいデータ構造: (ID, 質問, キーワード, 誰の情報, CSV検証済みキーワード)
-                question_id, current_question, keyword_combination, who_combination, csv_validated_keywords = combo
-                is_csv_mode = csv_validated_keywords is not None
-                is_batch_mode = question_id == "batch"  # CSV連続モードかどうか
-                
-                try:
-                    # キーワード取得（動的カテゴリに対応）
-                    all_keywords = []  # 各カテゴリのキーワードを格納
-                    
-                    if is_csv_mode and csv_validated_keywords:
-                        # CSV優先モード: 検証済みキーワードを使用
-                        for category_type, value, who in csv_validated_keywords:
-                            keyword_dict = {}
-                            
-                            # カテゴリタイプに応じてキーワードを取得
-                            if category_type in keywords:
-                                name_column = keywords[category_type]["columns"][0] if keywords[category_type]["columns"] else "name"
-                                data = next((item for item in keywords[category_type]["data"] if item.get(name_column) == value), None)
-                                if data:
-                                    for col in keywords[category_type]["columns"][1:]:
-                                        if col in data and data[col]:
-                                            keyword_dict[col] = data[col]
-                            
-                            all_keywords.append((category_type, value, who, keyword_dict))
-                    else:
-                        # 通常モード: 画面で選択されたキーワードを使用
-                        for idx, (category_type, value, who) in enumerate(zip(selected_categories, keyword_combination, who_combination)):
-                            keyword_dict = {}
-                            
-                            # カテゴリタイプに応じてキーワードを取得
-                            if category_type in keywords:
-                                name_column = keywords[category_type]["columns"][0] if keywords[category_type]["columns"] else "name"
-                                data = next((item for item in keywords[category_type]["data"] if item.get(name_column) == value), None)
-                                if data:
-                                    for col in keywords[category_type]["columns"][1:]:
-                                        if col in data and data[col]:
-                                            keyword_dict[col] = data[col]
-                            
-                            all_keywords.append((category_type, value, who, keyword_dict))
-                    
-                    # プロンプト構築
-                    full_prompt = system_prompt + "\n\n"
-                    
-                    # ユーザー定義のルールとトンマナを追加（セッション状態から取得）
-                    user_rules = st.session_state.get('preset_user_rules_input', '')
-                    user_tone = st.session_state.get('preset_user_tone_input', '')
-                    
-                    if user_rules:
-                        full_prompt += f"<rules>\n{user_rules}\n</rules>\n\n"
-                    
-                    if user_tone:
-                        full_prompt += f"<tone_and_style>\n{user_tone}\n</tone_and_style>\n\n"
-                    
-                    # CSV連続モードの場合は複数質問を処理
-                    if is_batch_mode:
-                        # 複数の質問を一連の質問として処理
-                        full_prompt += "以下の質問は関連した一連の質問です。それぞれの回答に関連性を持たせて答えてください。\n\n"
-                        
-                        # 各質問にキーワード情報を追加
-                        for q_idx, (q_id, question) in enumerate(zip(id_list, current_question)):
-                            enhanced_question = f"質問{q_idx + 1} (ID: {q_id}): {question}"
-                            for category_type, value, who, _ in all_keywords:
-                                enhanced_question += f"\n【{who}の{category_type}】{value}"
-                            full_prompt += f"{enhanced_question}\n\n"
-                    else:
-                        # 通常モード：単一質問の処理
-                        enhanced_question = current_question
-                        for category_type, value, who, _ in all_keywords:
-                            enhanced_question += f"\n【{who}の{category_type}】{value}"
-                        
-                        full_prompt += f"質問: {enhanced_question}\n\n"
-                    
-                    # 各カテゴリのキーワードを追加
-                    for category_type, value, who, keyword_dict in all_keywords:
-                        if keyword_dict:
-                            full_prompt += f"【{who}の{category_type}キーワード】{value}\n"
-                            for col, keyword_value in keyword_dict.items():
-                                full_prompt += f"・{col}: {keyword_value}\n"
-                            full_prompt += "\n"
-                    
-                    # 文字数指定を追加（JSON形式で出力）
-                    if is_batch_mode:
-                        # CSV連続モード：複数質問用のJSON形式
-                        full_prompt += f"\n【出力形式】\n"
-                        full_prompt += f"必ず以下の正確なJSON形式のみを出力してください。前後に説明文を入れないでください：\n"
-                        full_prompt += f'{{\n'
-                        full_prompt += f'  "回答": [\n'
-                        for q_idx, (q_id, _) in enumerate(zip(id_list, current_question)):
-                            full_prompt += f'    {{\n'
-                            full_prompt += f'      "id": "{q_id}",\n'
-                            full_prompt += f'      "回答": "{answer_length}文字程度で詳細な占い結果",\n'
-                            full_prompt += f'      "サマリ": "{summary_length}文字程度で要点をまとめた内容"\n'
-                            full_prompt += f'    }}'
-                            if q_idx < len(id_list) - 1:
-                                full_prompt += ','
-                            full_prompt += '\n'
-                        full_prompt += f'  ],\n'
-                        full_prompt += f'  "元キーワード": "使用したキーワードを記載",\n'
-                        full_prompt += f'  "アレンジキーワード": "アレンジしたキーワードを記載"\n'
-                        full_prompt += f'}}\n'
-                    else:
-                        # 通常モード：単一質問用のJSON形式
-                        full_prompt += f"\n【出力形式】\n"
-                        full_prompt += f"必ず以下の正確なJSON形式のみを出力してください。前後に説明文を入れないでください：\n"
-                        full_prompt += f'{{\n'
-                        full_prompt += f'  "回答": "{answer_length}文字程度で詳細な占い結果(ここには使用キーワードは記載しない)",\n'
-                        full_prompt += f'  "サマリ": "{summary_length}文字程度で要点をまとめた内容",\n'
-                        full_prompt += f'  "元キーワード": "使用したキーワードを記載（なければ空文字）",\n'
-                        full_prompt += f'  "アレンジキーワード": "アレンジしたキーワードを記載（なければ空文字）"\n'
-                        full_prompt += f'}}\n'
-                    
-                    full_prompt += f"注意事項：\n"
-                    full_prompt += f"- JSONのみを出力（マークダウンのコードブロック```は使用しない）\n"
-                    full_prompt += f"- 前後に説明文を含めない"
-                    
-                    # API呼び出し
-                    if NEW_SDK:
-                        # 新しいSDKを使用
-                        # Vertex AIクライアントを取得
-                        service_account = None
-                        if hasattr(st, 'secrets') and 'gcp_service_account' in st.secrets:
-                            service_account = dict(st.secrets["gcp_service_account"])
-                        
-                        current_client, _ = setup_vertex_ai(
-                            selected_model,
-                            vertex_ai_project_id,
-                            vertex_ai_location,
-                            service_account
-                        )
-                        
-                        if not current_client:
-                            st.error("Vertex AIクライアントの初期化に失敗しました")
-                            continue
-                        
-                        if "2.5" in selected_model:
-                            # Gemini 2.5の処理
-                            if i == 0:  # 最初のリクエストでのみ表示
-                                st.info(f"🧠 Gemini 2.5で生成中 (Vertex AI, Thinking Budget: {thinking_budget}トークン)")
-                            
-                            config = types.GenerateContentConfig(
-                                thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget)
-                            )
-                            response = current_client.models.generate_content(
-                                model=selected_model,
-                                contents=full_prompt,
-                                config=config
-                            )
-                        else:
-                            # Gemini 2.5以外では通常の生成
-                            if i == 0:
-                                st.info(f"⚡ 通常モードで生成中（Vertex AI）")
-                            response = current_client.models.generate_content(
-                                model=selected_model,
-                                contents=full_prompt
-                            )
-                    
-                    # JSON形式の回答を解析
-                    if is_batch_mode:
-                        # CSV連続モード：複数回答の処理
-                        batch_results = []
-                        
-                        if response.text:
-                            try:
-                                # レスポンステキストのクリーンアップ
-                                cleaned_text = response.text.strip()
-                                
-                                # マークダウンのコードブロックを除去
-                                if cleaned_text.startswith("```json"):
-                                    cleaned_text = cleaned_text[7:]
-                                elif cleaned_text.startswith("```"):
-                                    cleaned_text = cleaned_text[3:]
-                                
-                                if cleaned_text.endswith("```"):
-                                    cleaned_text = cleaned_text[:-3]
-                                
-                                cleaned_text = cleaned_text.strip()
-                                
-                                # JSONの開始位置と終了位置を検出
-                                start_idx = cleaned_text.find("{")
-                                end_idx = cleaned_text.rfind("}")
-                                
-                                if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-                                    json_text = cleaned_text[start_idx:end_idx + 1]
-                                    json_response = json.loads(json_text)
-                                    
-                                    # キーワード情報を取得
-                                    original_keyword = json_response.get("元キーワード", "")
-                                    arranged_keyword = json_response.get("アレンジキーワード", "")
-                                    
-                                    # 各質問の回答を取得
-                                    answers = json_response.get("回答", [])
-                                    for answer in answers:
-                                        batch_results.append({
-                                            "id": answer.get("id", ""),
-                                            "回答": answer.get("回答", ""),
-                                            "サマリ": answer.get("サマリ", "")
-                                        })
-                                else:
-                                    # JSON形式が見つからない場合
-                                    for q_id in id_list:
-                                        batch_results.append({
-                                            "id": q_id,
-                                            "回答": "JSON解析エラー",
-                                            "サマリ": ""
-                                        })
-                                        
-                            except json.JSONDecodeError as e:
-                                # JSON解析に失敗した場合
-                                for q_id in id_list:
-                                    batch_results.append({
-                                        "id": q_id,
-                                        "回答": f"JSON解析エラー: {str(e)}",
-                                        "サマリ": ""
-                                    })
-                        else:
-                            # レスポンスがない場合
-                            for q_id in id_list:
-                                batch_results.append({
-                                    "id": q_id,
-                                    "回答": "回答を生成できませんでした",
-                                    "サマリ": ""
-                                })
-                    else:
-                        # 通常モード：単一回答の処理
-                        answer_text = ""
-                        summary_text = ""
-                        original_keyword = ""
-                        arranged_keyword = ""
-                        
-                        if response.text:
-                            try:
-                                # レスポンステキストのクリーンアップ
-                                cleaned_text = response.text.strip()
-                                
-                                # マークダウンのコードブロックを除去
-                                if cleaned_text.startswith("```json"):
-                                    cleaned_text = cleaned_text[7:]  # ```json を除去
-                                elif cleaned_text.startswith("```"):
-                                    cleaned_text = cleaned_text[3:]  # ``` を除去
-                                
-                                if cleaned_text.endswith("```"):
-                                    cleaned_text = cleaned_text[:-3]  # 末尾の ``` を除去
-                                
-                                # 再度前後の空白を除去
-                                cleaned_text = cleaned_text.strip()
-                                
-                                # JSONの開始位置と終了位置を検出
-                                start_idx = cleaned_text.find("{")
-                                end_idx = cleaned_text.rfind("}")
-                                
-                                if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-                                    json_text = cleaned_text[start_idx:end_idx + 1]
-                                    
-                                    # JSONとして解析を試行
-                                    json_response = json.loads(json_text)
-                                    answer_text = json_response.get("回答", "")
-                                    summary_text = json_response.get("サマリ", "")
-                                    original_keyword = json_response.get("元キーワード", "")
-                                    arranged_keyword = json_response.get("アレンジキーワード", "")
-                                else:
-                                    # JSON形式が見つからない場合
-                                    answer_text = response.text
-                                    summary_text = ""
-                                    
-                            except json.JSONDecodeError as e:
-                                # JSON解析に失敗した場合は元のテキストを回答に入れる
-                                answer_text = response.text
-                                summary_text = ""
-                                # サマリが空の場合、エラー情報を記録
-                                if not summary_text:
-                                    summary_text = f"JSON解析エラー"
-                        else:
-                            answer_text = "回答を生成できませんでした"
-                            summary_text = ""
-                    
-                    # トークン数の取得（Noneチェック付き）
-                    if hasattr(response, 'usage_metadata') and response.usage_metadata:
-                        if hasattr(response.usage_metadata, 'prompt_token_count') and response.usage_metadata.prompt_token_count is not None:
-                            total_prompt_tokens += response.usage_metadata.prompt_token_count
-                        if hasattr(response.usage_metadata, 'candidates_token_count') and response.usage_metadata.candidates_token_count is not None:
-                            total_candidates_tokens += response.usage_metadata.candidates_token_count
-                        if hasattr(response.usage_metadata, 'thoughts_token_count') and response.usage_metadata.thoughts_token_count is not None:
-                            total_thoughts_tokens += response.usage_metadata.thoughts_token_count
-                        if hasattr(response.usage_metadata, 'cached_content_token_count') and response.usage_metadata.cached_content_token_count is not None:
-                            total_cached_tokens += response.usage_metadata.cached_content_token_count
-                    
-                    # 結果保存
-                    if is_batch_mode:
-                        # CSV連続モード：複数の結果を保存
-                        for idx, (q_id, question, batch_result) in enumerate(zip(id_list, current_question, batch_results)):
-                            result_dict = {"id": q_id, "質問": question}
-                            
-                            # 各カテゴリの値を追加
-                            for cat_idx, (category_type, value, who) in enumerate(zip(selected_categories, keyword_combination, who_combination)):
-                                result_dict[f"{who}の{category_type}{cat_idx+1}"] = value
-                            
-                            # 回答データを追加
-                            result_dict["回答"] = batch_result.get("回答", "")
-                            result_dict["サマリ"] = batch_result.get("サマリ", "")
-                            result_dict["元キーワード"] = original_keyword
-                            result_dict["アレンジキーワード"] = arranged_keyword
-                            
-                            results.append(result_dict)
-                    else:
-                        # 通常モード：単一の結果を保存
-                        result_dict = {"id": question_id, "質問": current_question}
-                        
-                        # 各カテゴリの値を追加（最大4つ）
-                        if is_csv_mode and csv_validated_keywords:
-                            # CSV優先モード: CSV由来のキーワードを保存
-                            for idx, (category_type, value, who) in enumerate(csv_validated_keywords):
-                                result_dict[f"{who}の{category_type}{idx+1}"] = value
-                            # 空欄は作らない（CSVモードでは実際のキーワード数だけ出力）
-                        else:
-                            # 通常モード: 画面で選択されたキーワードを保存
-                            for idx, (category_type, value, who) in enumerate(zip(selected_categories, keyword_combination, who_combination)):
-                                result_dict[f"{who}の{category_type}{idx+1}"] = value
-                        
-                        # 残りの固定項目を追加
-                        result_dict["回答"] = answer_text
-                        result_dict["サマリ"] = summary_text
-                        result_dict["元キーワード"] = original_keyword
-                        result_dict["アレンジキーワード"] = arranged_keyword
-                        
-                        results.append(result_dict)
+            # CSV連続モードの回答救出・再リクエストの集計用
+            batch_recovered_count = 0
+            batch_followup_count = 0
+            request_count = 0  # APIリクエスト数（キャッシュヒットの集計用）
+            
+            # 生成モードの表示
+            if cascade_enabled:
+                st.info(f"🪜 カスケードモードで生成中: {' → '.join(model_chain)} (文字数許容誤差: ±{length_tolerance}%)")
+            elif "2.5" in selected_model:
+                st.info(f"🧠 Gemini 2.5で生成中 (Vertex AI, Thinking Budget: {thinking_budget}トークン)")
+            else:
+                st.info(f"⚡ 通常モードで生成中（Vertex AI）")
+            
+            # Vertex AIクライアントを取得
+            current_client = create_vertex_client(selected_model) if NEW_SDK else None
+            if not current_client:
+                st.error("Vertex AIクライアントの初期化に失敗しました")
+                if job_cprofile:
+                    job_cprofile.disable()
+                st.stop()
+            
+            generation_started_at = time.perf_counter()
+            
+            # 全セッション共有のスケジューラで順番にモデルを呼び出す（期限・ヘッジは設定した場合のみ）
+            endpoint_client = current_client
+            hedged_client = hedge_client(current_client)
+            current_client = schedule_client(hedged_client, f"生成 {len(total_combinations):,}件", len(total_combinations))
+            
+            # 進行状況（表示の更新は一定間隔にまとめる）
+            progress = GenerationProgress(len(total_combinations), thinking_budget)
+            
+            # 差分実行用の入力ハッシュ
+            combination_hashes = {}
+            carried_count = 0
+            mirrored_count = 0
+            symmetric_outcomes = {}  # 対称キー → 生成（引き継ぎ）済みの結果
+            processed_count = len(total_combinations)  # トークン上限で止まった場合はそこまでの組み合わせ数
+            quota_error = None
+            previous_entries = previous_manifest.get("entries", {}) if previous_manifest and previous_results is not None else {}
+            
+            try:
+                for i, combo in enumerate(total_combinations):
+                    # 組み合わせの入力ハッシュ（同じ組み合わせが複数ある場合は出現順で区別）
+                    combo_key = get_combination_key(combo, generation_settings)
+                    if combo_key in combination_hashes:
+                        combo_key = f"{combo_key}#{i}"
+                    combo_hash = compute_combination_hash(combo, generation_settings, keyword_index)
+                    combination_hashes[combo_key] = combo_hash
                     
-                    # プログレス更新
-                    progress = (i + 1) / len(total_combinations)
-                    progress_bar.progress(progress)
-                    thinking_status = f" (思考機能: {thinking_budget}トークン)" if thinking_budget > 0 else ""
-                    # 組み合わせの表示テキストを動的に生成
-                    combo_parts = []
-                    for val, who in zip(keyword_combination, who_combination):
-                        combo_parts.append(f"{who}の{val}")
-                    combo_text = " × ".join(combo_parts)
+                    # 入力が前回と同じで、前回の行がすべて正常に生成されていれば引き継ぐ
+                    carried_rows = None
+                    if previous_entries.get(combo_key) == combo_hash:
+                        carried_rows = [previous_results.get(row_key) for row_key in get_combination_row_keys(combo, generation_settings)]
+                        if not all(row is not None and not is_error_answer(row["回答"]) for row in carried_rows):
+                            carried_rows = None
                     
-                    if is_batch_mode:
-                        status_text.text(f"進行状況: {i + 1}/{len(total_combinations)} - 連続処理: {len(current_question)}個の質問 | {combo_text}{thinking_status}")
+                    symmetry_key = symmetry_keys[i] if symmetry_keys else None
+                    mirrored = carried_rows is None and symmetry_key in symmetric_outcomes
+                    if carried_rows is not None:
+                        outcome = {"rows": carried_rows, "model": "", "usage": [0, 0, 0, 0], "escalation_reasons": [], "followup_count": 0, "recovered_count": 0, "parsed_ok": True, "request_count": 0}
+                        carried_count += 1
+                    elif mirrored:
+                        # 入れ替えただけの組み合わせは生成済みの回答を使う
+                        outcome = mirror_outcome(symmetric_outcomes[symmetry_key], combo, generation_settings)
+                        mirrored_count += 1
                     else:
-                        question_preview = current_question[:30] + "..." if len(current_question) > 30 else current_question
-                        status_text.text(f"進行状況: {i + 1}/{len(total_combinations)} - 質問: {question_preview} | {combo_text}{thinking_status}")
-                    
-                    # トークン情報の更新
-                    token_text = f"入力: {total_prompt_tokens:,} | 出力: {total_candidates_tokens:,}"
-                    if total_thoughts_tokens > 0:
-                        token_text += f" | 思考: {total_thoughts_tokens:,}"
-                    if total_cached_tokens > 0:
-                        token_text += f" | キャッシュ: {total_cached_tokens:,}"
-                    token_info.info(f"📊 トークン使用量: {token_text}")
-                    
-                except Exception as e:
-                    # エラー時の結果保存（動的カテゴリに対応）
-                    result_dict = {"id": question_id, "質問": current_question}
+                        try:
+                            outcome = generate_combination(current_client, combo, generation_settings, keyword_index, job_profiler)
+                        except QuotaExceededError as e:
+                            # トークン上限に達したらジョブを止める（この組み合わせ以降はマニフェストに含めず、差分実行で再開できるようにする）
+                            del combination_hashes[combo_key]
+                            processed_count = i
+                            quota_error = f"{e}。残りの{len(total_combinations) - i:,}組み合わせは生成していません（マニフェストと結果CSVを保存し、「♻️ 差分実行」で再開できます）"
+                            break
+                    # エラーで終わった結果は複製せず、次の同じキーの組み合わせで生成し直す
+                    if symmetry_key is not None and not mirrored and not any(is_error_answer(row["回答"]) for row in outcome["rows"]):
+                        symmetric_outcomes.setdefault(symmetry_key, outcome)
+                    if carried_rows is None:
+                        new_row_indices.extend(range(len(results), len(results) + len(outcome["rows"])))
+                    results.extend(outcome["rows"])
+                    row_combo_indices.extend([i] * len(outcome["rows"]))
                     
-                    # 各カテゴリの値を追加
-                    if is_csv_mode and csv_validated_keywords:
-                        # CSV優先モード
-                        for idx, (category_type, value, who) in enumerate(csv_validated_keywords):
-                            result_dict[f"{who}の{category_type}{idx+1}"] = value
-                        # 空欄は作らない（CSVモードでは実際のキーワード数だけ出力）
-                    else:
-                        # 通常モード
-                        for idx, (category_type, value, who) in enumerate(zip(selected_categories, keyword_combination, who_combination)):
-                            result_dict[f"{who}の{category_type}{idx+1}"] = value
+                    # トークン数の集計
+                    prompt_tokens, candidates_tokens, thoughts_tokens, cached_tokens = outcome["usage"]
+                    total_prompt_tokens += prompt_tokens
+                    total_candidates_tokens += candidates_tokens
+                    total_thoughts_tokens += thoughts_tokens
+                    total_cached_tokens += cached_tokens
                     
-                    result_dict["回答"] = f"エラー: {str(e)}"
-                    result_dict["サマリ"] = ""
-                    result_dict["元キーワード"] = ""
-                    result_dict["アレンジキーワード"] = ""
+                    # カスケードモードの集計（エラーで終わった組み合わせは判定していないため数えない）
+                    if outcome["model"]:
+                        checked_count += 1
+                        if outcome["escalation_reasons"]:
+                            escalated_count += 1
+                        for reason in outcome["escalation_reasons"]:
+                            escalation_reasons[reason] = escalation_reasons.get(reason, 0) + 1
+                        model_usage_counts[outcome["model"]] = model_usage_counts.get(outcome["model"], 0) + 1
+                    batch_recovered_count += outcome["recovered_count"]
+                    batch_followup_count += outcome["followup_count"]
+                    request_count += outcome["request_count"]
                     
-                    results.append(result_dict)
+                    # 進行状況の更新
+                    with profile_stage(job_profiler, "進行状況の表示"):
+                        progress.update(combo, outcome, carried=carried_rows is not None or mirrored)
+                    current_client.update(i + 1)
+            finally:
+                current_client.finish()
+            hedge_stats = merge_hedge_stats(None, hedged_client)
+            
+            # トークン使用量を台帳に記録（ヘッジで余分に使った分のうち、計測できた分を含む）
+            with profile_stage(job_profiler, "台帳記録"):
+                record_token_usage(
+                    "生成", generation_settings, processed_count - carried_count - mirrored_count, len(results),
+                    [total + extra for total, extra in zip(
+                        [total_prompt_tokens, total_candidates_tokens, total_thoughts_tokens, total_cached_tokens], hedge_stats["hedge_usage"]
+                    )],
+                    time.perf_counter() - generation_started_at
+                )
+            
+            with profile_stage(job_profiler, "結果テーブル作成"):
+                results_df = pd.DataFrame(results)
+            
+            # 生成した行を検索用のアーカイブに追加
+            with profile_stage(job_profiler, "アーカイブ保存"):
+                archived_count = archive_results(results_df.iloc[new_row_indices], "生成", generation_settings)
             
-            # 結果表示
+            # ジョブのプロファイル（全体の所要時間と区間ごとの内訳）
+            job_profile = None
+            if job_profiler:
+                job_profiler.record("ジョブ全体", time.perf_counter() - job_started_at)
+                job_profile = {"stages": job_profiler.report(), "row_count": len(results), "combination_count": len(total_combinations)}
+                if job_cprofile:
+                    job_cprofile.disable()
+                    job_profile["cprofile_dump"], job_profile["cprofile_text"] = summarize_cprofile(job_cprofile)
+            
+            # 結果をセッション状態に保存（再実行後も表示・再生成できるようにする）
+            st.session_state.generation_run = {
+                "df": results_df,
+                "row_combo_indices": row_combo_indices,
+                "combinations": total_combinations,
+                "symmetry_keys": symmetry_keys,
+                "settings": generation_settings,
+                "token_totals": [total_prompt_tokens, total_candidates_tokens, total_thoughts_tokens, total_cached_tokens],
+                "request_count": request_count,
+                "escalated_count": escalated_count,
+                "checked_count": checked_count,
+                "escalation_reasons": escalation_reasons,
+                "model_usage_counts": model_usage_counts,
+                "batch_recovered_count": batch_recovered_count,
+                "batch_followup_count": batch_followup_count,
+                "generated_count": processed_count - carried_count - mirrored_count,
+                "quota_error": quota_error,
+                "carried_count": carried_count,
+                "mirrored_count": mirrored_count,
+                "archived_count": archived_count,
+                "hedge_stats": hedge_stats,
+                "endpoint_usage": merge_endpoint_usage(None, endpoint_client),
+                "manifest": build_run_manifest(combination_hashes, generation_settings),
+                "profile": job_profile,
+                "timestamp": get_japan_time().replace(':', '').replace('-', '').replace(' ', '_')
+            }
             st.success("生成完了！")
+    
+    profile_checkpoint(rerun_profiler, "生成設定・生成")
+    
+    # ===============================
+    # 結果表示セクション
+    # ===============================
+    # 絞り込み・ページ切り替え・ダウンロードなどの操作ではこのセクションだけを再実行する（再生成した後は画面全体を再実行する）
+    @st.fragment
+    def show_generation_results():
+        if 'generation_run' in st.session_state:
+            run = st.session_state.generation_run
+            run_settings = run["settings"]
+            df = run["df"]
+            total_prompt_tokens, total_candidates_tokens, total_thoughts_tokens, total_cached_tokens = run["token_totals"]
             
             # 最終的なトークン使用量サマリー
             st.subheader("トークン使用量サマリー")
-            col1, col2, col3, col4 = st.columns(4)
+            col1, col2, col3, col4, col5 = st.columns(5)
             
             with col1:
                 st.metric("入力トークン", f"{total_prompt_tokens:,}")
@@ -1638,9 +3359,208 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
                 total_tokens = total_prompt_tokens + total_candidates_tokens + total_thoughts_tokens
                 st.metric("合計トークン", f"{total_tokens:,}")
             
+            with col5:
+                # 入力のうちプレフィックスキャッシュにヒットしたトークン
+                request_count = run.get("request_count", 0)
+                cache_help = None
+                if request_count and total_prompt_tokens:
+                    cache_help = f"1リクエストあたり平均 {total_cached_tokens / request_count:,.0f}トークン（入力の{total_cached_tokens / total_prompt_tokens:.1%}）/ リクエスト数 {request_count:,}"
+                st.metric("キャッシュ済み入力", f"{total_cached_tokens:,}", help=cache_help)
+            
+            # エンドポイント別の内訳（複数のエンドポイントに振り分けた場合）
+            if len(run.get("endpoint_usage") or {}) > 1:
+                st.dataframe(pd.DataFrame([
+                    {
+                        "エンドポイント": name,
+                        "リクエスト数": usage["requests"],
+                        "エラー数": usage["errors"],
+                        "入力トークン": usage["usage"][0],
+                        "出力トークン": usage["usage"][1],
+                        "思考トークン": usage["usage"][2],
+                        "キャッシュトークン": usage["usage"][3]
+                    }
+                    for name, usage in run["endpoint_usage"].items()
+                ]), use_container_width=True, hide_index=True)
+            
+            # トークン上限で生成・再生成を止めた場合
+            if run.get("quota_error"):
+                st.warning(f"⛔ {run['quota_error']}")
+            if run.get("regenerate_quota_error"):
+                st.warning(f"⛔ {run['regenerate_quota_error']}")
+            
+            # 差分実行の内訳
+            if run.get("carried_count"):
+                st.info(f"♻️ 差分実行: 前回から引き継ぎ {run['carried_count']:,}件 / 新規・変更で生成 {run['generated_count']:,}件")
+            
+            # 対称な組み合わせの統合
+            if run.get("mirrored_count"):
+                st.info(f"🪞 入れ替えただけの組み合わせ {run['mirrored_count']:,}件は生成済みの回答を出力しました")
+            
+            # カスケードモードのエスカレーション率（引き継いだ組み合わせ・エラーで終わった組み合わせは除く）
+            combination_count = run.get("checked_count", run.get("generated_count", len(run["combinations"])))
+            if run_settings["cascade_enabled"] and combination_count:
+                st.subheader("カスケードモードサマリー")
+                col1, col2 = st.columns([1, 3])
+                with col1:
+                    st.metric("エスカレーション率", f"{run['escalated_count'] / combination_count:.1%}", help=f"{run['escalated_count']}/{combination_count}件が上位モデルで生成されました")
+                with col2:
+                    usage_text = " / ".join(f"{model}: {count}件" for model, count in run["model_usage_counts"].items())
+                    st.write(f"モデル別生成件数: {usage_text}")
+                    if run["escalation_reasons"]:
+                        reason_text = " / ".join(f"{reason}: {count}回" for reason, count in run["escalation_reasons"].items())
+                        st.write(f"エスカレーション理由: {reason_text}")
+            
+            # 文字数チェック
+            if not df.empty:
+                st.subheader("文字数チェック")
+                lengths, nonconforming_mask = memoize_in_session(
+                    "length_report", None,
+                    lambda: build_length_report(df, run_settings["answer_length"], run_settings["summary_length"], run_settings["length_tolerance"]),
+                    memo=run.setdefault("memo", {})
+                )
+                nonconforming_count = int(nonconforming_mask.sum())
+                
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("指定文字数", f"回答 {run_settings['answer_length']} / サマリ {run_settings['summary_length']}", help=f"許容誤差: ±{run_settings['length_tolerance']}%")
+                with col2:
+                    st.metric("範囲内", f"{len(df) - nonconforming_count:,}件")
+                with col3:
+                    st.metric("範囲外", f"{nonconforming_count:,}件")
+                
+                with st.expander("📏 文字数の分布", expanded=False):
+                    st.dataframe(lengths.describe().T.round(1), use_container_width=True)
+                    answer_bins = pd.cut(lengths["回答文字数"], bins=min(10, max(1, lengths["回答文字数"].nunique())))
+                    st.bar_chart(answer_bins.value_counts(sort=False).rename(index=str))
+                
+                if nonconforming_count:
+                    with st.expander(f"⚠️ 範囲外の行（{nonconforming_count}件）", expanded=False):
+                        # 先頭の一部のみ表示（すべての行は結果プレビューの「文字数範囲外」で確認できる）
+                        nonconforming_preview = build_result_page(df, nonconforming_mask, 1, 100)
+                        st.dataframe(
+                            pd.concat([nonconforming_preview, lengths.loc[nonconforming_preview.index]], axis=1),
+                            use_container_width=True
+                        )
+                        if nonconforming_count > 100:
+                            st.caption("先頭100件を表示しています。すべての行は結果プレビューの状態「文字数範囲外」で確認できます。")
+                    
+                    if st.button("🔁 文字数不一致の行のみ再生成", help="範囲外の行の組み合わせだけを再実行し、結果を同じ位置に反映します"):
+                        regenerate_client = create_vertex_client(run_settings["model_chain"][0]) if NEW_SDK else None
+                        if not regenerate_client:
+                            st.error("Vertex AIクライアントの初期化に失敗しました")
+                        else:
+                            regenerate_progress = st.progress(0)
+                            regenerate_started_at = time.perf_counter()
+                            token_totals_before = list(run["token_totals"])
+                            endpoint_client = regenerate_client
+                            hedged_client = hedge_client(regenerate_client)
+                            regenerate_client = schedule_client(hedged_client, f"再生成 {nonconforming_count:,}行", nonconforming_count)
+                            try:
+                                regenerate_rows(
+                                    regenerate_client, run, list(df.index[nonconforming_mask]), keyword_index,
+                                    progress_callback=lambda done, total: regenerate_progress.progress(done / total)
+                                )
+                            finally:
+                                regenerate_client.finish()
+                            hedge_usage = merge_hedge_stats(None, hedged_client)["hedge_usage"]
+                            run["hedge_stats"] = merge_hedge_stats(run.get("hedge_stats"), hedged_client)
+                            run["endpoint_usage"] = merge_endpoint_usage(run.get("endpoint_usage"), endpoint_client)
+                            record_token_usage(
+                                "再生成", run_settings, len({run["row_combo_indices"][row_idx] for row_idx in df.index[nonconforming_mask]}), nonconforming_count,
+                                [after - before + extra for after, before, extra in zip(run["token_totals"], token_totals_before, hedge_usage)],
+                                time.perf_counter() - regenerate_started_at
+                            )
+                            archive_results(run["df"].loc[df.index[nonconforming_mask]], "再生成", run_settings)
+                            run.pop("duplicate_clusters", None)
+                            st.rerun()
+                
+                # 類似回答チェック（回答が変わるまで結果を保持し、再表示のたびに計算し直さない）
+                st.subheader("類似回答チェック")
+                duplicate_threshold = st.slider(
+                    "類似度のしきい値", min_value=0.5, max_value=0.95, value=0.8, step=0.05, key="duplicate_threshold",
+                    help="回答の文字3-gramの一致度（Jaccard係数）がこの値以上の回答を、似た回答としてまとめます"
+                )
+                if run.get("duplicate_threshold") != duplicate_threshold or "duplicate_clusters" not in run:
+                    with st.spinner("類似した回答を検出中..."):
+                        answers = df["回答"].dropna()
+                        run["duplicate_clusters"] = find_near_duplicate_answers(answers[~answers.map(is_error_answer)], duplicate_threshold)
+                    run["duplicate_threshold"] = duplicate_threshold
+                duplicate_clusters = run["duplicate_clusters"]
+                
+                if not duplicate_clusters:
+                    st.success("似た回答は見つかりませんでした")
+                else:
+                    duplicate_report = memoize_in_session(
+                        "duplicate_report", duplicate_threshold, lambda: build_duplicate_report(df, duplicate_clusters), memo=run.setdefault("memo", {})
+                    )
+                    flagged_rows = list(duplicate_report.loc[duplicate_report["再生成"], "行"])
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.metric("似た回答のクラスタ", f"{len(duplicate_clusters):,}件")
+                    with col2:
+                        st.metric("再生成の対象", f"{len(flagged_rows):,}行", help="各クラスタの先頭の行を残し、残りの行を再生成します")
+                    
+                    with st.expander(f"🧬 似た回答の一覧（{len(duplicate_clusters):,}クラスタ）", expanded=False):
+                        # 大きいクラスタから先頭の一部のみ表示
+                        st.dataframe(duplicate_report.head(200), use_container_width=True, hide_index=True)
+                        if len(duplicate_report) > 200:
+                            st.caption(f"全{len(duplicate_report):,}行のうち先頭200行を表示しています。")
+                    
+                    if st.button("🔁 似た回答の行を再生成（多様性の指示付き）", help="各クラスタの先頭の回答と似ないよう指示して、残りの行の組み合わせを再実行します"):
+                        regenerate_client = create_vertex_client(run_settings["model_chain"][0]) if NEW_SDK else None
+                        if not regenerate_client:
+                            st.error("Vertex AIクライアントの初期化に失敗しました")
+                        else:
+                            regenerate_progress = st.progress(0)
+                            regenerate_started_at = time.perf_counter()
+                            token_totals_before = list(run["token_totals"])
+                            # 各行には、同じクラスタの残す行の回答を避けるべき回答として渡す
+                            avoid_answers = {
+                                row_idx: truncate_text(df.at[rows[0], "回答"], 200)
+                                for rows in duplicate_clusters for row_idx in rows[1:]
+                            }
+                            endpoint_client = regenerate_client
+                            hedged_client = hedge_client(regenerate_client)
+                            regenerate_client = schedule_client(hedged_client, f"類似回答の再生成 {len(flagged_rows):,}行", len(flagged_rows))
+                            try:
+                                regenerate_rows(
+                                    regenerate_client, run, flagged_rows, keyword_index,
+                                    progress_callback=lambda done, total: regenerate_progress.progress(done / total),
+                                    avoid_answers=avoid_answers
+                                )
+                            finally:
+                                regenerate_client.finish()
+                            hedge_usage = merge_hedge_stats(None, hedged_client)["hedge_usage"]
+                            run["hedge_stats"] = merge_hedge_stats(run.get("hedge_stats"), hedged_client)
+                            run["endpoint_usage"] = merge_endpoint_usage(run.get("endpoint_usage"), endpoint_client)
+                            record_token_usage(
+                                "再生成", run_settings, len({run["row_combo_indices"][row_idx] for row_idx in flagged_rows}), len(flagged_rows),
+                                [after - before + extra for after, before, extra in zip(run["token_totals"], token_totals_before, hedge_usage)],
+                                time.perf_counter() - regenerate_started_at
+                            )
+                            archive_results(run["df"].loc[flagged_rows], "再生成", run_settings)
+                            run.pop("duplicate_clusters", None)
+                            st.rerun()
+            
+            hedge_stats = run.get("hedge_stats")
+            if hedge_stats and (hedge_stats["hedge_sent"] or hedge_stats["timeouts"]):
+                measured_tokens = sum(hedge_stats["hedge_usage"][:3])
+                estimated_tokens = measured_tokens + sum(hedge_stats.get("cancelled_usage_estimate", [0, 0, 0])[:3])
+                st.caption(
+                    f"🪁 ヘッジ: 追加で送信 {hedge_stats['hedge_sent']:,}件のうち、追加分が先に返った {hedge_stats['hedge_wins']:,}件・"
+                    f"送信後に取り消した {hedge_stats.get('hedge_cancelled', 0):,}件（元の呼び出しを含む取り消しは計 {hedge_stats['cancelled']:,}件） / "
+                    f"ヘッジで余分に使ったトークン 少なくとも {measured_tokens:,}"
+                    f"（取り消した呼び出しも先に返った呼び出しと同じだけ使った場合の推定 {estimated_tokens:,}） / ⏱️ 期限切れ {hedge_stats['timeouts']:,}件"
+                )
+            
+            if run.get("batch_recovered_count") or run.get("batch_followup_count"):
+                st.caption(f"🧩 CSV連続モード: 壊れたレスポンスから救出した回答 {run.get('batch_recovered_count', 0)}件 / 未回答IDの再リクエスト {run.get('batch_followup_count', 0)}回")
+            
+            if run.get("regenerated_count"):
+                st.caption(f"🔁 再生成済みの行: 延べ{run['regenerated_count']}件")
+            
             # CSV出力
-            df = pd.DataFrame(results)
-            timestamp = get_japan_time().replace(':', '').replace('-', '').replace(' ', '_')
+            timestamp = run["timestamp"]
             
             # CSVファイル名入力とダウンロードボタンを横並びに配置
             col_filename, col_download = st.columns([2, 1])
@@ -1658,29 +3578,488 @@ Gemini 2.5モデルでは、AIが「考える」ためのトークン数を指
                 # カスタムファイル名を使用（デフォルトは"占い結果"）
                 csv_filename = f"{custom_filename}_{timestamp}.csv"
                 
-                csv = df.to_csv(index=False, encoding='utf-8-sig')
+                with profile_stage(rerun_profiler, "CSV出力（to_csv）"):
+                    csv_text = memoize_in_session("csv", None, lambda: df.to_csv(index=False, encoding='utf-8-sig'), memo=run.setdefault("memo", {}))
                 st.download_button(
                     label="結果をCSVでダウンロード",
-                    data=csv,
+                    data=csv_text,
                     file_name=csv_filename,
                     mime="text/csv",
                     use_container_width=True
                 )
+                
+                # 差分実行用のマニフェスト
+                if run.get("manifest"):
+                    st.download_button(
+                        label="マニフェストをダウンロード",
+                        data=json.dumps(run["manifest"], ensure_ascii=False, indent=2),
+                        file_name=f"{custom_filename}_{timestamp}_manifest.json",
+                        mime="application/json",
+                        use_container_width=True,
+                        help="次回の差分実行で、この結果CSVと一緒にアップロードしてください"
+                    )
+                
+                # 配信用ストアへの公開（管理者のみ）
+                if st.session_state.get("user_role") == "admin":
+                    if st.button("🚀 配信用ストアに公開", use_container_width=True, help="この結果を (質問ID, キーワードの組み合わせ) で引ける配信用ストアに変換し、公開中のストアと置き換えます"):
+                        try:
+                            published_count = publish_serving_store(df, run.get("settings"))
+                            run["published_store"] = {"count": published_count, "published_at": get_japan_time()}
+                        except OSError as e:
+                            st.error(f"配信用ストアを公開できませんでした: {e}")
+                    if run.get("published_store"):
+                        st.caption(f"🚀 {run['published_store']['published_at']} に{run['published_store']['count']:,}件を公開しました（{serving_store_path}）")
             
-            # 結果プレビュー
+            # 結果プレビュー（絞り込み・ページ分割はサーバー側で行い、表示するページだけを送る）
             st.subheader("結果プレビュー")
-            st.dataframe(df)
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                result_id_query = st.text_input("ID", key="result_filter_id", placeholder="部分一致")
+            with col2:
+                result_keyword_query = st.text_input("キーワード", key="result_filter_keyword", placeholder="例：牡羊座")
+            with col3:
+                result_who_filter = st.selectbox("対象", ["すべて", "あなた", "あの人", "相性"], key="result_filter_who")
+            with col4:
+                result_status_filter = st.selectbox("状態", ["すべて", "エラーのみ", "正常のみ", "文字数範囲外"], key="result_filter_status")
+            
+            result_mask = filter_result_rows(
+                df, result_id_query, result_keyword_query, result_who_filter, result_status_filter,
+                nonconforming_mask if not df.empty else None
+            )
+            matched_count = int(result_mask.sum())
+            
+            col1, col2, col3 = st.columns([1, 1, 2])
+            with col1:
+                result_page_size = st.selectbox("表示件数", [25, 50, 100, 200], index=1, key="result_page_size")
+            page_count = max(1, -(-matched_count // result_page_size))
+            with col2:
+                result_page = st.number_input("ページ", min_value=1, max_value=page_count, value=1, key="result_page")
+            with col3:
+                st.caption(f"{matched_count:,}件 / 全{len(df):,}件（{page_count:,}ページ）")
+            
+            result_page_df = build_result_page(df, result_mask, min(result_page, page_count), result_page_size)
+            st.dataframe(result_page_df, use_container_width=True)
+            
+            # 省略した回答・サマリは選択した行だけ全文を表示
+            if not result_page_df.empty:
+                expanded_row = st.selectbox(
+                    "全文を表示する行",
+                    [None] + list(result_page_df.index),
+                    format_func=lambda row_idx: "選択してください" if row_idx is None else f"{row_idx}: ID {df.at[row_idx, 'id']}",
+                    key="result_expanded_row"
+                )
+                if expanded_row is not None and expanded_row in df.index:
+                    st.markdown(f"**回答**\n\n{df.at[expanded_row, '回答']}")
+                    st.markdown(f"**サマリ**\n\n{df.at[expanded_row, 'サマリ']}")
+    
+    show_generation_results()
+    
+    profile_checkpoint(rerun_profiler, "結果表示")
+    
+    # ===============================
+    # 生成結果アーカイブ
+    # ===============================
+    with st.expander("🗄️ 生成結果アーカイブ（過去の実行を検索）", expanded=False):
+        try:
+            archive_stats = get_archive_stats()
+        except sqlite3.Error as e:
+            archive_stats = None
+            st.error(f"アーカイブの読み込みに失敗しました: {str(e)}")
+        
+        if archive_stats is not None:
+            st.caption(
+                f"保存済み: {archive_stats['runs']:,}回の実行 / {archive_stats['rows']:,}行"
+                + ("" if archive_stats["full_text"] else "（このSQLiteは全文索引に対応していないため部分一致で検索します）")
+            )
+            col1, col2, col3 = st.columns([2, 2, 1])
+            with col1:
+                archive_text_query = st.text_input("全文検索", key="archive_text_query", placeholder="質問・回答・サマリ・キーワードから検索")
+            with col2:
+                archive_keyword_query = st.text_input("キーワード", key="archive_keyword_query", placeholder="例：牡羊座 第7ハウス（すべて含む）")
+            with col3:
+                archive_id_query = st.text_input("ID", key="archive_id_query", placeholder="完全一致")
+            
+            col1, col2, col3 = st.columns([1, 1, 2])
+            with col1:
+                archive_page_size = st.selectbox("表示件数", [25, 50, 100], index=1, key="archive_page_size")
+            archive_page = st.session_state.get("archive_page", 1)
+            try:
+                archive_df, archive_total = search_fortune_archive(
+                    archive_text_query, archive_keyword_query, archive_id_query,
+                    limit=archive_page_size, offset=(archive_page - 1) * archive_page_size
+                )
+            except sqlite3.Error as e:
+                archive_df, archive_total = pd.DataFrame(columns=archive_columns), 0
+                st.error(f"検索に失敗しました: {str(e)}")
+            archive_page_count = max(1, -(-archive_total // archive_page_size))
+            if archive_df.empty and archive_page > archive_page_count:
+                # 絞り込みで件数が減った場合は最後のページを表示する
+                archive_df, archive_total = search_fortune_archive(
+                    archive_text_query, archive_keyword_query, archive_id_query,
+                    limit=archive_page_size, offset=(archive_page_count - 1) * archive_page_size
+                )
+            with col2:
+                st.number_input("ページ", min_value=1, max_value=archive_page_count, value=1, key="archive_page")
+            with col3:
+                st.caption(f"{archive_total:,}件が一致（{archive_page_count:,}ページ）")
+            
+            # 長い回答・サマリは省略し、キーワード列は1列にまとめて表示
+            archive_page_df = archive_df.assign(キーワード列=archive_df["キーワード列"].map(format_archived_keywords))
+            for col in ["回答", "サマリ"]:
+                archive_page_df[col] = archive_page_df[col].map(lambda text: truncate_text(text, 80))
+            st.dataframe(archive_page_df, use_container_width=True, hide_index=True)
+            
+            if not archive_df.empty:
+                archive_expanded_row = st.selectbox(
+                    "全文を表示する行",
+                    [None] + list(archive_df.index),
+                    format_func=lambda row_idx: "選択してください" if row_idx is None else f"実行{archive_df.at[row_idx, '実行ID']}: ID {archive_df.at[row_idx, 'id']}",
+                    key="archive_expanded_row"
+                )
+                if archive_expanded_row is not None and archive_expanded_row in archive_df.index:
+                    st.markdown(f"**キーワード**\n\n{format_archived_keywords(archive_df.at[archive_expanded_row, 'キーワード列'])}")
+                    st.markdown(f"**回答**\n\n{archive_df.at[archive_expanded_row, '回答']}")
+                    st.markdown(f"**サマリ**\n\n{archive_df.at[archive_expanded_row, 'サマリ']}")
+            
+            # 一致したすべての行を出力CSVと同じ形式で書き出す（ボタンを押したときだけ作成する）
+            if archive_total and st.button(f"📦 一致した{archive_total:,}行をCSVに書き出す"):
+                export_df, _ = search_fortune_archive(archive_text_query, archive_keyword_query, archive_id_query)
+                st.session_state.archive_export = expand_archived_rows(export_df).to_csv(index=False, encoding='utf-8-sig')
+            if st.session_state.get("archive_export"):
+                st.download_button(
+                    label="書き出したCSVをダウンロード",
+                    data=st.session_state.archive_export,
+                    file_name=f"アーカイブ_{get_japan_time().replace(':', '').replace('-', '').replace(' ', '_')}.csv",
+                    mime="text/csv"
+                )
+            
+            # 以前にダウンロードした結果CSVの取り込み
+            archive_uploads = st.file_uploader("過去の結果CSVを取り込む", type=['csv'], accept_multiple_files=True, key="archive_uploads")
+            if archive_uploads and st.button("📥 アーカイブに取り込む"):
+                imported_count = 0
+                for uploaded_archive in archive_uploads:
+                    try:
+                        imported_df = pd.read_csv(uploaded_archive, encoding='utf-8-sig', dtype=str, keep_default_na=False)
+                    except Exception as e:
+                        st.error(f"{uploaded_archive.name} の読み込みに失敗しました: {str(e)}")
+                        continue
+                    if not {"id", "質問", "回答"}.issubset(imported_df.columns):
+                        st.error(f"{uploaded_archive.name} は結果CSVの形式ではありません（id・質問・回答の列が必要です）")
+                        continue
+                    imported_count += archive_results(imported_df, "取り込み")
+                st.success(f"{imported_count:,}行を取り込みました")
+    
+    # ===============================
+    # リクエストキュー（管理者のみ）
+    # ===============================
+    if st.session_state.get("user_role") == "admin":
+        with st.expander("🚦 リクエストキュー（全セッション）", expanded=False):
+            queue_state = get_shared_scheduler().snapshot()
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("実行中リクエスト", f"{queue_state['running']} / {scheduler_settings['max_concurrency']}")
+            with col2:
+                st.metric("待機中リクエスト", sum(job["waiting"] for job in queue_state["jobs"]))
+            with col3:
+                st.metric("進行中のジョブ", sum(1 for job in queue_state["jobs"] if not job["finished"]))
+            
+            # ロール別の本日のトークン使用量と上限
+            usage_rows = []
+            for role in sorted(set(scheduler_settings["role_weights"]) | set(queue_state["daily_tokens"])):
+                token_limit = scheduler_settings["role_daily_tokens"].get(role)
+                job_token_limit = scheduler_settings["role_job_tokens"].get(role)
+                usage_rows.append({
+                    "ロール": role,
+                    "同時実行数上限": scheduler_settings["role_concurrency"].get(role, scheduler_settings["max_concurrency"]),
+                    "重み": scheduler_settings["role_weights"].get(role, 1),
+                    "本日のトークン": queue_state["daily_tokens"].get(role, 0),
+                    "1日の上限": f"{token_limit:,}" if token_limit else "無制限",
+                    "1ジョブの上限": f"{job_token_limit:,}" if job_token_limit else "無制限"
+                })
+            st.dataframe(pd.DataFrame(usage_rows), use_container_width=True, hide_index=True)
+            
+            if queue_state["jobs"]:
+                st.dataframe(pd.DataFrame([{
+                    "ジョブ": job["id"],
+                    "ロール": job["role"],
+                    "内容": job["label"],
+                    "進捗": f"{job['done']:,} / {job['total']:,}",
+                    "待機": job["waiting"],
+                    "実行中": job["running"],
+                    "リクエスト数": job["requests"],
+                    "トークン": job["tokens"],
+                    "状態": "完了" if job["finished"] else "実行中",
+                    "開始": datetime.fromtimestamp(job["started_at"], pytz.timezone('Asia/Tokyo')).strftime('%H:%M:%S')
+                } for job in queue_state["jobs"]]), use_container_width=True, hide_index=True)
+            else:
+                st.info("現在登録されているジョブはありません")
+            st.caption("設定はconfig.tomlの[scheduler]（max_concurrency、role_concurrency、role_weights、role_daily_tokens、role_job_tokens）で変更できます。")
+            
+            # エンドポイントの状態（複数のエンドポイントに振り分けている場合）
+            if len(endpoint_settings) > 1:
+                st.write("**エンドポイント**")
+                st.dataframe(pd.DataFrame([
+                    {
+                        "エンドポイント": endpoint["name"],
+                        "状態": endpoint["state"],
+                        "重み": endpoint["weight"],
+                        "連続失敗": endpoint["failures"],
+                        "再開まで(秒)": round(endpoint["reopen_in"], 1),
+                        "リクエスト数": endpoint["requests"],
+                        "エラー数": endpoint["errors"],
+                        "トークン": endpoint["tokens"]
+                    }
+                    for endpoint in get_shared_endpoint_health().snapshot()
+                ]), use_container_width=True, hide_index=True)
+                st.caption("429・5xxを続けて返したエンドポイントは一時的に遮断し、他のエンドポイントに振り分けます（設定はconfig.tomlの[endpoint_pool]）。")
+    
+    # ===============================
+    # トークン使用量台帳（管理者のみ）
+    # ===============================
+    if st.session_state.get("user_role") == "admin":
+        with st.expander("📒 トークン使用量台帳", expanded=False):
+            try:
+                ledger = load_token_ledger()
+            except sqlite3.Error as e:
+                ledger = None
+                st.error(f"台帳の読み込みに失敗しました: {str(e)}")
+            
+            if ledger is not None and ledger.empty:
+                st.info("まだ記録がありません。生成・再生成を実行すると記録されます。")
+            elif ledger is not None:
+                ledger_dates = ledger["記録日時"].str[:10]
+                col1, col2 = st.columns(2)
+                with col1:
+                    ledger_period = st.date_input(
+                        "期間",
+                        value=(datetime.strptime(ledger_dates.min(), '%Y-%m-%d').date(), datetime.strptime(ledger_dates.max(), '%Y-%m-%d').date()),
+                        key="ledger_period"
+                    )
+                with col2:
+                    ledger_group_by = st.multiselect(
+                        "集計単位",
+                        ["日付", "種別", "ロール", "モデル", "Thinking Budget", "プリセット", "入力モード"],
+                        default=["日付", "ロール"],
+                        key="ledger_group_by"
+                    )
+                
+                if isinstance(ledger_period, (list, tuple)) and len(ledger_period) == 2:
+                    in_period = (ledger_dates >= ledger_period[0].isoformat()) & (ledger_dates <= ledger_period[1].isoformat())
+                    ledger = ledger[in_period]
+                
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("実行回数", f"{len(ledger):,}")
+                with col2:
+                    st.metric("生成行数", f"{int(ledger['行数'].sum()):,}")
+                with col3:
+                    st.metric("合計トークン", f"{int(ledger[['入力トークン', '出力トークン', '思考トークン']].sum().sum()):,}")
+                
+                if ledger_group_by and not ledger.empty:
+                    ledger_summary = aggregate_token_ledger(ledger, ledger_group_by)
+                    st.dataframe(ledger_summary, use_container_width=True, hide_index=True)
+                else:
+                    ledger_summary = None
+                
+                with st.expander("記録一覧", expanded=False):
+                    st.dataframe(ledger, use_container_width=True, hide_index=True)
+                
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.download_button(
+                        label="記録をCSVでダウンロード",
+                        data=ledger.to_csv(index=False, encoding='utf-8-sig'),
+                        file_name=f"token_ledger_{get_japan_time()[:10]}.csv",
+                        mime="text/csv",
+                        use_container_width=True
+                    )
+                with col2:
+                    if ledger_summary is not None:
+                        st.download_button(
+                            label="集計をCSVでダウンロード",
+                            data=ledger_summary.to_csv(index=False, encoding='utf-8-sig'),
+                            file_name=f"token_ledger_summary_{get_japan_time()[:10]}.csv",
+                            mime="text/csv",
+                            use_container_width=True
+                        )
+    
+    # ===============================
+    # ベンチマーク（管理者のみ）
+    # ===============================
+    if st.session_state.get("user_role") == "admin":
+        with st.expander("🧪 モデル×Thinking Budget ベンチマーク", expanded=False):
+            st.caption("現在の質問・キーワード設定から固定のサンプルを抽出し、モデルとThinking Budgetの設定ごとにレイテンシ・トークン数・JSON有効率・文字数適合率を比較します。記録ファイルをアップロードすると、APIを呼ばずに記録したレスポンスを再生します。")
+            col1, col2 = st.columns(2)
+            with col1:
+                benchmark_models = st.multiselect("比較するモデル", vertex_model_options, default=vertex_model_options, key="benchmark_models")
+                benchmark_budgets_text = st.text_input("Thinking Budget（カンマ区切り）", value="0, 1024, 4096", key="benchmark_budgets", help="Gemini 2.5のみ適用されます（Proは128以上）")
+                uploaded_recordings = st.file_uploader("記録ファイル（再生する場合）", type=['jsonl'], key="benchmark_recordings_upload")
+            with col2:
+                benchmark_sample_size = st.number_input("サンプル数（組み合わせ）", min_value=1, max_value=500, value=20, key="benchmark_sample_size")
+                benchmark_seed = st.number_input("サンプル抽出のシード", min_value=0, value=0, key="benchmark_seed", help="同じシードと設定なら同じ組み合わせを抽出します（記録の再生にも同じ値が必要です）")
+                latency_slo = st.number_input("レイテンシSLO（p90, 秒）", min_value=0.0, value=10.0, step=0.5, key="benchmark_latency_slo")
+                min_quality = st.slider("推奨に必要なJSON有効率・文字数適合率（%）", min_value=0, max_value=100, value=90, step=5, key="benchmark_min_quality")
+            
+            if st.button("🧪 ベンチマークを実行", key="run_benchmark"):
+                try:
+                    thinking_budgets = [int(value) for value in re.split(r"[,、\s]+", benchmark_budgets_text.strip()) if value]
+                except ValueError:
+                    thinking_budgets = None
+                keyword_combinations, who_combinations = build_keyword_combinations(selected_categories, selected_values, selected_who, keyword_index, keyword_expansion)
+                total_combinations, validation_errors = build_total_combinations(
+                    input_mode, questions_list, id_list, csv_keywords_list,
+                    keyword_combinations, who_combinations, selected_who, keyword_index, keyword_expansion
+                )
+                
+                if not system_prompt or not total_combinations:
+                    st.error("システムプロンプト・質問・キーワードを設定してください")
+                elif validation_errors:
+                    st.error("CSVファイルに無効なキーワードが含まれています。")
+                    for error in validation_errors:
+                        st.error(error)
+                elif not benchmark_models or not thinking_budgets:
+                    st.error("比較するモデルと、Thinking Budget（整数のカンマ区切り）を指定してください")
+                else:
+                    # 固定シードで抽出（同じ設定なら毎回同じサンプル）
+                    sample_indices = random.Random(benchmark_seed).sample(range(len(total_combinations)), min(benchmark_sample_size, len(total_combinations)))
+                    sample = [total_combinations[i] for i in sorted(sample_indices)]
+                    
+                    recordings = None
+                    base_client = None
+                    if uploaded_recordings is not None:
+                        recordings = load_benchmark_recordings(uploaded_recordings.getvalue().decode('utf-8'))
+                    else:
+                        base_client = create_vertex_client(benchmark_models[0]) if NEW_SDK else None
+                    
+                    if recordings is None and not base_client:
+                        st.error("Vertex AIクライアントの初期化に失敗しました")
+                    else:
+                        benchmark_client = BenchmarkClient(base_client, recordings)
+                        sweep_settings = build_sweep_settings(benchmark_models, thinking_budgets)
+                        # 実トラフィックではスケジューラを通す（待ち時間はレイテンシに含めない）
+                        scheduled_client = None
+                        if recordings is None:
+                            scheduled_client = schedule_client(benchmark_client, f"ベンチマーク {len(sample) * len(sweep_settings):,}件", len(sample) * len(sweep_settings))
+                        benchmark_progress = st.progress(0)
+                        try:
+                            measurements = run_benchmark_sweep(
+                                benchmark_client, sample, generation_settings, keyword_index, sweep_settings,
+                                progress_callback=lambda done, total: benchmark_progress.progress(done / total),
+                                client=scheduled_client
+                            )
+                        except QuotaExceededError as e:
+                            measurements = None
+                            st.error(f"⛔ {e}。ベンチマークを中止しました")
+                        finally:
+                            if scheduled_client:
+                                scheduled_client.finish()
+                        if measurements is not None and scheduled_client:
+                            record_token_usage(
+                                "ベンチマーク", dict(generation_settings, model_chain=list(benchmark_models), cascade_enabled=False),
+                                len(measurements), len(measurements),
+                                [sum(m[column] for m in measurements) for column in ("入力トークン", "出力トークン", "思考トークン", "キャッシュトークン")],
+                                benchmark_client.elapsed
+                            )
+                        if measurements is not None:
+                            st.session_state.benchmark_result = {
+                                "measurements": measurements,
+                                "records": benchmark_client.records,
+                                "replayed": recordings is not None,
+                                "sample_size": len(sample),
+                                "timestamp": get_japan_time().replace(':', '').replace('-', '').replace(' ', '_')
+                            }
+            
+            if 'benchmark_result' in st.session_state:
+                benchmark_result = st.session_state.benchmark_result
+                report = build_benchmark_report(benchmark_result["measurements"], model_pricing, latency_slo, min_quality)
+                mode_text = "記録の再生" if benchmark_result["replayed"] else "実トラフィック"
+                st.caption(f"サンプル {benchmark_result['sample_size']}件 × {len(report)}設定（{mode_text}）。レイテンシは1組み合わせあたりのAPI呼び出し時間の合計です。")
+                if not model_pricing:
+                    st.caption("config.tomlに [pricing.\"モデル名\"] input / output（100万トークンあたりの料金）を設定すると推定コストで比較できます。料金設定がない場合は合計トークン数が最少の設定を推奨します。")
+                elif "推奨" in report and (report["推奨"] == "価格未設定").any():
+                    st.caption("「価格未設定」の設定は料金設定がないため推定コストで比較していません。config.tomlの [pricing] にモデルの料金を追加すると推奨の対象になります。")
+                st.dataframe(report, use_container_width=True)
+                
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.download_button(
+                        label="レポートをCSVでダウンロード",
+                        data=report.to_csv(index=False, encoding='utf-8-sig'),
+                        file_name=f"benchmark_{benchmark_result['timestamp']}.csv",
+                        mime="text/csv",
+                        use_container_width=True
+                    )
+                with col2:
+                    if benchmark_result["records"]:
+                        st.download_button(
+                            label="記録ファイルをダウンロード",
+                            data="\n".join(json.dumps(record, ensure_ascii=False) for record in benchmark_result["records"]),
+                            file_name=f"benchmark_{benchmark_result['timestamp']}.jsonl",
+                            mime="application/json",
+                            use_container_width=True,
+                            help="アップロードすると同じサンプルをオフラインで再生できます"
+                        )
     
     # ===============================
     # 3. キーワード参照セクション
     # ===============================
-    with st.expander("📚 キーワード参照", expanded=False):
-        if st.session_state.custom_keywords:
-            # カスタムキーワードの表示
-            for category_name, keyword_info in keywords.items():
-                if keyword_info and "df" in keyword_info:
-                    st.subheader(f"{category_name}キーワード")
-                    st.dataframe(keyword_info["df"], use_container_width=True)
-        else:
-            st.info("キーワードCSVファイルをアップロードしてください。")
+    # カテゴリ・ページの切り替えではこのセクションだけを再実行する
+    @st.fragment
+    def show_keyword_reference():
+        with st.expander("📚 キーワード参照", expanded=False):
+            if st.session_state.custom_keywords:
+                # 選択したカテゴリの表示中のページだけを表示
+                col1, col2 = st.columns([2, 1])
+                with col1:
+                    reference_category = st.selectbox("カテゴリ", list(keywords.keys()), key="keyword_reference_category")
+                keyword_info = keywords[reference_category]
+                reference_page_size = 20
+                reference_page_count = max(1, -(-len(keyword_info["values"][keyword_info["columns"][0]]) // reference_page_size)) if keyword_info["columns"] else 1
+                with col2:
+                    reference_page = st.number_input("ページ", min_value=1, max_value=reference_page_count, value=1, key="keyword_reference_page")
+                st.subheader(f"{reference_category}キーワード")
+                reference_df = keyword_table_to_dataframe(keyword_info)
+                page_start = (min(reference_page, reference_page_count) - 1) * reference_page_size
+                st.dataframe(reference_df.iloc[page_start:page_start + reference_page_size], use_container_width=True)
+                st.caption(f"{len(reference_df):,}件中 {page_start + 1:,}〜{min(page_start + reference_page_size, len(reference_df)):,}件目")
+            else:
+                st.info("キーワードCSVファイルをアップロードしてください。")
+    
+    show_keyword_reference()
+    
+    profile_checkpoint(rerun_profiler, "アーカイブ・管理者メニュー・キーワード参照")
+    
+    # ===============================
+    # プロファイル（管理者のみ）
+    # ===============================
+    if st.session_state.get("user_role") == "admin":
+        with st.expander("⏱️ プロファイル", expanded=bool(rerun_profiler)):
+            col1, col2 = st.columns(2)
+            with col1:
+                st.checkbox("プロファイルモード", key="profiling_enabled", help="画面の再実行ごとにセクション別の所要時間を、生成ジョブでは区間別（1行あたりのプロンプト構築・API呼び出し・JSON解析など）の所要時間を計測します")
+            with col2:
+                st.checkbox("生成ジョブをcProfileで記録", key="profiling_cprofile", disabled=not st.session_state.get("profiling_enabled"), help="関数ごとの所要時間を記録します（計測のぶん生成が遅くなります）")
+            
+            if rerun_profiler:
+                rerun_profiler.record("再実行全体", time.perf_counter() - script_started_at)
+                st.write("**この再実行**")
+                st.dataframe(rerun_profiler.report(), use_container_width=True, hide_index=True)
+                st.caption("セクションの時間には、その中の質問CSVの解析・CSV出力の時間も含まれます。")
+            
+            job_profile = st.session_state.generation_run.get("profile") if 'generation_run' in st.session_state else None
+            if job_profile:
+                st.write(f"**直前の生成ジョブ**（{job_profile['combination_count']:,}組み合わせ・{job_profile['row_count']:,}行）")
+                st.dataframe(job_profile["stages"], use_container_width=True, hide_index=True)
+                st.caption("平均は1回（1組み合わせ）あたりの時間です。ヘッジ付きの呼び出しは別スレッドで実行されるため、cProfileでは待ち時間として記録されます。")
+                if job_profile.get("cprofile_dump"):
+                    st.download_button(
+                        label="cProfileの記録をダウンロード（.prof）",
+                        data=job_profile["cprofile_dump"],
+                        file_name=f"generation_{st.session_state.generation_run['timestamp']}.prof",
+                        mime="application/octet-stream",
+                        help="python -m pstats や snakeviz で開けます"
+                    )
+                    st.code(job_profile["cprofile_text"], language=None)
+            elif not rerun_profiler:
+                st.caption("プロファイルモードをオンにすると、この再実行と次の生成ジョブの所要時間の内訳を表示します。")
 
@@ -0,0 +1,114 @@
+"""キーワード組み合わせの縮小（網羅配列・層化ランダムサンプル）と網羅率の計算
+
+カテゴリごとの値リスト（例: [["太陽", "月"], ["牡羊座", "牡牛座", "双子座"]]）から、全組み合わせの代わりに
+生成する組み合わせを作る。アプリ本体から切り離して単体で検証できるようにこのモジュールに置く。
+"""
+import itertools
+import random
+
+
+# 網羅配列作成関数
+def build_covering_array(value_lists, strength=2):
+    """各カテゴリの値のt個組（t=strength）をすべて1回以上含む組み合わせを貪欲法で作成する"""
+    factor_count = len(value_lists)
+    strength = min(strength, factor_count)
+    if strength == factor_count:
+        return list(itertools.product(*value_lists))
+
+    sizes = [len(values) for values in value_lists]
+    factor_sets = list(itertools.combinations(range(factor_count), strength))
+    pending = [
+        (factors, values)
+        for factors in factor_sets
+        for values in itertools.product(*(range(sizes[factor]) for factor in factors))
+    ]
+    uncovered = set(pending)
+    fill_order = sorted(range(factor_count), key=lambda factor: -sizes[factor])
+
+    rows = []
+    position = 0
+    while uncovered:
+        # 未網羅のt個組を1つ選んで行の起点にする
+        while pending[position] not in uncovered:
+            position += 1
+        seed_factors, seed_values = pending[position]
+        row = dict(zip(seed_factors, seed_values))
+
+        # 残りのカテゴリは、決定済みのカテゴリと合わせて新たに網羅できるt個組が最も多い値を選ぶ
+        for factor in fill_order:
+            if factor in row:
+                continue
+            related = [factors for factors in factor_sets if factor in factors and all(f in row or f == factor for f in factors)]
+            best_value, best_gain = 0, -1
+            for value in range(sizes[factor]):
+                row[factor] = value
+                gain = sum((factors, tuple(row[f] for f in factors)) in uncovered for factors in related)
+                if gain > best_gain:
+                    best_value, best_gain = value, gain
+            row[factor] = best_value
+
+        for factors in factor_sets:
+            uncovered.discard((factors, tuple(row[f] for f in factors)))
+        rows.append(tuple(value_lists[factor][row[factor]] for factor in range(factor_count)))
+    return rows
+
+
+# 層化ランダムサンプル作成関数
+def build_stratified_sample(value_lists, sample_size, seed=0, max_rounds=20):
+    """各カテゴリの値がほぼ均等に現れるように、指定件数の組み合わせを無作為に抽出する（重複なし）
+
+    全組み合わせ数が指定件数以下の場合は全組み合わせを返す（戻り値の件数が指定件数より少なくなるのはこの場合だけ）。
+    """
+    total_count = 1
+    for values in value_lists:
+        total_count *= len(values)
+    if sample_size >= total_count:
+        return list(itertools.product(*value_lists))
+
+    rng = random.Random(seed)
+    rows = []
+    seen = set()
+    for _ in range(max_rounds):
+        # カテゴリごとに値を均等に並べてシャッフルし、列を組み合わせる（重複した行は次の試行で補う）
+        columns = []
+        for values in value_lists:
+            column = [values[i % len(values)] for i in range(sample_size)]
+            rng.shuffle(column)
+            columns.append(column)
+        for row in zip(*columns):
+            if row not in seen and len(rows) < sample_size:
+                seen.add(row)
+                rows.append(row)
+        if len(rows) >= sample_size:
+            return rows
+
+    # 指定件数が全組み合わせ数に近いと均等な列では重複が続くため、残りは未選択の組み合わせから無作為に補う
+    # （全組み合わせの通し番号から抽出するので、全組み合わせを展開しない）
+    needed = sample_size - len(rows)
+    for index in rng.sample(range(total_count), needed + len(rows)):
+        row = []
+        for values in reversed(value_lists):
+            index, position = divmod(index, len(values))
+            row.append(values[position])
+        row = tuple(reversed(row))
+        if row not in seen:
+            seen.add(row)
+            rows.append(row)
+            if len(rows) >= sample_size:
+                break
+    return rows
+
+
+# 組み合わせの網羅率計算関数
+def measure_combination_coverage(keyword_combinations, value_lists, strength):
+    """組み合わせが各カテゴリの値のt個組をいくつ網羅しているかを返す（網羅数, 全体数）"""
+    strength = min(strength, len(value_lists))
+    factor_sets = list(itertools.combinations(range(len(value_lists)), strength))
+    total_count = 0
+    for factors in factor_sets:
+        size = 1
+        for factor in factors:
+            size *= len(set(value_lists[factor]))
+        total_count += size
+    covered = {(factors, tuple(row[f] for f in factors)) for row in keyword_combinations for factors in factor_sets}
+    return len(covered), total_count
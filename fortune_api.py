@@ -0,0 +1,514 @@
+"""占い生成のHTTP API
+
+1件の質問とキーワードから占いを生成して返す、標準ライブラリのHTTPサーバー。画面（app.py）とは別のプロセスとして
+起動する（config.tomlの[api_server]で enabled = true の場合のみ）。
+
+    python fortune_api.py [config.tomlのパス]
+
+    POST /fortune  {"question": "...", "keywords": [{"category": "...", "keyword": "...", "target": "..."}], ...}
+    GET  /health
+
+FortuneAPI はリクエストの解釈と生成処理を関数として受け取り、認証・応答キャッシュ・同じリクエストの集約
+（同時に来た同じリクエストはモデルを1回だけ呼ぶ）を行う。FortuneGenerator は設定・クライアント・キーワードを
+受け取って、その解釈と生成処理を提供する。
+"""
+import collections
+import hashlib
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import toml
+
+from fortune_generation import ScheduledClient, generate_combination, is_error_answer, vertex_model_options
+from fortune_store import who_types
+from keyword_index import (
+    build_keyword_index, default_category_aliases, get_keyword_details, load_condensed_texts, load_keyword_directory,
+    match_keyword_category, match_keyword_name, normalize_keyword_text
+)
+from request_scheduler import QuotaExceededError, RequestScheduler, build_scheduler_settings
+from token_ledger import append_token_usage
+
+# リクエスト本文の上限（バイト）
+max_request_bytes = 64 * 1024
+
+# APIサーバーの既定の設定（config.tomlの[api_server]で変更可能、トークンはSecretsの[api_server] tokenでも設定可能）
+api_server_defaults = {
+    "enabled": False,
+    "host": "127.0.0.1",
+    "port": 8765,
+    "token": "",                   # 設定すると Authorization: Bearer トークン が必要になる
+    "backend": "vertex",           # "fake" にするとモデルを呼ばずに疑似の回答を返す（動作確認・負荷試験用）
+    "fake_latency_seconds": 0.0,   # 疑似の回答を返すまでの秒数
+    "model": "gemini-2.5-flash",
+    "thinking_budget": 0,
+    "answer_length": 300,
+    "summary_length": 20,
+    "length_tolerance": 30,
+    "presets_path": "",            # 画面からエクスポートしたプリセットのJSON
+    "cache_size": 1024,            # 応答キャッシュの件数
+    "cache_ttl_seconds": 3600      # 応答キャッシュの有効期間（秒）
+}
+
+
+# APIのエラー
+class APIError(Exception):
+    """HTTPステータスを付けて返すエラー"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# 応答キャッシュ
+class ResponseCache:
+    """生成結果を一定時間・一定件数まで保持する（古いものから破棄）"""
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+# 同じリクエストの集約
+class RequestCoalescer:
+    """同じキーの処理が実行中なら、新たに実行せずにその結果を待って共有する"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.coalesced = 0
+
+    def run(self, key, function):
+        """(結果, 集約したかどうか) を返す（実行中の処理が例外になった場合は同じ例外を送出する）"""
+        with self.lock:
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self.in_flight[key] = call
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                call["result"] = function()
+            except BaseException as e:
+                call["error"] = e
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+                call["done"].set()
+        else:
+            call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"], not leader
+
+
+# APIの本体
+class FortuneAPI:
+    """リクエストを解釈し、キャッシュ・集約を通して生成関数を呼び出す
+
+    prepare: リクエストの辞書から (キャッシュキーの文字列, 生成関数に渡す値) を作る関数（入力の誤りは APIError(400) を送出する）
+    generate: prepare が作った値から、応答する結果（辞書）を返す関数
+    """
+
+    def __init__(self, prepare, generate, cache=None, token=""):
+        self.prepare = prepare
+        self.generate = generate
+        self.cache = cache or ResponseCache()
+        self.coalescer = RequestCoalescer()
+        self.token = token
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "generated": 0, "errors": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def is_authorized(self, authorization):
+        """トークンを設定している場合は Authorization: Bearer トークン を確認する"""
+        if not self.token:
+            return True
+        return hmac.compare_digest((authorization or "").encode("utf-8"), f"Bearer {self.token}".encode("utf-8"))
+
+    def handle(self, payload):
+        """1件のリクエストを処理し、(ステータス, 応答の辞書) を返す"""
+        self.count("requests")
+        started_at = time.perf_counter()
+        try:
+            if not isinstance(payload, dict):
+                raise APIError(400, "リクエストはJSONのオブジェクトで指定してください")
+            cache_key, request = self.prepare(payload)
+            key = hashlib.sha256(cache_key.encode("utf-8")).hexdigest()
+            result = self.cache.get(key)
+            source = "cache"
+            if result is None:
+                result, coalesced = self.coalescer.run(key, lambda: self.generate(request))
+                source = "coalesced" if coalesced else "generated"
+                if not coalesced:
+                    self.count("generated")
+                    self.cache.put(key, result)
+        except APIError as e:
+            self.count("errors")
+            return e.status, {"error": e.message}
+        except Exception as e:
+            self.count("errors")
+            return 502, {"error": str(e)}
+        return 200, dict(result, source=source, elapsed_ms=round((time.perf_counter() - started_at) * 1000, 1))
+
+    def snapshot(self):
+        """リクエスト数・キャッシュのヒット数などを返す"""
+        with self.lock:
+            stats = dict(self.stats)
+        stats.update(
+            cache_hits=self.cache.hits, cache_misses=self.cache.misses, cache_entries=len(self.cache.entries),
+            coalesced=self.coalescer.coalesced, in_flight=len(self.coalescer.in_flight)
+        )
+        return stats
+
+
+# 疑似モデルのレスポンス
+FakeModelResponse = collections.namedtuple("FakeModelResponse", ["text", "usage_metadata"])
+
+
+# 疑似モデルのクライアント
+class FakeModelClient:
+    """モデルを呼ばずに、プロンプトから決まる疑似の回答（JSON）を返すクライアント（HTTP APIの動作確認用）"""
+
+    def __init__(self, latency_seconds=0.0):
+        self.latency_seconds = latency_seconds
+        self.models = self
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(self.latency_seconds)
+        digest = hashlib.sha256(f"{getattr(config, 'system_instruction', '')}\n{contents}".encode('utf-8')).hexdigest()[:8]
+        lengths = re.findall(r'(\d+)文字程度', getattr(config, 'system_instruction', None) or "")
+        answer_length, summary_length = (int(lengths[0]), int(lengths[1])) if len(lengths) >= 2 else (100, 20)
+        answer = {
+            "回答": f"（疑似回答 {digest}）".ljust(answer_length, "。"),
+            "サマリ": f"（疑似 {digest}）".ljust(summary_length, "。"),
+            "元キーワード": "",
+            "アレンジキーワード": ""
+        }
+        return FakeModelResponse(json.dumps(answer, ensure_ascii=False), None)
+
+
+# 占いの生成
+class FortuneGenerator:
+    """HTTP APIのリクエストを解釈し、1件の占いを生成する（設定・クライアント・キーワードは呼び出し側から受け取る）
+
+    settings: [api_server] の設定（既定のモデル・文字数など）
+    client: client.models.generate_content で呼び出せるモデルのクライアント
+    scheduler: 指定するとロール「api」のジョブとして順番を待つ（トークン上限に達した場合は429を返す）
+    ledger_path: 指定するとトークン使用量を台帳に記録する
+    condense_cache_path: 指定するとプリセットの要約の文字数上限に、要約キャッシュにある文だけ置き換える
+    """
+
+    def __init__(self, settings, client, keyword_index, presets=None, system_prompt="", scheduler=None, ledger_path=None, condense_cache_path=None):
+        self.settings = settings
+        self.client = client
+        self.keyword_index = keyword_index
+        self.presets = presets or {}
+        self.system_prompt = system_prompt
+        self.scheduler = scheduler
+        self.ledger_path = ledger_path
+        self.condense_cache_path = condense_cache_path
+
+    def resolve_keywords(self, keywords):
+        """リクエストの {category, keyword, target} の一覧を、読み込み済みの (カテゴリ, キーワード, 対象) に照合する"""
+        if not isinstance(keywords, list):
+            raise APIError(400, "keywords は {category, keyword, target} の配列で指定してください")
+        keyword_triples = []
+        for item in keywords:
+            if not isinstance(item, dict):
+                raise APIError(400, "keywords は {category, keyword, target} の配列で指定してください")
+            category_name = match_keyword_category(self.keyword_index, str(item.get("category", "")))
+            if category_name is None:
+                raise APIError(400, f"カテゴリ「{item.get('category', '')}」は読み込まれていません")
+            keyword_name = match_keyword_name(self.keyword_index, category_name, str(item.get("keyword", "")))
+            if keyword_name is None or keyword_name == "すべて":
+                raise APIError(400, f"{category_name}のキーワード「{item.get('keyword', '')}」はありません")
+            who = str(item.get("target") or "あなた").strip()
+            if who not in who_types:
+                raise APIError(400, f"対象「{who}」は {'・'.join(who_types)} のいずれかで指定してください")
+            keyword_triples.append((category_name, keyword_name, who))
+        return keyword_triples
+
+    def prepare(self, payload):
+        """リクエストを検証して生成設定を作り、(キャッシュキー, 生成に渡す値) を返す"""
+        question = str(payload.get("question") or "").strip()
+        if not question:
+            raise APIError(400, "question を指定してください")
+        keyword_triples = self.resolve_keywords(payload.get("keywords", []))
+
+        preset_name = str(payload.get("preset") or "")
+        if preset_name and preset_name not in self.presets:
+            raise APIError(400, f"プリセット「{preset_name}」はありません")
+        preset_info = self.presets.get(preset_name, {})
+        model_name = str(payload.get("model") or self.settings["model"])
+        if model_name not in vertex_model_options:
+            raise APIError(400, f"モデル「{model_name}」は使用できません（{', '.join(vertex_model_options)}）")
+        try:
+            thinking_budget, answer_length, summary_length = (
+                int(payload.get(name, self.settings[name])) for name in ["thinking_budget", "answer_length", "summary_length"]
+            )
+        except (TypeError, ValueError):
+            raise APIError(400, "thinking_budget・answer_length・summary_length は整数で指定してください")
+        if not (0 <= thinking_budget <= 4096 and 50 <= answer_length <= 2000 and 20 <= summary_length <= 500):
+            raise APIError(400, "thinking_budget は0〜4096、answer_length は50〜2000、summary_length は20〜500で指定してください")
+
+        # プリセットの要約の文字数上限は、要約キャッシュにある文だけ置き換える（APIではモデルで要約しない）
+        keyword_columns = preset_info.get("keyword_columns", {})
+        condense_limit = int(preset_info.get("condense_limit", 0))
+        condensed_texts = {}
+        if condense_limit and self.condense_cache_path:
+            texts = {
+                text for category_type, value, _ in keyword_triples
+                for col, text in get_keyword_details(self.keyword_index, category_type, value).items()
+                if len(text) > condense_limit and (category_type not in keyword_columns or col in keyword_columns[category_type])
+            }
+            condensed_texts = load_condensed_texts(texts, condense_limit, self.condense_cache_path)
+
+        settings = {
+            "system_prompt": self.system_prompt,
+            "user_rules": preset_info.get("rules", ""),
+            "user_tone": preset_info.get("tone", ""),
+            "selected_categories": [category_type for category_type, _, _ in keyword_triples],
+            "id_list": [],
+            "model_chain": [model_name],
+            "cascade_enabled": False,
+            "thinking_budget": thinking_budget,
+            "answer_length": answer_length,
+            "summary_length": summary_length,
+            "length_tolerance": int(self.settings["length_tolerance"]),
+            "preset_name": preset_name,
+            "input_mode": "HTTP API",
+            "symmetric_categories": [],
+            "keyword_columns": keyword_columns,
+            "condensed_texts": condensed_texts
+        }
+        # キーワードの並び順によらず同じリクエストとして扱う
+        cache_key = json.dumps([
+            normalize_keyword_text(question), sorted(keyword_triples),
+            preset_name, model_name, thinking_budget, answer_length, summary_length
+        ], ensure_ascii=False)
+        return cache_key, {"question": question, "keyword_triples": keyword_triples, "settings": settings}
+
+    def generate(self, request):
+        """1件の占いを生成する（スケジューラがあれば順番を待ち、台帳の保存先があればトークン使用量を記録する）"""
+        keyword_triples = request["keyword_triples"]
+        combo = (
+            "api", request["question"],
+            tuple(value for _, value, _ in keyword_triples), tuple(who for _, _, who in keyword_triples), None
+        )
+        client = self.client
+        job_id = None
+        if self.scheduler is not None:
+            job_id = self.scheduler.start_job("api", f"HTTP API: {request['question'][:20]}", 1)
+            client = ScheduledClient(client, self.scheduler, job_id)
+        started_at = time.time()
+        try:
+            outcome = generate_combination(client, combo, request["settings"], self.keyword_index)
+        except QuotaExceededError as e:
+            raise APIError(429, str(e))
+        finally:
+            if job_id is not None:
+                self.scheduler.finish_job(job_id)
+        if self.ledger_path:
+            append_token_usage(self.ledger_path, "HTTP API", "api", request["settings"], 1, 1, outcome["usage"], time.time() - started_at)
+
+        row = outcome["rows"][0]
+        if is_error_answer(row["回答"]):
+            raise APIError(502, row["回答"])
+        return {
+            "回答": row["回答"],
+            "サマリ": row["サマリ"],
+            "元キーワード": row["元キーワード"],
+            "アレンジキーワード": row["アレンジキーワード"],
+            "生成モデル": row["生成モデル"],
+            "keywords": [{"category": category_type, "keyword": value, "target": who} for category_type, value, who in keyword_triples],
+            "usage": dict(zip(["input", "output", "thinking", "cached"], outcome["usage"]))
+        }
+
+
+# HTTPリクエストの処理
+class FortuneRequestHandler(BaseHTTPRequestHandler):
+    """POST /fortune と GET /health を受け付ける（server.api に FortuneAPI を持たせる）"""
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, dict(self.server.api.snapshot(), status="ok"))
+        else:
+            self.send_json(404, {"error": "見つかりません"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > max_request_bytes:
+            self.send_json(413, {"error": "リクエストが大きすぎます"})
+            self.close_connection = True
+            return
+        body = self.rfile.read(length)
+        if self.path != "/fortune":
+            self.send_json(404, {"error": "見つかりません"})
+        elif not self.server.api.is_authorized(self.headers.get("Authorization")):
+            self.send_json(401, {"error": "認証に失敗しました"})
+        else:
+            try:
+                payload = json.loads(body.decode("utf-8") or "{}")
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                self.send_json(400, {"error": "JSONを解析できません"})
+                return
+            self.send_json(*self.server.api.handle(payload))
+
+    def log_message(self, format, *args):
+        # リクエストごとのアクセスログは出さない
+        pass
+
+
+# サーバー作成関数
+def create_api_server(api, host="127.0.0.1", port=8765):
+    """FortuneAPI を受け付けるHTTPサーバーを作成する（待ち受けは server.serve_forever()）"""
+    server = ThreadingHTTPServer((host, port), FortuneRequestHandler)
+    server.daemon_threads = True
+    server.api = api
+    return server
+
+
+# サーバー起動関数
+def start_api_server(api, host="127.0.0.1", port=8765):
+    """HTTPサーバーを専用スレッドで起動し、サーバーを返す（停止は server.shutdown()、テスト・組み込み用）"""
+    server = create_api_server(api, host, port)
+    threading.Thread(target=server.serve_forever, name="fortune-api", daemon=True).start()
+    return server
+
+
+# 設定ファイル読み込み関数
+def load_toml(path):
+    """TOMLファイルを読み込む（ファイルがなければ空の辞書）"""
+    return toml.load(path) if os.path.exists(path) else {}
+
+
+# APIサーバー設定作成関数
+def load_api_settings(config, secrets=None):
+    """config.tomlの[api_server]を既定の設定に重ねる（Secretsの[api_server] tokenがあればそちらを使う）"""
+    settings = dict(api_server_defaults, **config.get("api_server", {}))
+    token = (secrets or {}).get("api_server", {}).get("token")
+    if token:
+        settings["token"] = token
+    return settings
+
+
+# モデルのクライアント作成関数
+def create_model_client(settings, config, secrets=None):
+    """[api_server] backend に応じて、疑似のクライアントかVertex AIのクライアントを作成する
+
+    プロジェクト・リージョンは画面と同じく Secrets の[api] → 環境変数 → config.tomlの[api] の順に探し、
+    Secretsに[gcp_service_account]があればその認証情報を使う（なければ既定の認証情報）。
+    """
+    if settings["backend"] == "fake":
+        return FakeModelClient(float(settings["fake_latency_seconds"]))
+    import google.genai as genai
+
+    secrets = secrets or {}
+    project = secrets.get("api", {}).get("vertex_project") or os.environ.get("VERTEX_AI_PROJECT_ID") or config.get("api", {}).get("vertex_project")
+    location = secrets.get("api", {}).get("vertex_location") or os.environ.get("VERTEX_AI_LOCATION") or config.get("api", {}).get("vertex_location", "us-central1")
+    if not project:
+        raise ValueError("Project IDが設定されていません（Secrets・config.tomlの[api] vertex_project、または環境変数 VERTEX_AI_PROJECT_ID）")
+    credentials = None
+    if "gcp_service_account" in secrets:
+        from google.oauth2 import service_account
+        credentials = service_account.Credentials.from_service_account_info(
+            dict(secrets["gcp_service_account"]), scopes=["https://www.googleapis.com/auth/cloud-platform"]
+        )
+    return genai.Client(vertexai=True, project=project, location=location, credentials=credentials)
+
+
+# コマンドライン
+def main(argv):
+    """使い方: python fortune_api.py [config.tomlのパス]（[api_server] enabled = true の場合のみ起動する）"""
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    config = load_toml(argv[0] if argv else os.path.join(base_path, "config.toml"))
+    secrets = load_toml(os.path.join(base_path, ".streamlit", "secrets.toml"))
+    settings = load_api_settings(config, secrets)
+    if not settings["enabled"]:
+        print("HTTP APIは無効です（config.tomlの[api_server]で enabled = true にすると起動します）", file=sys.stderr)
+        return 2
+
+    # キーワード・プリセット・システムプロンプトは起動時に読み込む（更新した場合は再起動する）
+    keyword_settings = config.get("keywords", {})
+    keyword_index = build_keyword_index(
+        load_keyword_directory(keyword_settings.get("directory", base_path), keyword_settings.get("pattern", "*キーワード.csv")),
+        dict(default_category_aliases, **config.get("keyword_aliases", {}))
+    )
+    presets = {}
+    if settings["presets_path"]:
+        with open(settings["presets_path"], encoding="utf-8") as f:
+            presets = json.load(f)
+    system_prompt = config.get("prompts", {}).get("default_system_prompt") or secrets.get("prompts", {}).get("default_system_prompt", "")
+
+    generator = FortuneGenerator(
+        settings, create_model_client(settings, config, secrets), keyword_index, presets, system_prompt,
+        scheduler=RequestScheduler(build_scheduler_settings(config)),
+        ledger_path=config.get("ledger", {}).get("path", os.path.join(base_path, "token_ledger.sqlite3")),
+        condense_cache_path=config.get("condense", {}).get("path", os.path.join(base_path, "keyword_condense_cache.sqlite3"))
+    )
+    api = FortuneAPI(
+        generator.prepare, generator.generate,
+        ResponseCache(int(settings["cache_size"]), float(settings["cache_ttl_seconds"])), settings["token"]
+    )
+    try:
+        server = create_api_server(api, settings["host"], int(settings["port"]))
+    except OSError as e:
+        print(f"HTTP APIを起動できませんでした（{settings['host']}:{settings['port']}）: {e}", file=sys.stderr)
+        return 1
+    print(f"http://{settings['host']}:{settings['port']}/fortune で待ち受けています（{settings['backend']}、キーワード{len(keyword_index['categories'])}カテゴリ）", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
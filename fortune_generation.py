@@ -0,0 +1,597 @@
+"""占いの生成（プロンプト構築・モデル呼び出し・レスポンス解析）
+
+1つの組み合わせ（質問とキーワード）から占いの回答を生成する処理。モデルのクライアントと生成設定は呼び出し側から
+受け取るため、画面（app.py）とHTTP APIサーバー（fortune_api.py）の両方から同じ処理で生成できる。
+"""
+import contextlib
+import json
+import re
+
+from keyword_index import build_prompt_keywords
+from request_scheduler import QuotaExceededError
+
+# Google GenAI SDK（古いSDKのみの環境でも読み込めるようにする）
+try:
+    from google.genai import types
+except ImportError:
+    types = None
+
+
+# Vertex AI モデルオプション
+vertex_model_options = [
+    "gemini-2.0-flash",
+    "gemini-2.5-flash",
+    "gemini-2.5-pro"
+]
+
+
+# モデルごとの生成設定を作成する関数
+def build_generate_config(model_name, thinking_budget, max_output_tokens=None, system_instruction=None):
+    """モデルに応じた生成設定を作成する（思考機能はGemini 2.5のみ）"""
+    if "2.5" in model_name:
+        # Proモデルでは128以上の値が必要
+        budget = max(thinking_budget, 128) if model_name == "gemini-2.5-pro" else thinking_budget
+        return types.GenerateContentConfig(
+            system_instruction=system_instruction,
+            thinking_config=types.ThinkingConfig(thinking_budget=budget),
+            max_output_tokens=max_output_tokens
+        )
+    return types.GenerateContentConfig(system_instruction=system_instruction, max_output_tokens=max_output_tokens)
+
+
+# モデルごとのThinking Budget取得関数
+def get_thinking_budget(settings, model_name):
+    """モデルのThinking Budgetを返す（カスケードモードではモデルごとに設定した値を使う）"""
+    return settings.get("thinking_budgets", {}).get(model_name, settings["thinking_budget"])
+
+
+# モデル呼び出し関数
+def generate_content(client, model_name, prompt, thinking_budget, max_output_tokens=None, system_instruction=None):
+    """指定したモデルでコンテンツを生成する（固定の指示はsystem_instructionで送る）"""
+    return client.models.generate_content(
+        model=model_name,
+        contents=prompt,
+        config=build_generate_config(model_name, thinking_budget, max_output_tokens, system_instruction)
+    )
+
+
+# トークン数取得関数
+def get_token_usage(response):
+    """レスポンスからトークン数（入力, 出力, 思考, キャッシュ）を取得する"""
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage:
+        return 0, 0, 0, 0
+    return tuple(
+        getattr(usage, name, None) or 0
+        for name in ('prompt_token_count', 'candidates_token_count', 'thoughts_token_count', 'cached_content_token_count')
+    )
+
+
+# スケジューラ経由のクライアント
+class ScheduledClient:
+    """共有スケジューラで順番を待ってからモデルを呼び出すクライアント"""
+
+    def __init__(self, client, scheduler, job_id):
+        self.client = client
+        self.scheduler = scheduler
+        self.job_id = job_id
+        # client.models.generate_content と同じ形で呼び出せるようにする
+        self.models = self
+
+    def generate_content(self, model, contents, config=None):
+        self.scheduler.acquire(self.job_id)
+        tokens = 0
+        try:
+            response = self.client.models.generate_content(model=model, contents=contents, config=config)
+            tokens = sum(get_token_usage(response)[:3])
+            return response
+        finally:
+            self.scheduler.release(self.job_id, tokens)
+
+    def update(self, done):
+        self.scheduler.update_job(self.job_id, done)
+
+    def finish(self):
+        self.scheduler.finish_job(self.job_id)
+
+
+# JSON抽出関数
+def parse_json_response(text):
+    """レスポンステキストからJSONオブジェクトを抽出して解析する（見つからない場合はNone）"""
+    cleaned_text = text.strip()
+
+    # マークダウンのコードブロックを除去
+    if cleaned_text.startswith("```json"):
+        cleaned_text = cleaned_text[7:]
+    elif cleaned_text.startswith("```"):
+        cleaned_text = cleaned_text[3:]
+
+    if cleaned_text.endswith("```"):
+        cleaned_text = cleaned_text[:-3]
+
+    cleaned_text = cleaned_text.strip()
+
+    # JSONの開始位置と終了位置を検出
+    start_idx = cleaned_text.find("{")
+    end_idx = cleaned_text.rfind("}")
+
+    if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
+        return json.loads(cleaned_text[start_idx:end_idx + 1])
+    return None
+
+
+# 通常モードの回答解析関数
+def parse_single_response(text):
+    """単一質問の回答を解析する（回答, サマリ, 元キーワード, アレンジキーワード, 解析成功フラグ）"""
+    if not text:
+        return "回答を生成できませんでした", "", "", "", False
+
+    try:
+        json_response = parse_json_response(text)
+    except json.JSONDecodeError:
+        # JSON解析に失敗した場合は元のテキストを回答に入れる
+        return text, "JSON解析エラー", "", "", False
+
+    if json_response is None:
+        # JSON形式が見つからない場合
+        return text, "", "", "", False
+
+    return (
+        json_response.get("回答", ""),
+        json_response.get("サマリ", ""),
+        json_response.get("元キーワード", ""),
+        json_response.get("アレンジキーワード", ""),
+        True
+    )
+
+
+# 壊れたJSONからの回答抽出関数
+def salvage_batch_answers(text):
+    """部分的に壊れたレスポンスから、idと回答を持つ整形式の回答オブジェクトをすべて抽出する"""
+    decoder = json.JSONDecoder()
+    salvaged = []
+    pos = text.find("{")
+    while pos != -1:
+        try:
+            obj, end_pos = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            pos = text.find("{", pos + 1)
+            continue
+        if isinstance(obj, dict) and "id" in obj and "回答" in obj:
+            salvaged.append(obj)
+            pos = text.find("{", end_pos)
+        else:
+            pos = text.find("{", pos + 1)
+    return salvaged
+
+
+# 壊れたJSONからの文字列項目抽出関数
+def salvage_string_field(text, field_name):
+    """部分的に壊れたレスポンスから指定した文字列項目の値を抽出する（見つからない場合は空文字）"""
+    match = re.search(r'"' + re.escape(field_name) + r'"\s*:\s*("(?:[^"\\]|\\.)*")', text)
+    if not match:
+        return ""
+    try:
+        return json.loads(match.group(1))
+    except json.JSONDecodeError:
+        return ""
+
+
+# CSV連続モードの回答解析関数
+def parse_batch_response(text):
+    """複数質問の回答をIDで対応付けて解析する（IDごとの結果, 元キーワード, アレンジキーワード, エラー内容）"""
+    if not text:
+        return {}, "", "", "回答を生成できませんでした"
+
+    answers = None
+    parse_error = None
+    try:
+        json_response = parse_json_response(text)
+        if json_response is None:
+            parse_error = "JSON解析エラー"
+        elif not isinstance(json_response.get("回答"), list):
+            parse_error = "JSON解析エラー: 回答の一覧が見つかりません"
+        else:
+            answers = json_response["回答"]
+            original_keyword = json_response.get("元キーワード", "")
+            arranged_keyword = json_response.get("アレンジキーワード", "")
+    except json.JSONDecodeError as e:
+        parse_error = f"JSON解析エラー: {str(e)}"
+
+    if answers is None:
+        # 壊れたレスポンスから整形式の回答だけを救出する
+        answers = salvage_batch_answers(text)
+        original_keyword = salvage_string_field(text, "元キーワード")
+        arranged_keyword = salvage_string_field(text, "アレンジキーワード")
+
+    # 位置ではなくIDで対応付ける（重複したIDは最初の回答を採用）
+    answers_by_id = {}
+    for answer in answers:
+        if not isinstance(answer, dict):
+            continue
+        answer_id = str(answer.get("id", "")).strip()
+        if answer_id and answer_id not in answers_by_id:
+            answers_by_id[answer_id] = {
+                "回答": answer.get("回答", ""),
+                "サマリ": answer.get("サマリ", "")
+            }
+    return answers_by_id, original_keyword, arranged_keyword, parse_error
+
+
+# 文字数チェック関数
+def check_length(text, target_length, tolerance):
+    """文字数が指定文字数の許容誤差（%）以内かを判定する"""
+    return abs(len(str(text)) - target_length) <= target_length * tolerance / 100
+
+
+# カスケードモードのエスカレーション判定関数
+def find_escalation_reason(parsed_ok, answers, answer_length, summary_length, tolerance, truncated=False):
+    """上位モデルで再生成すべき理由を返す（問題がなければNone）"""
+    if truncated:
+        return "出力上限到達"
+    if not parsed_ok:
+        return "JSON解析エラー"
+    if not answers:
+        return "空の回答"
+    for answer_text, summary_text in answers:
+        if not str(answer_text).strip():
+            return "空の回答"
+        if not check_length(answer_text, answer_length, tolerance) or not check_length(summary_text, summary_length, tolerance):
+            return "文字数不一致"
+    return None
+
+
+# 最大出力トークン数の算出関数
+def derive_max_output_tokens(model_name, answer_length, summary_length, question_count, thinking_budget, tolerance):
+    """指定文字数から最大出力トークン数を算出する（日本語は1文字≒1トークンとして見積もる）"""
+    # 回答・サマリの許容上限（許容誤差が小さくても指定文字数の1.5倍以上）に、JSONの構造とキーワード欄の分を加算
+    per_question = int((answer_length + summary_length) * max(1.5, 1 + tolerance / 100)) + 100
+    max_tokens = per_question * question_count + 200
+    # Gemini 2.5では思考トークンも最大出力トークン数に含まれる
+    if "2.5" in model_name:
+        max_tokens += max(thinking_budget, 128) if model_name == "gemini-2.5-pro" else thinking_budget
+    return max_tokens
+
+
+# 出力上限による打ち切り判定関数
+def is_truncated_response(response):
+    """レスポンスが最大出力トークン数に達して打ち切られたかどうかを判定する"""
+    candidates = getattr(response, "candidates", None) or []
+    finish_reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return getattr(finish_reason, "name", finish_reason) == "MAX_TOKENS"
+
+
+# 出力上限を考慮したモデル呼び出し関数
+def generate_content_within_limit(client, model_name, prompt, thinking_budget, max_output_tokens, system_instruction, usage):
+    """モデルを呼び出し、出力が最大出力トークン数で打ち切られた場合は上限を2倍にして1回だけ再試行する
+
+    トークン数は全試行分を usage に加算する。戻り値: (レスポンス, 呼び出し回数, 再試行しても打ち切られたかどうか)
+    """
+    request_count = 0
+    for attempt_max_tokens in (max_output_tokens, max_output_tokens * 2):
+        response = generate_content(client, model_name, prompt, thinking_budget, attempt_max_tokens, system_instruction)
+        request_count += 1
+        for usage_idx, count in enumerate(get_token_usage(response)):
+            usage[usage_idx] += count
+        if not is_truncated_response(response):
+            return response, request_count, False
+    return response, request_count, True
+
+
+# プロンプト構築関数
+def build_fortune_prompt(settings, current_question, all_keywords, is_batch_mode, answered_context=None):
+    """プロンプトを、固定の指示（system_instructionとして送る）と、キーワード→質問の順に並べた本文に分けて構築する
+
+    共通部分ほど先頭に置き、同じ設定の呼び出し間でプレフィックスキャッシュが効くようにする
+    answered_context: CSV連続モードの再リクエスト時に参考として渡す回答済みの（ID, 質問, 回答）の一覧
+    戻り値: (system_instruction, contents)
+    """
+    answer_length = settings["answer_length"]
+    summary_length = settings["summary_length"]
+    id_list = settings["id_list"]
+
+    # 固定の指示：システムプロンプト・ルール・トンマナ・出力形式
+    system_instruction = settings["system_prompt"] + "\n\n"
+
+    # ユーザー定義のルールとトンマナを追加
+    if settings["user_rules"]:
+        system_instruction += f"<rules>\n{settings['user_rules']}\n</rules>\n\n"
+
+    if settings["user_tone"]:
+        system_instruction += f"<tone_and_style>\n{settings['user_tone']}\n</tone_and_style>\n\n"
+
+    # 文字数指定を追加（JSON形式で出力）
+    if is_batch_mode:
+        # CSV連続モード：複数質問用のJSON形式
+        system_instruction += f"【出力形式】\n"
+        system_instruction += f"必ず以下の正確なJSON形式のみを出力してください。前後に説明文を入れないでください：\n"
+        system_instruction += f'{{\n'
+        system_instruction += f'  "回答": [\n'
+        for q_idx, (q_id, _) in enumerate(zip(id_list, current_question)):
+            system_instruction += f'    {{\n'
+            system_instruction += f'      "id": "{q_id}",\n'
+            system_instruction += f'      "回答": "{answer_length}文字程度で詳細な占い結果",\n'
+            system_instruction += f'      "サマリ": "{summary_length}文字程度で要点をまとめた内容"\n'
+            system_instruction += f'    }}'
+            if q_idx < len(id_list) - 1:
+                system_instruction += ','
+            system_instruction += '\n'
+        system_instruction += f'  ],\n'
+        system_instruction += f'  "元キーワード": "使用したキーワードを記載",\n'
+        system_instruction += f'  "アレンジキーワード": "アレンジしたキーワードを記載"\n'
+        system_instruction += f'}}\n'
+    else:
+        # 通常モード：単一質問用のJSON形式
+        system_instruction += f"【出力形式】\n"
+        system_instruction += f"必ず以下の正確なJSON形式のみを出力してください。前後に説明文を入れないでください：\n"
+        system_instruction += f'{{\n'
+        system_instruction += f'  "回答": "{answer_length}文字程度で詳細な占い結果(ここには使用キーワードは記載しない)",\n'
+        system_instruction += f'  "サマリ": "{summary_length}文字程度で要点をまとめた内容",\n'
+        system_instruction += f'  "元キーワード": "使用したキーワードを記載（なければ空文字）",\n'
+        system_instruction += f'  "アレンジキーワード": "アレンジしたキーワードを記載（なければ空文字）"\n'
+        system_instruction += f'}}\n'
+
+    system_instruction += f"注意事項：\n"
+    system_instruction += f"- JSONのみを出力（マークダウンのコードブロック```は使用しない）\n"
+    system_instruction += f"- 前後に説明文を含めない"
+
+    # 本文：各カテゴリのキーワードを先に追加（同じキーワードを複数の対象で使う場合は1回だけ）
+    contents = ""
+    keyword_blocks = {}
+    for category_type, value, who, keyword_dict in all_keywords:
+        if keyword_dict:
+            block = keyword_blocks.setdefault((category_type, value), {"who": [], "details": keyword_dict})
+            if who not in block["who"]:
+                block["who"].append(who)
+    for (category_type, value), block in keyword_blocks.items():
+        contents += f"【{'・'.join(block['who'])}の{category_type}キーワード】{value}\n"
+        for col, keyword_value in block["details"].items():
+            contents += f"・{col}: {keyword_value}\n"
+        contents += "\n"
+
+    # 類似回答の再生成時：似た回答になった他の組み合わせの回答を避けるよう指示する
+    if settings.get("avoid_answers"):
+        contents += "【避けること】以下は別のキーワードの組み合わせで生成済みの回答です。これらと似た内容・言い回しにならないよう、上記のキーワードならではの具体的な回答にしてください。\n"
+        for avoid_answer in settings["avoid_answers"]:
+            contents += f"・{avoid_answer}\n"
+        contents += "\n"
+
+    # 質問は最後に追加
+    if is_batch_mode:
+        if answered_context:
+            # 未回答の質問のみの再リクエスト：回答済みの内容を参考として渡す
+            contents += "以下は同じ一連の質問のうち、既に回答済みの質問と回答です。内容の一貫性を保つための参考にしてください。\n\n"
+            for q_id, question, answer in answered_context:
+                contents += f"【回答済み】(ID: {q_id}): {question}\n回答: {answer.get('回答', '')}\nサマリ: {answer.get('サマリ', '')}\n\n"
+            contents += "次の未回答の質問にのみ、回答済みの内容と関連性を持たせて答えてください。\n\n"
+        else:
+            # 複数の質問を一連の質問として処理
+            contents += "以下の質問は関連した一連の質問です。それぞれの回答に関連性を持たせて答えてください。\n\n"
+
+        # 各質問にキーワード情報を追加
+        for q_idx, (q_id, question) in enumerate(zip(id_list, current_question)):
+            enhanced_question = f"質問{q_idx + 1} (ID: {q_id}): {question}"
+            for category_type, value, who, _ in all_keywords:
+                enhanced_question += f"\n【{who}の{category_type}】{value}"
+            contents += f"{enhanced_question}\n\n"
+    else:
+        # 通常モード：単一質問の処理
+        enhanced_question = current_question
+        for category_type, value, who, _ in all_keywords:
+            enhanced_question += f"\n【{who}の{category_type}】{value}"
+
+        contents += f"質問: {enhanced_question}"
+
+    return system_instruction, contents.rstrip()
+
+
+# 組み合わせのキーワード取得関数
+def get_combination_keyword_triples(combo, settings):
+    """組み合わせで使用するキーワード（カテゴリ, キーワード, 対象）の一覧を返す"""
+    question_id, current_question, keyword_combination, who_combination, csv_validated_keywords = combo
+    if csv_validated_keywords:
+        # CSV優先モード: 検証済みキーワードを使用
+        return list(csv_validated_keywords)
+    # 通常モード: 画面で選択されたキーワードを使用
+    return list(zip(settings["selected_categories"], keyword_combination, who_combination))
+
+
+# 結果のキーワード列取得関数
+def get_keyword_columns(keyword_triples):
+    """出力CSVのキーワード列（列名, キーワード）の一覧を返す"""
+    return [(f"{who}の{category_type}{idx+1}", value) for idx, (category_type, value, who) in enumerate(keyword_triples)]
+
+
+# 結果行作成関数
+def build_result_row(question_id, question, keyword_triples, answer_text, summary_text, original_keyword, arranged_keyword, model_name):
+    """出力CSVの1行分の辞書を作成する"""
+    result_dict = {"id": question_id, "質問": question}
+
+    # 各カテゴリの値を追加（CSVモードでは実際のキーワード数だけ出力）
+    for column_name, value in get_keyword_columns(keyword_triples):
+        result_dict[column_name] = value
+
+    result_dict["回答"] = answer_text
+    result_dict["サマリ"] = summary_text
+    result_dict["元キーワード"] = original_keyword
+    result_dict["アレンジキーワード"] = arranged_keyword
+    result_dict["生成モデル"] = model_name
+    return result_dict
+
+
+# CSV連続モードの生成関数（未回答IDの再リクエスト付き）
+def generate_batch_answers(client, model_name, settings, questions, all_keywords, usage, max_followups=2):
+    """複数質問をまとめて生成し、回答が欠けたIDだけを回答済みの内容を参考に再リクエストする"""
+    id_list = settings["id_list"]
+    question_by_id = {}
+    for q_id, question in zip(id_list, questions):
+        question_by_id.setdefault(str(q_id).strip(), question)
+
+    answers_by_id = {}
+    original_keyword = ""
+    arranged_keyword = ""
+    parse_error = None
+    followup_count = 0
+    salvaged_count = 0
+    request_count = 0
+    truncated = False
+    pending_ids = list(question_by_id.keys())
+    system_instruction, prompt = build_fortune_prompt(settings, questions, all_keywords, True)
+
+    while True:
+        max_output_tokens = derive_max_output_tokens(
+            model_name, settings["answer_length"], settings["summary_length"],
+            len(pending_ids), get_thinking_budget(settings, model_name), settings["length_tolerance"]
+        )
+        response, attempt_count, truncated = generate_content_within_limit(
+            client, model_name, prompt, get_thinking_budget(settings, model_name), max_output_tokens, system_instruction, usage
+        )
+        request_count += attempt_count
+
+        new_answers, new_original, new_arranged, error = parse_batch_response(response.text)
+        if truncated and error:
+            # 出力上限で途中までしか返らなかった（回答済みの分は使い、残りのIDは再リクエストする）
+            error = "エラー: 出力が最大出力トークン数に達しました"
+        for answer_id, answer in new_answers.items():
+            # 依頼していないIDの回答は使わない
+            if answer_id in pending_ids and answer_id not in answers_by_id:
+                answers_by_id[answer_id] = answer
+                if error:
+                    salvaged_count += 1
+        original_keyword = original_keyword or new_original
+        arranged_keyword = arranged_keyword or new_arranged
+        if followup_count == 0:
+            parse_error = error
+
+        pending_ids = [q_id for q_id in question_by_id if q_id not in answers_by_id]
+        # 1件も回答が得られない場合は再リクエストしない（カスケードモードの判定に任せる）
+        if not pending_ids or not answers_by_id or followup_count >= max_followups:
+            break
+
+        # 未回答のIDだけを、回答済みの内容を参考として再リクエスト
+        followup_count += 1
+        followup_settings = dict(settings, id_list=pending_ids)
+        answered_context = [(q_id, question_by_id[q_id], answer) for q_id, answer in answers_by_id.items()]
+        system_instruction, prompt = build_fortune_prompt(
+            followup_settings, [question_by_id[q_id] for q_id in pending_ids], all_keywords, True,
+            answered_context=answered_context
+        )
+
+    return {
+        "answers": answers_by_id,
+        "original_keyword": original_keyword,
+        "arranged_keyword": arranged_keyword,
+        "parse_error": parse_error,
+        "missing_ids": pending_ids,
+        "followup_count": followup_count,
+        "salvaged_count": salvaged_count,
+        "request_count": request_count,
+        "truncated": truncated and bool(pending_ids)
+    }
+
+
+# 組み合わせ単位の生成関数
+def generate_combination(client, combo, settings, keyword_index, profiler=None):
+    """1つの組み合わせ（CSV連続モードでは質問リスト全体）の回答を生成する（profilerを渡すと区間ごとの所要時間を記録する）"""
+    # データ構造: (ID, 質問, キーワード, 誰の情報, CSV検証済みキーワード)
+    question_id, current_question, keyword_combination, who_combination, csv_validated_keywords = combo
+    is_batch_mode = question_id == "batch"  # CSV連続モードかどうか
+
+    keyword_triples = get_combination_keyword_triples(combo, settings)
+
+    outcome = {"rows": [], "model": "", "usage": [0, 0, 0, 0], "escalation_reasons": [], "followup_count": 0, "recovered_count": 0, "parsed_ok": False, "request_count": 0}
+
+    try:
+        # キーワード取得（動的カテゴリに対応）
+        with profile_stage(profiler, "プロンプト構築"):
+            all_keywords = build_prompt_keywords(keyword_index, keyword_triples, settings)
+            if not is_batch_mode:
+                system_instruction, full_prompt = build_fortune_prompt(settings, current_question, all_keywords, is_batch_mode)
+
+        # カスケードモードでは条件を満たすまで上位モデルへ順に切り替える
+        model_chain = settings["model_chain"]
+        for model_idx, current_model in enumerate(model_chain):
+            if is_batch_mode:
+                # CSV連続モード：IDで対応付け、欠けたIDのみ再リクエスト（トークン数は全試行分を集計）
+                with profile_stage(profiler, "API呼び出し（CSV連続モード、解析を含む）"):
+                    batch = generate_batch_answers(client, current_model, settings, current_question, all_keywords, outcome["usage"])
+                outcome["followup_count"] += batch["followup_count"]
+                outcome["recovered_count"] += batch["salvaged_count"]
+                outcome["request_count"] += batch["request_count"]
+                original_keyword = batch["original_keyword"]
+                arranged_keyword = batch["arranged_keyword"]
+                parsed_ok = not batch["missing_ids"]
+                truncated = batch["truncated"]
+                checked_answers = [(a.get("回答", ""), a.get("サマリ", "")) for a in batch["answers"].values()]
+            else:
+                max_output_tokens = derive_max_output_tokens(
+                    current_model, settings["answer_length"], settings["summary_length"],
+                    1, get_thinking_budget(settings, current_model), settings["length_tolerance"]
+                )
+                # 出力上限で打ち切られた場合は上限を広げて再試行する（トークン数は全試行分を集計）
+                with profile_stage(profiler, "API呼び出し"):
+                    response, attempt_count, truncated = generate_content_within_limit(
+                        client, current_model, full_prompt, get_thinking_budget(settings, current_model), max_output_tokens, system_instruction, outcome["usage"]
+                    )
+                outcome["request_count"] += attempt_count
+
+                # JSON形式の回答を解析
+                with profile_stage(profiler, "JSON解析"):
+                    answer_text, summary_text, original_keyword, arranged_keyword, parsed_ok = parse_single_response(response.text)
+                if truncated and not parsed_ok:
+                    # JSON解析エラーではなく、再生成の対象になるエラーの行として扱う
+                    answer_text, summary_text = f"エラー: 出力が最大出力トークン数（{max_output_tokens * 2:,}）に達しました", ""
+                checked_answers = [(answer_text, summary_text)]
+
+            if not settings["cascade_enabled"] or model_idx == len(model_chain) - 1:
+                break
+            escalation_reason = find_escalation_reason(
+                parsed_ok, checked_answers, settings["answer_length"], settings["summary_length"], settings["length_tolerance"], truncated
+            )
+            if escalation_reason is None:
+                break
+            outcome["escalation_reasons"].append(escalation_reason)
+
+        outcome["model"] = current_model
+        outcome["parsed_ok"] = parsed_ok
+
+        # 結果保存
+        if is_batch_mode:
+            # CSV連続モード：複数の結果を保存
+            for q_id, question in zip(settings["id_list"], current_question):
+                batch_result = batch["answers"].get(str(q_id).strip())
+                if batch_result is None:
+                    # 再リクエストでも回答が得られなかったID
+                    batch_result = {"回答": batch["parse_error"] or "回答が見つかりませんでした", "サマリ": ""}
+                outcome["rows"].append(build_result_row(
+                    q_id, question, keyword_triples,
+                    batch_result.get("回答", ""), batch_result.get("サマリ", ""),
+                    original_keyword, arranged_keyword, current_model
+                ))
+        else:
+            # 通常モード：単一の結果を保存
+            outcome["rows"].append(build_result_row(
+                question_id, current_question, keyword_triples,
+                answer_text, summary_text, original_keyword, arranged_keyword, current_model
+            ))
+    except QuotaExceededError:
+        # トークン上限は行のエラーにせず、呼び出し元でジョブを止める
+        raise
+    except Exception as e:
+        # エラー時の結果保存
+        outcome["rows"] = [build_result_row(question_id, current_question, keyword_triples, f"エラー: {str(e)}", "", "", "", "")]
+
+    return outcome
+
+
+# エラー回答判定関数
+def is_error_answer(answer_text):
+    """生成に失敗した行の回答かどうかを判定する"""
+    answer_text = str(answer_text)
+    return answer_text.startswith(("エラー:", "JSON解析エラー")) or answer_text in ("回答を生成できませんでした", "回答が見つかりませんでした")
+
+
+# 区間計測関数
+def profile_stage(profiler, name):
+    """プロファイルモードの場合のみ、with文の区間の所要時間を記録する"""
+    return profiler.stage(name) if profiler else contextlib.nullcontext()
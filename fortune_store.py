@@ -0,0 +1,248 @@
+"""配信用の占い結果ストア
+
+生成済みの結果を (質問ID, キーワードの組み合わせ, 対象) で引ける読み取り専用のファイルに変換し、
+mmap で開いて参照する。ファイルは一時ファイルに書き出してから置き換えるため、公開中のストアを読んでいる
+プロセスは途中の状態を見ることがなく、次の参照から新しいストアに切り替わる。
+
+ファイル形式（リトルエンディアン）:
+    ヘッダー    : マジック(8) 形式バージョン(4) 件数(4) スロット数(8) 索引位置(8) メタデータ位置(8) メタデータ長(8)
+    メタデータ  : JSON（公開日時・件数など）
+    レコード    : キー長(4) 値長(4) キー 値（値は回答・サマリなどのJSON）
+    索引        : スロット数 × (キーのハッシュ(8), レコード位置(8))（オープンアドレス法、位置0は空き）
+"""
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import re
+import time
+import unicodedata
+
+# ファイル形式
+store_magic = b"FORTUNE1"
+store_format_version = 1
+header_format = struct.Struct("<8sIIQQQQ")
+slot_format = struct.Struct("<QQ")
+record_header_format = struct.Struct("<II")
+
+# キーの区切り文字（質問文・キーワードには現れない制御文字）
+key_field_separator = "\x1f"
+key_item_separator = "\x1e"
+
+# キーワードの対象
+who_types = ["あなた", "あの人", "相性"]
+
+# 出力CSVのキーワード列名（「対象のカテゴリ番号」）
+keyword_column_pattern = re.compile(rf"^({'|'.join(map(re.escape, who_types))})の(.+?)(\d+)$")
+
+
+# キー作成関数
+def make_store_key(question_id, keywords):
+    """質問IDと (対象, カテゴリ, キーワード) の一覧から、並び順によらない参照キー（バイト列）を作成する"""
+    items = sorted(
+        key_field_separator.join(unicodedata.normalize("NFKC", str(part)).strip() for part in keyword)
+        for keyword in keywords
+    )
+    return key_item_separator.join([unicodedata.normalize("NFKC", str(question_id)).strip()] + items).encode("utf-8")
+
+
+# 結果のキーワード列解析関数
+def parse_keyword_column(column_name, value):
+    """出力CSVのキーワード列（「対象のカテゴリ番号」）を (対象, カテゴリ, キーワード) に戻す"""
+    match = keyword_column_pattern.match(column_name)
+    if not match:
+        return ("", column_name, value)
+    return (match.group(1), match.group(2), value)
+
+
+# 空欄判定関数
+def is_blank_value(value):
+    """結果の列が空欄（None・NaN・空文字列）かどうかを判定する"""
+    return value is None or (isinstance(value, float) and math.isnan(value)) or str(value) == ""
+
+
+# ストアの登録内容作成関数
+def build_store_entries(records, value_columns):
+    """結果の行（列名→値の辞書）から、配信用ストアに登録する (キー, 値) の一覧を作成する
+
+    value_columns 以外の列はキーワード列として、列名から (対象, カテゴリ, キーワード) に戻してキーに使う。
+    """
+    entries = []
+    for record in records:
+        keywords = [
+            parse_keyword_column(col, str(value))
+            for col, value in record.items()
+            if col not in value_columns and not is_blank_value(value)
+        ]
+        value = {col: "" if is_blank_value(record.get(col)) else str(record[col]) for col in value_columns}
+        entries.append((make_store_key(record["id"], keywords), value))
+    return entries
+
+
+# キーのハッシュ計算関数
+def hash_store_key(key):
+    """キーの64ビットハッシュを返す（0は空きスロットを表すため使わない）"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+# ストア作成関数
+def build_fortune_store(entries, path, metadata=None):
+    """(キー, 値の辞書) の一覧から配信用ストアを作成し、一時ファイル経由で path に置き換える（同じキーは後の値を使う）
+
+    戻り値: 書き出した件数
+    """
+    records = {}
+    for key, value in entries:
+        records[key] = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    # 読み込み率50%以下になる2の累乗のスロット数
+    slot_count = 1
+    while slot_count < max(2, len(records) * 2):
+        slot_count *= 2
+
+    metadata_bytes = json.dumps(dict(metadata or {}, count=len(records)), ensure_ascii=False).encode("utf-8")
+    metadata_offset = header_format.size
+    record_offset = metadata_offset + len(metadata_bytes)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".fortune_store_", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"\0" * header_format.size)
+            f.write(metadata_bytes)
+            slots = [(0, 0)] * slot_count
+            offset = record_offset
+            for key, value_bytes in records.items():
+                f.write(record_header_format.pack(len(key), len(value_bytes)))
+                f.write(key)
+                f.write(value_bytes)
+                key_hash = hash_store_key(key)
+                slot = key_hash & (slot_count - 1)
+                while slots[slot][1]:
+                    slot = (slot + 1) & (slot_count - 1)
+                slots[slot] = (key_hash, offset)
+                offset += record_header_format.size + len(key) + len(value_bytes)
+            index_offset = offset
+            for key_hash, position in slots:
+                f.write(slot_format.pack(key_hash, position))
+            f.seek(0)
+            f.write(header_format.pack(
+                store_magic, store_format_version, len(records), slot_count, index_offset, metadata_offset, len(metadata_bytes)
+            ))
+            f.flush()
+            os.fsync(f.fileno())
+        # 配信側のプロセスが読めるようにする（mkstempは所有者のみ読み書き可能で作成する）
+        os.chmod(temp_path, 0o644)
+        # 同じディレクトリ内の置き換えはアトミックに行われる
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return len(records)
+
+
+# 配信用ストア
+class FortuneStore:
+    """配信用ストアのファイルを mmap で開き、キーで値を引く"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.slot_count, self.index_offset, metadata_offset, metadata_length = header_format.unpack_from(self.buffer, 0)
+        if magic != store_magic or version != store_format_version:
+            raise ValueError(f"{path} は配信用ストアの形式ではありません")
+        self.metadata = json.loads(self.buffer[metadata_offset:metadata_offset + metadata_length])
+        self.mask = self.slot_count - 1
+
+    def get_raw(self, key):
+        """キーに対応する値（JSONのバイト列）を返す（見つからない場合はNone）"""
+        key_hash = hash_store_key(key)
+        slot = key_hash & self.mask
+        while True:
+            slot_hash, position = slot_format.unpack_from(self.buffer, self.index_offset + slot * slot_format.size)
+            if not position:
+                return None
+            if slot_hash == key_hash:
+                key_length, value_length = record_header_format.unpack_from(self.buffer, position)
+                key_start = position + record_header_format.size
+                if self.buffer[key_start:key_start + key_length] == key:
+                    return self.buffer[key_start + key_length:key_start + key_length + value_length]
+            slot = (slot + 1) & self.mask
+
+    def lookup(self, question_id, keywords):
+        """質問IDと (対象, カテゴリ, キーワード) の一覧で占い結果を引く（見つからない場合はNone）"""
+        value = self.get_raw(make_store_key(question_id, keywords))
+        return None if value is None else json.loads(value)
+
+    def close(self):
+        self.buffer.close()
+
+
+# 自動で切り替わる配信用ストア
+class ServingStore:
+    """公開されたストアを参照し、ファイルが置き換えられたら次の参照から新しいストアに切り替える"""
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.store = None
+        self.identity = None
+        self.checked_at = 0.0
+        self.reload()
+
+    def reload(self):
+        """ファイルが置き換えられていれば開き直す（開き直した場合はTrue）"""
+        with self.lock:
+            self.checked_at = time.monotonic()
+            try:
+                file_stat = os.stat(self.path)
+            except FileNotFoundError:
+                return False
+            identity = (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+            if identity == self.identity:
+                return False
+            # 古いストアは参照中の呼び出しが終われば解放される（ここでは閉じない）
+            self.store = FortuneStore(self.path)
+            self.identity = identity
+            return True
+
+    def current(self):
+        """現在のストアを返す（一定間隔でファイルの置き換えを確認する）"""
+        if time.monotonic() - self.checked_at >= self.check_interval:
+            self.reload()
+        return self.store
+
+    def lookup(self, question_id, keywords):
+        store = self.current()
+        return None if store is None else store.lookup(question_id, keywords)
+
+
+# コマンドライン
+def main(argv):
+    """使い方: python fortune_store.py lookup ストア 質問ID 対象:カテゴリ:キーワード ... / python fortune_store.py info ストア"""
+    if len(argv) >= 2 and argv[0] == "info":
+        store = FortuneStore(argv[1])
+        print(json.dumps(store.metadata, ensure_ascii=False, indent=2))
+        return 0
+    if len(argv) >= 3 and argv[0] == "lookup":
+        store = FortuneStore(argv[1])
+        keywords = [tuple(item.split(":", 2)) for item in argv[3:]]
+        started_at = time.perf_counter()
+        result = store.lookup(argv[2], keywords)
+        elapsed = time.perf_counter() - started_at
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        print(f"({elapsed * 1e6:.1f}µs)", file=sys.stderr)
+        return 0 if result is not None else 1
+    print(main.__doc__, file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,219 @@
+"""キーワードCSVの読み込みと照合
+
+キーワードCSV（1列目がキーワード名、2列目以降が属性情報）をコンパクトな形式で保持し、カテゴリ名・キーワード名の
+表記ゆれを吸収して照合する。画面（app.py）とHTTP APIサーバー（fortune_api.py）の両方から使う。
+"""
+import glob
+import hashlib
+import io
+import os
+import sqlite3
+import sys
+import unicodedata
+
+import pandas as pd
+
+
+# カテゴリ名の別名（CSVファイル入力でのカテゴリ名の表記ゆれを吸収する）
+default_category_aliases = {
+    "星座": "サイン",
+    "12星座": "サイン",
+    "sign": "サイン",
+    "惑星": "天体",
+    "planet": "天体",
+    "宮": "ハウス",
+    "house": "ハウス",
+    "4区分": "エレメント",
+    "四区分": "エレメント",
+    "element": "エレメント",
+    "カード": "タロット",
+    "tarot": "タロット",
+    "運命軸": "MP軸"
+}
+
+
+# キーワードCSVのコンパクト化関数
+def compact_keyword_table(df, file_hash=None, raw_size=None):
+    """キーワードCSVを列ごとの文字列配列（同じ文字列は共有）とキーワード名→行番号の索引で保持する形式に変換する"""
+    columns = [str(col) for col in df.columns]
+    values = {}
+    for col, source_col in zip(columns, df.columns):
+        values[col] = tuple(sys.intern(str(v)) if pd.notna(v) else "" for v in df[source_col].tolist())
+
+    # 同じキーワード名が複数ある場合は最初の行を使用
+    index = {}
+    if columns:
+        for row, name in enumerate(values[columns[0]]):
+            if name:
+                index.setdefault(name, row)
+
+    return {"columns": columns, "values": values, "index": index, "hash": file_hash, "raw_size": raw_size}
+
+
+# カテゴリ名取得関数
+def get_keyword_category_name(file_name):
+    """キーワードCSVのファイル名からカテゴリ名を取り出す（拡張子と「キーワード」を除く）"""
+    return os.path.basename(file_name).replace('.csv', '').replace('キーワード', '')
+
+
+# キーワード照合用の正規化関数
+def normalize_keyword_text(text):
+    """全角・半角の違い（NFKC）と大文字小文字、前後の空白を吸収した照合用の文字列を返す"""
+    return unicodedata.normalize("NFKC", str(text)).strip().lower()
+
+
+# キーワードインデックス作成関数
+def build_keyword_index(keywords, aliases=None):
+    """読み込み済みのキーワードCSVから、カテゴリ名・キーワード名を定数時間で照合できるインデックスを作成する"""
+    index = {"categories": {}, "category_lookup": {}, "category_match_cache": {}}
+
+    for category_name, keyword_table in keywords.items():
+        first_column = keyword_table["columns"][0] if keyword_table["columns"] else None
+        names = [name for name in keyword_table["values"][first_column] if name] if first_column else []
+        normalized = {}
+        for name in names:
+            normalized.setdefault(normalize_keyword_text(name), name)
+
+        # キーワードの属性情報はコンパクト形式のテーブルを参照する（複製しない）
+        index["categories"][category_name] = {
+            "names": names,
+            "normalized": normalized,
+            "table": keyword_table
+        }
+        index["category_lookup"][normalize_keyword_text(category_name)] = category_name
+
+    # カテゴリ名の別名（読み込まれているカテゴリのみ有効）
+    for alias, category_name in (aliases or {}).items():
+        if category_name in index["categories"]:
+            index["category_lookup"].setdefault(normalize_keyword_text(alias), category_name)
+
+    return index
+
+
+# カテゴリ名照合関数
+def match_keyword_category(keyword_index, category_name):
+    """CSVに書かれたカテゴリ名を読み込み済みのカテゴリ名に照合する（見つからない場合はNone）"""
+    if category_name in keyword_index["categories"]:
+        return category_name
+
+    normalized_name = normalize_keyword_text(category_name)
+    matched = keyword_index["category_lookup"].get(normalized_name)
+    if matched:
+        return matched
+
+    # 部分一致での照合（同じ表記は一度だけ判定）
+    # 別名は短い英字（sign・houseなど）が無関係な語（design・greenhouse）に含まれてしまうため、カテゴリ名だけを対象にする。
+    # 複数のカテゴリ名に一致した場合は、読み込み順によらないよう最も長いカテゴリ名を使う
+    cache = keyword_index["category_match_cache"]
+    if normalized_name not in cache:
+        matches = [
+            category for category in keyword_index["categories"]
+            if normalized_name in normalize_keyword_text(category) or normalize_keyword_text(category) in normalized_name
+        ]
+        cache[normalized_name] = max(matches, key=lambda category: (len(category), category)) if matches else None
+    return cache[normalized_name]
+
+
+# キーワード名照合関数
+def match_keyword_name(keyword_index, category_name, keyword_name):
+    """CSVに書かれたキーワード名を読み込み済みのキーワード名に照合する（見つからない場合はNone）"""
+    category_index = keyword_index["categories"].get(category_name)
+    if category_index is None:
+        return None
+
+    normalized_name = normalize_keyword_text(keyword_name)
+    matched = category_index["normalized"].get(normalized_name)
+    if matched is not None:
+        return matched
+    if normalized_name in ("すべて", "all"):
+        return "すべて"
+    return None
+
+
+# キーワード一覧取得関数
+def get_keyword_names(keyword_index, category_name):
+    """カテゴリのキーワード名（CSVの1列目）の一覧を返す"""
+    category_index = keyword_index["categories"].get(category_name)
+    return category_index["names"] if category_index else []
+
+
+# キーワード選択肢取得関数
+def get_keyword_options(keyword_index, category_name):
+    """キーワード選択用の一覧（「すべて」+ キーワード名）を返す（インデックスに保持して再実行のたびに作り直さない）"""
+    category_index = keyword_index["categories"].get(category_name)
+    if not category_index:
+        return ["すべて"]
+    if "options" not in category_index:
+        category_index["options"] = ["すべて"] + category_index["names"]
+    return category_index["options"]
+
+
+# キーワード詳細取得関数
+def get_keyword_details(keyword_index, category_type, value):
+    """キーワードCSVから指定キーワードの属性情報（2列目以降の空でない値）を取得する"""
+    keyword_dict = {}
+    category_index = keyword_index["categories"].get(category_type)
+    if category_index:
+        keyword_table = category_index["table"]
+        row = keyword_table["index"].get(value)
+        if row is not None:
+            for col in keyword_table["columns"][1:]:
+                if keyword_table["values"][col][row]:
+                    keyword_dict[col] = keyword_table["values"][col][row]
+    return keyword_dict
+
+
+# プロンプト用キーワード情報作成関数
+def build_prompt_keywords(keyword_index, keyword_triples, settings):
+    """組み合わせのキーワード情報を、選択した列と要約済みの文に置き換えてプロンプト用に作成する"""
+    selected_columns = settings.get("keyword_columns") or {}
+    condensed_texts = settings.get("condensed_texts") or {}
+    all_keywords = []
+    for category_type, value, who in keyword_triples:
+        keyword_dict = get_keyword_details(keyword_index, category_type, value)
+        columns = selected_columns.get(category_type)
+        if columns is not None:
+            keyword_dict = {col: text for col, text in keyword_dict.items() if col in columns}
+        keyword_dict = {col: condensed_texts.get(text, text) for col, text in keyword_dict.items()}
+        all_keywords.append((category_type, value, who, keyword_dict))
+    return all_keywords
+
+
+# 要約キャッシュ接続関数
+def open_condense_cache(path):
+    """キーワード文の要約キャッシュに接続し、テーブルがなければ作成する"""
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS condensed_texts ("
+        "text_hash TEXT, char_limit INTEGER, condensed TEXT, created_at TEXT, PRIMARY KEY (text_hash, char_limit))"
+    )
+    return connection
+
+
+# 要約済みキーワード文読み込み関数
+def load_condensed_texts(texts, char_limit, path):
+    """キャッシュ済みの要約を、元の文→要約の辞書で返す"""
+    hashes = {hashlib.sha256(text.encode('utf-8')).hexdigest(): text for text in texts}
+    if not hashes:
+        return {}
+    try:
+        connection = open_condense_cache(path)
+        try:
+            rows = connection.execute("SELECT text_hash, condensed FROM condensed_texts WHERE char_limit = ?", (char_limit,)).fetchall()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return {}
+    return {hashes[text_hash]: condensed for text_hash, condensed in rows if text_hash in hashes}
+
+
+# キーワードCSVディレクトリ読み込み関数
+def load_keyword_directory(directory, pattern="*キーワード.csv"):
+    """ディレクトリのキーワードCSVをすべて読み込み、カテゴリ名 → テーブルの辞書を返す"""
+    tables = {}
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        with open(path, "rb") as f:
+            content = f.read()
+        df = pd.read_csv(io.BytesIO(content), encoding="utf-8", dtype=str)
+        tables[get_keyword_category_name(path)] = compact_keyword_table(df, hashlib.md5(content).hexdigest(), len(content))
+    return tables
@@ -0,0 +1,159 @@
+"""全セッション共有のリクエストスケジューラ
+
+Streamlitの全セッションからのモデル呼び出しを、同時実行数・ロールごとの重み（加重公平キュー）・トークン上限で調整する。
+スケジューラは st.cache_resource でプロセスに1つだけ作るため、再実行のたびに定義し直されないようこのモジュールに置く
+（上限超過の例外をアプリ側で型で判定できるようにする）。HTTP APIサーバー（fortune_api.py）も同じ[scheduler]の設定で
+自分のプロセス用のスケジューラを作る。
+"""
+import itertools
+import threading
+import time
+from datetime import datetime
+
+import pytz
+
+
+# スケジューラの既定の設定（config.tomlの[scheduler]で変更可能）
+default_scheduler_settings = {
+    "max_concurrency": 4,                          # 全セッション合計の同時リクエスト数
+    "role_concurrency": {"admin": 4, "user": 2},   # ロールごとの同時リクエスト数
+    "role_weights": {"admin": 2, "user": 1},       # 加重公平キューの重み（大きいほど多く割り当てる）
+    "role_daily_tokens": {},                       # ロールごとの1日あたりのトークン上限（未設定は無制限）
+    "role_job_tokens": {}                          # ロールごとの1ジョブあたりのトークン上限（1つのジョブでロールの上限を使い切らないようにする、未設定は無制限）
+}
+
+
+# スケジューラ設定作成関数
+def build_scheduler_settings(config):
+    """config.tomlの[scheduler]を既定の設定に重ねる（ロールごとの設定は既定の辞書に追加する）"""
+    settings = {key: dict(value) if isinstance(value, dict) else value for key, value in default_scheduler_settings.items()}
+    for key, value in (config or {}).get("scheduler", {}).items():
+        if isinstance(value, dict):
+            settings[key] = dict(settings.get(key, {}), **value)
+        else:
+            settings[key] = value
+    return settings
+
+
+# トークン上限のエラー
+class QuotaExceededError(RuntimeError):
+    """スケジューラのトークン上限に達したため、これ以上モデルを呼び出せない（行ごとのエラーにせずジョブを止める）"""
+
+
+# 共有リクエストスケジューラ
+class RequestScheduler:
+    """全セッションのモデル呼び出しを、同時実行数・1日のトークン上限・加重公平キューで調整する"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.condition = threading.Condition()
+        self.jobs = {}
+        self.job_counter = itertools.count(1)
+        self.running = 0
+        self.running_by_role = {}
+        self.usage_date = None
+        self.daily_tokens = {}
+
+    def start_job(self, role, label, total):
+        """ジョブを登録する（新しいジョブは実行中のジョブと同じ仮想時刻から始め、待たずに順番が回るようにする）"""
+        with self.condition:
+            active_times = [job["virtual_time"] for job in self.jobs.values() if not job["finished"]]
+            job_id = next(self.job_counter)
+            self.jobs[job_id] = {
+                "role": role,
+                "label": label,
+                "total": total,
+                "done": 0,
+                "weight": self.settings["role_weights"].get(role, 1),
+                "virtual_time": min(active_times) if active_times else 0.0,
+                "waiting": 0,
+                "running": 0,
+                "requests": 0,
+                "tokens": 0,
+                "finished": False,
+                "started_at": time.time(),
+                "updated_at": time.time()
+            }
+            return job_id
+
+    def update_job(self, job_id, done):
+        with self.condition:
+            self.jobs[job_id]["done"] = done
+            self.jobs[job_id]["updated_at"] = time.time()
+
+    def finish_job(self, job_id):
+        with self.condition:
+            self.jobs[job_id]["finished"] = True
+            self.jobs[job_id]["updated_at"] = time.time()
+            self.condition.notify_all()
+
+    def reset_daily_usage(self):
+        today = datetime.now(pytz.timezone('Asia/Tokyo')).date()
+        if self.usage_date != today:
+            self.usage_date = today
+            self.daily_tokens = {}
+
+    def is_next(self, job_id):
+        """同時実行数に空きがあり、待機中のジョブの中で仮想時刻が最も小さい（同じなら先に登録された）かを判定する"""
+        if self.running >= self.settings["max_concurrency"]:
+            return False
+
+        def can_start(job):
+            role_limit = self.settings["role_concurrency"].get(job["role"], self.settings["max_concurrency"])
+            return self.running_by_role.get(job["role"], 0) < role_limit
+
+        candidates = [(job["virtual_time"], waiting_id) for waiting_id, job in self.jobs.items() if job["waiting"] and can_start(job)]
+        return bool(candidates) and min(candidates)[1] == job_id
+
+    def acquire(self, job_id):
+        """順番が来るまで待ち、1リクエスト分の実行枠を確保する（トークン上限を超えている場合は QuotaExceededError）"""
+        with self.condition:
+            job = self.jobs[job_id]
+            job["waiting"] += 1
+            try:
+                while not self.is_next(job_id):
+                    self.condition.wait(timeout=1.0)
+
+                self.reset_daily_usage()
+                token_limit = self.settings["role_daily_tokens"].get(job["role"])
+                if token_limit and self.daily_tokens.get(job["role"], 0) >= token_limit:
+                    raise QuotaExceededError(f"本日のトークン上限（{token_limit:,}）に達しました")
+                job_token_limit = self.settings["role_job_tokens"].get(job["role"])
+                if job_token_limit and job["tokens"] >= job_token_limit:
+                    raise QuotaExceededError(f"1ジョブあたりのトークン上限（{job_token_limit:,}）に達しました")
+            finally:
+                job["waiting"] -= 1
+                # 待機をやめた場合も次のジョブに順番を回す
+                self.condition.notify_all()
+
+            job["running"] += 1
+            job["requests"] += 1
+            job["virtual_time"] += 1 / job["weight"]
+            self.running += 1
+            self.running_by_role[job["role"]] = self.running_by_role.get(job["role"], 0) + 1
+
+    def release(self, job_id, tokens):
+        """実行枠を返し、使用したトークン数を記録する"""
+        with self.condition:
+            job = self.jobs[job_id]
+            job["running"] -= 1
+            job["tokens"] += tokens
+            job["updated_at"] = time.time()
+            self.running -= 1
+            self.running_by_role[job["role"]] -= 1
+            self.reset_daily_usage()
+            self.daily_tokens[job["role"]] = self.daily_tokens.get(job["role"], 0) + tokens
+            self.condition.notify_all()
+
+    def snapshot(self, keep_seconds=600):
+        """管理者向けにキューの状態を返す（終了・停止から一定時間経ったジョブは削除する）"""
+        with self.condition:
+            now = time.time()
+            for job_id in [job_id for job_id, job in self.jobs.items() if not job["running"] and not job["waiting"] and now - job["updated_at"] > keep_seconds]:
+                del self.jobs[job_id]
+            self.reset_daily_usage()
+            return {
+                "running": self.running,
+                "daily_tokens": dict(self.daily_tokens),
+                "jobs": [dict(job, id=job_id) for job_id, job in self.jobs.items()]
+            }
@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+from answer_similarity import build_answer_shingles, compute_shingle_similarity, find_near_duplicate_answers
+
+characters = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん運勢恋愛仕事金健康星月太陽"
+
+
+def random_text(rng, length):
+    return "".join(rng.choice(characters) for _ in range(length))
+
+
+def mutate(rng, text, edits):
+    chars = list(text)
+    for position in rng.sample(range(len(chars)), edits):
+        chars[position] = rng.choice(characters)
+    return "".join(chars)
+
+
+def plant_clusters(rng, unrelated_count, cluster_sizes, length=200, edits=3):
+    """無関係な回答の中に、数文字だけ変えた回答のクラスタを埋め込む（行番号→回答文, 埋め込んだクラスタ）"""
+    texts = [random_text(rng, length) for _ in range(unrelated_count)]
+    planted = []
+    for size in cluster_sizes:
+        base = random_text(rng, length)
+        planted.append(list(range(len(texts), len(texts) + size)))
+        texts.extend(mutate(rng, base, edits) for _ in range(size))
+    order = list(range(len(texts)))
+    rng.shuffle(order)
+    answers = {row: texts[source] for row, source in enumerate(order)}
+    position = {source: row for row, source in enumerate(order)}
+    return answers, [sorted(position[source] for source in cluster) for cluster in planted]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_finds_planted_clusters_exactly(seed):
+    rng = random.Random(seed)
+    answers, planted = plant_clusters(rng, 500, [6, 3, 2])
+
+    clusters = find_near_duplicate_answers(answers, threshold=0.8)
+
+    assert sorted(sorted(rows) for rows in clusters) == sorted(planted)
+    # 大きいクラスタから順に返す
+    assert [len(rows) for rows in clusters] == [6, 3, 2]
+
+
+def test_finds_planted_cluster_among_templated_answers():
+    # 書き出しがそろった（しきい値未満で互いに似た）回答が多数あり、LSHのバケットが混み合う場合
+    rng = random.Random(11)
+    opening = random_text(rng, 200)
+    answers = {row: opening + random_text(rng, 40) for row in range(150)}
+    base = opening + random_text(rng, 40)
+    for row in range(150, 154):
+        answers[row] = mutate(rng, base, 2)
+
+    clusters = find_near_duplicate_answers(answers, threshold=0.8)
+
+    assert clusters == [[150, 151, 152, 153]]
+    assert find_near_duplicate_answers(answers, threshold=0.8, max_representatives=None) == clusters
+
+
+def test_skips_blank_and_missing_answers():
+    answers = {0: "今日は良い一日になるでしょう", 1: "", 2: None, 3: float("nan"), 4: "今日は良い一日になるでしょう"}
+
+    assert find_near_duplicate_answers(answers) == [[0, 4]]
+
+
+def test_returns_no_clusters_for_fewer_than_two_answers():
+    assert find_near_duplicate_answers({0: "回答"}) == []
+
+
+def test_shingle_similarity_ignores_width_case_and_whitespace():
+    shingles_a = build_answer_shingles("ＡＢＣ の 運勢")
+    shingles_b = build_answer_shingles("abcの運勢")
+
+    assert compute_shingle_similarity(shingles_a, shingles_b) == 1.0
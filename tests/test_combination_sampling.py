@@ -0,0 +1,129 @@
+import itertools
+
+import pytest
+
+from combination_sampling import build_covering_array, build_stratified_sample, measure_combination_coverage
+
+
+def make_value_lists(sizes):
+    return [[f"{chr(ord('A') + factor)}{value}" for value in range(size)] for factor, size in enumerate(sizes)]
+
+
+def all_tuples(value_lists, strength):
+    return {
+        (factors, values)
+        for factors in itertools.combinations(range(len(value_lists)), strength)
+        for values in itertools.product(*(value_lists[factor] for factor in factors))
+    }
+
+
+def covered_tuples(rows, value_lists, strength):
+    return {
+        (factors, tuple(row[factor] for factor in factors))
+        for row in rows
+        for factors in itertools.combinations(range(len(value_lists)), strength)
+    }
+
+
+@pytest.mark.parametrize("sizes", [[2, 2, 2], [3, 2, 4], [5, 1, 3, 2], [4, 4, 3, 2, 2], [2, 3, 2, 3, 2, 3]])
+@pytest.mark.parametrize("strength", [2, 3])
+def test_covering_array_covers_every_tuple(sizes, strength):
+    value_lists = make_value_lists(sizes)
+    rows = build_covering_array(value_lists, strength)
+
+    assert covered_tuples(rows, value_lists, strength) == all_tuples(value_lists, strength)
+    # 各行は全カテゴリの値を1つずつ持つ
+    assert all(row[factor] in value_lists[factor] for row in rows for factor in range(len(sizes)))
+
+
+@pytest.mark.parametrize("sizes", [[3, 4, 2, 3], [6, 5, 4, 3, 2]])
+def test_covering_array_is_smaller_than_full_product(sizes):
+    value_lists = make_value_lists(sizes)
+    full_count = len(list(itertools.product(*value_lists)))
+
+    rows = build_covering_array(value_lists, 2)
+
+    assert len(rows) < full_count
+    # 2つ組の網羅には最大の2カテゴリの積以上の行が必要
+    largest = sorted(sizes)[-2:]
+    assert len(rows) >= largest[0] * largest[1]
+
+
+def test_covering_array_with_strength_of_all_factors_is_full_product():
+    value_lists = make_value_lists([2, 3])
+
+    assert build_covering_array(value_lists, 3) == list(itertools.product(*value_lists))
+
+
+@pytest.mark.parametrize("sizes,sample_size", [([5, 4, 3], 10), ([5, 4, 3], 59), ([2, 2, 2, 2], 15), ([12, 10, 8], 200), ([3, 3], 8)])
+def test_stratified_sample_has_requested_size_without_duplicates(sizes, sample_size):
+    value_lists = make_value_lists(sizes)
+
+    rows = build_stratified_sample(value_lists, sample_size, seed=1)
+
+    assert len(rows) == sample_size
+    assert len(set(rows)) == len(rows)
+    assert set(rows) <= set(itertools.product(*value_lists))
+
+
+def test_stratified_sample_fills_remaining_rows_after_shuffle_rounds():
+    value_lists = make_value_lists([3, 3, 3])
+
+    # シャッフルを1回に制限しても、指定件数まで未選択の組み合わせで補う
+    rows = build_stratified_sample(value_lists, 26, seed=0, max_rounds=1)
+
+    assert len(rows) == 26
+    assert len(set(rows)) == 26
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_stratified_sample_balances_values(seed):
+    # 全組み合わせに対して少ない件数では重複がまれなため、各値はほぼ均等に現れる
+    value_lists = make_value_lists([10, 8, 12])
+
+    rows = build_stratified_sample(value_lists, 48, seed=seed)
+
+    for factor, values in enumerate(value_lists):
+        counts = [sum(row[factor] == value for row in rows) for value in values]
+        assert min(counts) >= 1
+        assert max(counts) - min(counts) <= 2
+
+
+def test_stratified_sample_returns_full_product_when_target_exceeds_total():
+    value_lists = make_value_lists([2, 3])
+
+    rows = build_stratified_sample(value_lists, 100)
+
+    assert rows == list(itertools.product(*value_lists))
+
+
+def test_stratified_sample_is_reproducible_with_seed():
+    value_lists = make_value_lists([6, 5, 4])
+
+    assert build_stratified_sample(value_lists, 30, seed=7) == build_stratified_sample(value_lists, 30, seed=7)
+
+
+def test_measure_combination_coverage_counts_covered_tuples():
+    value_lists = make_value_lists([2, 2, 2])
+    rows = [("A0", "B0", "C0"), ("A1", "B1", "C1")]
+
+    assert measure_combination_coverage(rows, value_lists, 1) == (6, 6)
+    # 3つのカテゴリの組 × 2つ組4通りのうち、各行が3つずつ網羅する
+    assert measure_combination_coverage(rows, value_lists, 2) == (6, 12)
+    assert measure_combination_coverage(rows, value_lists, 3) == (2, 8)
+
+
+def test_measure_combination_coverage_of_covering_array_is_complete():
+    value_lists = make_value_lists([3, 4, 2, 3])
+    rows = build_covering_array(value_lists, 2)
+
+    covered, total = measure_combination_coverage(rows, value_lists, 2)
+
+    assert covered == total == len(all_tuples(value_lists, 2))
+
+
+def test_measure_combination_coverage_caps_strength_at_factor_count():
+    value_lists = make_value_lists([2, 3])
+    rows = list(itertools.product(*value_lists))
+
+    assert measure_combination_coverage(rows, value_lists, 3) == (6, 6)
@@ -0,0 +1,210 @@
+import json
+import threading
+import types
+import urllib.error
+import urllib.request
+
+import pandas as pd
+import pytest
+
+from fortune_api import (
+    FakeModelClient, FakeModelResponse, FortuneAPI, FortuneGenerator, ResponseCache, api_server_defaults,
+    create_api_server, load_api_settings
+)
+from keyword_index import build_keyword_index, compact_keyword_table, default_category_aliases
+from request_scheduler import RequestScheduler, build_scheduler_settings
+
+
+def make_keyword_index():
+    tables = {
+        "サイン": compact_keyword_table(pd.DataFrame({"キーワード": ["牡羊座", "牡牛座"], "意味": ["始まり", "安定"]})),
+        "ハウス": compact_keyword_table(pd.DataFrame({"キーワード": ["第1ハウス", "第7ハウス"], "意味": ["自分", "パートナー"]})),
+    }
+    return build_keyword_index(tables, default_category_aliases)
+
+
+class CountingClient(FakeModelClient):
+    """呼び出し回数を数え、指定した場合は失敗する・トークン使用量を返す疑似クライアント"""
+
+    def __init__(self, latency_seconds=0.0, error=None, tokens=0):
+        super().__init__(latency_seconds)
+        self.error = error
+        self.tokens = tokens
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def generate_content(self, model, contents, config=None):
+        with self.lock:
+            self.calls += 1
+        if self.error:
+            raise self.error
+        response = super().generate_content(model, contents, config)
+        usage = types.SimpleNamespace(prompt_token_count=self.tokens, candidates_token_count=0, thoughts_token_count=0, cached_content_token_count=0)
+        return FakeModelResponse(response.text, usage)
+
+
+def make_api(client, scheduler=None, presets=None):
+    settings = dict(api_server_defaults, answer_length=60, summary_length=20)
+    generator = FortuneGenerator(settings, client, make_keyword_index(), presets, "あなたは占い師です。", scheduler=scheduler)
+    return FortuneAPI(generator.prepare, generator.generate, ResponseCache())
+
+
+def make_payload(**overrides):
+    payload = {
+        "question": "今日の運勢は？",
+        "keywords": [{"category": "サイン", "keyword": "牡羊座", "target": "あなた"}, {"category": "house", "keyword": "第７ハウス", "target": "あの人"}],
+    }
+    payload.update(overrides)
+    return payload
+
+
+def test_generates_then_serves_from_cache():
+    client = CountingClient()
+    api = make_api(client)
+
+    status, body = api.handle(make_payload())
+    assert status == 200
+    assert body["source"] == "generated"
+    assert body["回答"].startswith("（疑似回答")
+    # カテゴリの別名・全角数字は読み込み済みの名前に照合される
+    assert body["keywords"] == [
+        {"category": "サイン", "keyword": "牡羊座", "target": "あなた"},
+        {"category": "ハウス", "keyword": "第7ハウス", "target": "あの人"},
+    ]
+
+    # キーワードの並び順・質問の全角半角が違っても同じリクエストとしてキャッシュから返す
+    payload = make_payload(question="今日の運勢は?", keywords=list(reversed(make_payload()["keywords"])))
+    status, cached = api.handle(payload)
+    assert status == 200
+    assert cached["source"] == "cache"
+    assert cached["回答"] == body["回答"]
+    assert client.calls == 1
+
+    # 条件が違うリクエストは新たに生成する
+    status, other = api.handle(make_payload(answer_length=80))
+    assert (status, other["source"]) == (200, "generated")
+    assert client.calls == 2
+    assert api.snapshot()["cache_hits"] == 1
+
+
+def test_coalesces_concurrent_identical_requests():
+    client = CountingClient(latency_seconds=0.3)
+    api = make_api(client)
+    results = []
+    barrier = threading.Barrier(6)
+
+    def request():
+        barrier.wait()
+        results.append(api.handle(make_payload()))
+
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [status for status, _ in results] == [200] * 6
+    sources = sorted(body["source"] for _, body in results)
+    assert sources.count("generated") == 1
+    assert set(sources) <= {"generated", "coalesced", "cache"}
+    assert len({body["回答"] for _, body in results}) == 1
+    assert client.calls == 1
+
+
+@pytest.mark.parametrize("payload,message", [
+    (["question"], "JSONのオブジェクト"),
+    ({"keywords": []}, "question"),
+    (dict(question="運勢", keywords={"category": "サイン"}), "配列"),
+    (dict(question="運勢", keywords=[{"category": "タロット", "keyword": "愚者"}]), "タロット"),
+    (dict(question="運勢", keywords=[{"category": "サイン", "keyword": "蛇遣い座"}]), "蛇遣い座"),
+    (dict(question="運勢", keywords=[{"category": "サイン", "keyword": "すべて"}]), "すべて"),
+    (dict(question="運勢", keywords=[{"category": "サイン", "keyword": "牡羊座", "target": "友人"}]), "友人"),
+    (dict(question="運勢", model="gpt-4"), "gpt-4"),
+    (dict(question="運勢", answer_length="長め"), "整数"),
+    (dict(question="運勢", answer_length=10), "answer_length"),
+    (dict(question="運勢", preset="未登録"), "未登録"),
+])
+def test_rejects_invalid_requests(payload, message):
+    client = CountingClient()
+    api = make_api(client)
+
+    status, body = api.handle(payload)
+
+    assert status == 400
+    assert message in body["error"]
+    assert client.calls == 0
+    assert api.snapshot()["errors"] == 1
+
+
+def test_model_failure_returns_502_and_is_not_cached():
+    client = CountingClient(error=RuntimeError("backend unavailable"))
+    api = make_api(client)
+
+    status, body = api.handle(make_payload())
+    assert status == 502
+    assert "backend unavailable" in body["error"]
+
+    # 失敗した結果はキャッシュしないので、復旧後は生成し直す
+    client.error = None
+    status, body = api.handle(make_payload())
+    assert (status, body["source"]) == (200, "generated")
+
+
+def test_quota_exceeded_returns_429():
+    scheduler = RequestScheduler(build_scheduler_settings({"scheduler": {"role_daily_tokens": {"api": 10}}}))
+    client = CountingClient(tokens=50)
+    api = make_api(client, scheduler)
+
+    status, _ = api.handle(make_payload())
+    assert status == 200
+    status, body = api.handle(make_payload(question="明日の運勢は？"))
+    assert status == 429
+    assert "トークン上限" in body["error"]
+    assert client.calls == 1
+
+
+def test_preset_rules_reach_the_prompt():
+    client = CountingClient()
+    prompts = []
+    original = client.generate_content
+
+    def record(model, contents, config=None):
+        prompts.append(config.system_instruction)
+        return original(model, contents, config)
+
+    client.generate_content = record
+    api = make_api(client, presets={"恋愛": {"rules": "恋愛の話題に絞る", "tone": "やさしく"}})
+
+    status, _ = api.handle(make_payload(preset="恋愛"))
+
+    assert status == 200
+    assert "恋愛の話題に絞る" in prompts[0] and "やさしく" in prompts[0]
+
+
+def test_http_server_requires_token():
+    settings = load_api_settings({"api_server": {"token": "from-config"}}, {"api_server": {"token": "secret"}})
+    generator = FortuneGenerator(settings, CountingClient(), make_keyword_index())
+    api = FortuneAPI(generator.prepare, generator.generate, ResponseCache(), settings["token"])
+    server = create_api_server(api, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/fortune"
+    try:
+        def post(token):
+            request = urllib.request.Request(
+                url, json.dumps(make_payload()).encode("utf-8"),
+                {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    return response.status, json.load(response)
+            except urllib.error.HTTPError as e:
+                return e.code, json.load(e)
+
+        assert post("from-config")[0] == 401
+        status, body = post("secret")
+        assert status == 200
+        assert body["source"] == "generated"
+    finally:
+        server.shutdown()
+        server.server_close()
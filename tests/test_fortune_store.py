@@ -0,0 +1,71 @@
+import pytest
+
+from fortune_store import FortuneStore, build_fortune_store, build_store_entries, parse_keyword_column
+
+value_columns = ["id", "質問", "回答", "サマリ", "元キーワード", "アレンジキーワード", "生成モデル"]
+
+
+def make_record(question_id, keyword_columns, answer):
+    record = {col: "" for col in value_columns}
+    record.update(id=question_id, 質問="今日の運勢は？", 回答=answer, サマリ="まとめ", 生成モデル="gemini-2.5-flash")
+    record.update(keyword_columns)
+    return record
+
+
+@pytest.mark.parametrize("column_name,expected", [
+    ("あなたの太陽1", ("あなた", "太陽")),
+    ("あの人の月2", ("あの人", "月")),
+    ("相性のハウス3", ("相性", "ハウス")),
+    ("あの人のMP軸12", ("あの人", "MP軸")),
+    ("あなたのあの人の星1", ("あなた", "あの人の星")),
+])
+def test_parse_keyword_column_splits_target_and_category(column_name, expected):
+    assert parse_keyword_column(column_name, "牡羊座") == expected + ("牡羊座",)
+
+
+def test_parse_keyword_column_keeps_unknown_columns_whole():
+    assert parse_keyword_column("備考", "メモ") == ("", "備考", "メモ")
+
+
+@pytest.mark.parametrize("who", ["あなた", "あの人", "相性"])
+def test_entries_round_trip_through_store(tmp_path, who):
+    records = [
+        make_record("Q1", {f"{who}の太陽1": "牡羊座", f"{who}のハウス2": "第1ハウス"}, "回答1"),
+        make_record("Q1", {f"{who}の太陽1": "牡牛座", f"{who}のハウス2": "第1ハウス"}, "回答2"),
+        make_record("Q2", {f"{who}の太陽1": "牡羊座", f"{who}のハウス2": "第1ハウス"}, "回答3"),
+    ]
+    path = tmp_path / "store.bin"
+
+    assert build_fortune_store(build_store_entries(records, value_columns), str(path)) == 3
+
+    store = FortuneStore(str(path))
+    try:
+        # キーワードの並び順によらず引ける
+        result = store.lookup("Q1", [(who, "ハウス", "第1ハウス"), (who, "太陽", "牡牛座")])
+        assert result["回答"] == "回答2"
+        assert result["id"] == "Q1"
+        assert store.lookup("Q2", [(who, "太陽", "牡羊座"), (who, "ハウス", "第1ハウス")])["回答"] == "回答3"
+        # 対象が違う組み合わせは別のキーになる
+        other = next(target for target in ["あなた", "あの人", "相性"] if target != who)
+        assert store.lookup("Q1", [(other, "太陽", "牡羊座"), (other, "ハウス", "第1ハウス")]) is None
+    finally:
+        store.close()
+
+
+def test_entries_mix_targets_and_skip_blank_keyword_columns(tmp_path):
+    records = [
+        make_record("Q1", {"あなたの太陽1": "牡羊座", "あの人の太陽2": "天秤座", "相性のハウス3": None}, "回答1"),
+        make_record("Q1", {"あなたの太陽1": "牡羊座", "あの人の太陽2": "天秤座", "相性のハウス3": float("nan")}, "回答2"),
+    ]
+    path = tmp_path / "store.bin"
+
+    # 空欄の列はキーに含めないため、2行は同じキーになり後の行が使われる
+    assert build_fortune_store(build_store_entries(records, value_columns), str(path)) == 1
+
+    store = FortuneStore(str(path))
+    try:
+        result = store.lookup("Q1", [("あの人", "太陽", "天秤座"), ("あなた", "太陽", "牡羊座")])
+        assert result["回答"] == "回答2"
+        assert result["元キーワード"] == ""
+    finally:
+        store.close()
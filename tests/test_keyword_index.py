@@ -0,0 +1,42 @@
+import pandas as pd
+import pytest
+
+from keyword_index import build_keyword_index, compact_keyword_table, default_category_aliases, match_keyword_category, match_keyword_name
+
+
+def make_keyword_index(category_names):
+    tables = {
+        category_name: compact_keyword_table(pd.DataFrame({"キーワード": [f"{category_name}A", f"{category_name}B"], "意味": ["a", "b"]}))
+        for category_name in category_names
+    }
+    return build_keyword_index(tables, default_category_aliases)
+
+
+@pytest.mark.parametrize("header,expected", [
+    ("サイン", "サイン"),
+    ("ｻｲﾝ", "サイン"),
+    ("星座", "サイン"),
+    ("Sign", "サイン"),
+    ("HOUSE", "ハウス"),
+    ("サイン1", "サイン"),
+    ("カテゴリ: ハウス", "ハウス"),
+])
+def test_match_keyword_category_accepts_names_and_aliases(header, expected):
+    assert match_keyword_category(make_keyword_index(["サイン", "ハウス", "天体"]), header) == expected
+
+
+@pytest.mark.parametrize("header", ["design", "greenhouse", "planetarium", "タロットカード"])
+def test_match_keyword_category_does_not_match_aliases_inside_other_words(header):
+    assert match_keyword_category(make_keyword_index(["サイン", "ハウス", "天体"]), header) is None
+
+
+def test_match_keyword_category_prefers_the_longest_category_name():
+    for category_names in (["MP", "MP軸"], ["MP軸", "MP"]):
+        assert match_keyword_category(make_keyword_index(category_names), "MP軸1") == "MP軸"
+
+
+def test_match_keyword_name_folds_width_and_case():
+    keyword_index = make_keyword_index(["サイン"])
+    assert match_keyword_name(keyword_index, "サイン", " ｻｲﾝa ") == "サインA"
+    assert match_keyword_name(keyword_index, "サイン", "ALL") == "すべて"
+    assert match_keyword_name(keyword_index, "サイン", "サインC") is None
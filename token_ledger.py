@@ -0,0 +1,44 @@
+"""トークン使用量台帳（SQLite、追記のみ）
+
+生成・再生成・要約・HTTP APIなど、1回の実行ごとのトークン使用量を記録する。画面（app.py）とHTTP APIサーバー
+（fortune_api.py）が同じファイルに追記できるよう、保存先は呼び出し側から受け取る。
+"""
+import sqlite3
+from datetime import datetime
+
+import pytz
+
+
+# 台帳接続関数
+def open_token_ledger(path):
+    """トークン使用量台帳（追記のみ）に接続し、テーブルがなければ作成する"""
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS token_ledger ("
+        "recorded_at TEXT, kind TEXT, role TEXT, model TEXT, cascade INTEGER, thinking_budget INTEGER,"
+        " preset TEXT, input_mode TEXT, combination_count INTEGER, row_count INTEGER,"
+        " prompt_tokens INTEGER, candidates_tokens INTEGER, thoughts_tokens INTEGER, cached_tokens INTEGER,"
+        " duration_seconds REAL)"
+    )
+    return connection
+
+
+# 台帳追記関数
+def append_token_usage(path, kind, role, settings, combination_count, row_count, token_totals, duration_seconds):
+    """1回の実行のトークン使用量を台帳に追記する（記録に失敗しても生成結果には影響させない、成功した場合はTrue）"""
+    try:
+        connection = open_token_ledger(path)
+        with connection:
+            connection.execute(
+                "INSERT INTO token_ledger VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    datetime.now(pytz.timezone("Asia/Tokyo")).strftime("%Y-%m-%d %H:%M:%S"), kind, role,
+                    " → ".join(settings["model_chain"]), int(settings["cascade_enabled"]), settings["thinking_budget"],
+                    settings.get("preset_name") or "", settings.get("input_mode", ""),
+                    combination_count, row_count, *token_totals, round(duration_seconds, 2)
+                )
+            )
+        connection.close()
+        return True
+    except sqlite3.Error:
+        return False